@@ -1,18 +1,46 @@
 import os
+import abc
 import time
 import random
 import datetime
 import json
-from flask import Flask, request, redirect, url_for, render_template, send_from_directory, session, flash, abort, jsonify, Response
+from flask import Flask, request, redirect, url_for, render_template, send_from_directory, send_file, session, flash, abort, jsonify, Response, g
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException
+import werkzeug.utils
 import functools
 import shutil
 import requests
-from urllib.parse import urlparse, urlunparse
+from requests.adapters import HTTPAdapter
+import http.cookiejar
+from urllib.parse import urlparse, urlunparse, quote
 import mimetypes
 import math
 from dotenv import load_dotenv
 import uuid # For unique ID generation
+import threading
+import stat
+import hashlib
+import collections
+import bisect
+import sqlite3
+import queue
+import itertools
+import re
+import base64
+import secrets
+import zipfile
+import tarfile
+import posixpath
+import struct
+import zlib
+import concurrent.futures
+import cProfile
+import pstats
+import io
+import multiprocessing
+import click
+import imaging
 
 load_dotenv()
 
@@ -20,32 +48,333 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'a_default_secret_key_for_dev')
 app.config['EMOTICONS_FOLDER'] = os.environ.get('EMOTICONS_FOLDER', 'emoticons')
 app.config['ADMIN_PASSWORD'] = os.environ.get('ADMIN_PASSWORD', 'admin')
+# Application state (caches, databases) lives outside EMOTICONS_FOLDER so it never shows up as a category
+app.config['DATA_FOLDER'] = os.environ.get('DATA_FOLDER', 'data')
+app.config['PROXY_CACHE_MAX_BYTES'] = int(os.environ.get('PROXY_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+app.config['PROXY_CACHE_MAX_ITEM_BYTES'] = int(os.environ.get('PROXY_CACHE_MAX_ITEM_BYTES', 20 * 1024 * 1024))
+app.config['PROXY_CACHE_TTL'] = int(os.environ.get('PROXY_CACHE_TTL', 3600)) # seconds before revalidating with the origin
+# Bearer token Prometheus sends to /metrics (Authorization: Bearer ...); logged-in admins can always read it
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+# Request profiling, off unless one of the first two is set: fraction of requests profiled at random, and
+# whether a logged-in admin can ask for a profile with an "X-Profile-Request: 1" header
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_HEADER'] = os.environ.get('PROFILE_HEADER', 'false').lower() in ('1', 'true', 'yes', 'on')
+app.config['PROFILE_FOLDER'] = os.environ.get('PROFILE_FOLDER', os.path.join(app.config['DATA_FOLDER'], 'profiles'))
+app.config['PROFILE_MAX_FILES'] = int(os.environ.get('PROFILE_MAX_FILES', 200)) # the slowest ones are kept
+# Async proxy mode, switched on by asgi.py: the image proxy's origin fetches run on its async client
+# (at most ASYNC_PROXY_MAX_CONNECTIONS at once per process) instead of holding a worker thread
+app.config['ASYNC_PROXY'] = False
+app.config['ASYNC_PROXY_MAX_CONNECTIONS'] = int(os.environ.get('ASYNC_PROXY_MAX_CONNECTIONS', 200))
+# Shared outbound HTTP client (image proxy, URL importer)
+app.config['HTTP_POOL_CONNECTIONS'] = int(os.environ.get('HTTP_POOL_CONNECTIONS', 32)) # number of per-host pools kept
+app.config['HTTP_POOL_MAXSIZE'] = int(os.environ.get('HTTP_POOL_MAXSIZE', 10)) # keep-alive connections per host
+app.config['HTTP_CONNECT_TIMEOUT'] = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+app.config['HTTP_READ_TIMEOUT'] = float(os.environ.get('HTTP_READ_TIMEOUT', 15))
+app.config['HTTP_USER_AGENT'] = os.environ.get('HTTP_USER_AGENT', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.85 Safari/537.36')
+# Background health checks of external links; dead links leave the random pool until a check succeeds again
+app.config['LINK_CHECK_INTERVAL'] = int(os.environ.get('LINK_CHECK_INTERVAL', 6 * 3600)) # seconds between checks of a link, 0 disables the checker
+app.config['LINK_CHECK_CONCURRENCY'] = int(os.environ.get('LINK_CHECK_CONCURRENCY', 4))
+app.config['LINK_CHECK_TIMEOUT'] = float(os.environ.get('LINK_CHECK_TIMEOUT', 10)) # read timeout of one check
+app.config['LINK_CHECK_FAILURES'] = int(os.environ.get('LINK_CHECK_FAILURES', 2)) # consecutive failed checks before a link counts as dead
+# URL import: downloads running at once, overall and per origin host
+app.config['IMPORT_MAX_WORKERS'] = int(os.environ.get('IMPORT_MAX_WORKERS', 8))
+app.config['IMPORT_MAX_PER_HOST'] = int(os.environ.get('IMPORT_MAX_PER_HOST', 2))
+# URL import task store: 'sqlite' is shared by all Gunicorn workers and survives restarts, 'memory' is single-process only
+app.config['TASK_STORE'] = os.environ.get('TASK_STORE', 'sqlite')
+app.config['TASK_STORE_PATH'] = os.environ.get('TASK_STORE_PATH', os.path.join(app.config['DATA_FOLDER'], 'tasks.sqlite3'))
+app.config['TASK_TTL'] = int(os.environ.get('TASK_TTL', 24 * 3600)) # seconds before an unfinished task is cleaned up
+app.config['TASK_HEARTBEAT_TIMEOUT'] = int(os.environ.get('TASK_HEARTBEAT_TIMEOUT', 60)) # seconds without a heartbeat before a running task counts as orphaned
+# SQLite catalog of external links and local-file metadata (replaces per-category external_links.json)
+app.config['CATALOG_PATH'] = os.environ.get('CATALOG_PATH', os.path.join(app.config['DATA_FOLDER'], 'catalog.sqlite3'))
+# Let the front server send local images: '' sends them from the app (default), 'sendfile' returns an
+# X-Sendfile header (Apache mod_xsendfile, lighttpd, ...), 'nginx' returns X-Accel-Redirect to FILE_OFFLOAD_PREFIX
+app.config['FILE_OFFLOAD'] = os.environ.get('FILE_OFFLOAD', '').lower()
+app.config['FILE_OFFLOAD_PREFIX'] = os.environ.get('FILE_OFFLOAD_PREFIX', '/_emoticons/') # nginx internal location mapped to EMOTICONS_FOLDER
+# Random endpoint redirect mode: answer with a 302 to a stable, cacheable /media/... URL instead of the bytes.
+# Can be overridden per request with ?redirect=1 / ?redirect=0.
+app.config['RANDOM_REDIRECT'] = os.environ.get('RANDOM_REDIRECT', 'false').lower() in ('1', 'true', 'yes', 'on')
+app.config['MEDIA_MAX_AGE'] = int(os.environ.get('MEDIA_MAX_AGE', 365 * 24 * 3600)) # seconds, for content-addressed local files
+# Per-client "last shown" state of the random endpoint, kept server-side (LRU, entries are (client, category) pairs)
+app.config['CLIENT_STATE_STORE'] = os.environ.get('CLIENT_STATE_STORE', 'sqlite') # 'sqlite' (shared by all workers) or 'memory' (single worker)
+app.config['CLIENT_STATE_PATH'] = os.environ.get('CLIENT_STATE_PATH', os.path.join(app.config['DATA_FOLDER'], 'client_state.sqlite3'))
+app.config['CLIENT_STATE_MAX_ENTRIES'] = int(os.environ.get('CLIENT_STATE_MAX_ENTRIES', 50000))
+# Shuffle-bag mode of the random endpoint (no repeats until the whole category was shown):
+# comma-separated category names that use it by default, '*' for all. ?mode=shuffle / ?mode=random override per request.
+app.config['SHUFFLE_CATEGORIES'] = os.environ.get('SHUFFLE_CATEGORIES', '')
+# Content deduplication of stored images by SHA-256:
+# 'link' stores copies in other categories as hard links, 'reject' refuses every duplicate, 'off' disables the check.
+# A file whose bytes are already in the same category is never stored twice unless this is 'off'.
+app.config['DEDUP_MODE'] = os.environ.get('DEDUP_MODE', 'link').lower()
+# Archive (zip/tar) upload limits, checked against the bytes actually extracted
+app.config['ARCHIVE_MAX_MEMBERS'] = int(os.environ.get('ARCHIVE_MAX_MEMBERS', 20000))
+app.config['ARCHIVE_MAX_MEMBER_BYTES'] = int(os.environ.get('ARCHIVE_MAX_MEMBER_BYTES', 50 * 1024 * 1024))
+app.config['ARCHIVE_MAX_TOTAL_BYTES'] = int(os.environ.get('ARCHIVE_MAX_TOTAL_BYTES', 4 * 1024 * 1024 * 1024))
+app.config['ARCHIVE_MAX_RATIO'] = int(os.environ.get('ARCHIVE_MAX_RATIO', 100)) # zip members: uncompressed / compressed size
+# Admin grid thumbnails (needs Pillow), rendered in a process pool
+app.config['THUMBNAIL_FOLDER'] = os.environ.get('THUMBNAIL_FOLDER', os.path.join(app.config['DATA_FOLDER'], 'thumbnails'))
+app.config['THUMBNAIL_SIZE'] = int(os.environ.get('THUMBNAIL_SIZE', 256)) # longest side in pixels
+app.config['THUMBNAIL_WORKERS'] = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+app.config['THUMBNAIL_RENDER_TIMEOUT'] = float(os.environ.get('THUMBNAIL_RENDER_TIMEOUT', 0.3)) # seconds a request waits for a missing thumbnail before falling back to the original
+# WebP/AVIF re-encodings of local images, sent to clients whose Accept header lists them (needs Pillow)
+app.config['IMAGE_VARIANTS'] = [fmt.strip().lower() for fmt in os.environ.get('IMAGE_VARIANTS', 'avif,webp').split(',') if fmt.strip()] # preferred first
+app.config['VARIANT_FOLDER'] = os.environ.get('VARIANT_FOLDER', os.path.join(app.config['DATA_FOLDER'], 'variants'))
+app.config['VARIANT_QUALITY'] = int(os.environ.get('VARIANT_QUALITY', 80))
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 ALLOWED_PER_PAGE = [50, 100, 150, 200, 250, 300]
 ADMIN_ALLOWED_PER_PAGE = [10, 20, 30, 40, 50]
 
-# Global store for URL processing tasks (for simplicity in this example)
-# WARNING: This in-memory dict is not suitable for multi-worker Gunicorn setups in production.
-# Consider Redis or another shared store for production.
-url_processing_tasks = {}
-
 if not os.path.exists(app.config['EMOTICONS_FOLDER']):
     os.makedirs(app.config['EMOTICONS_FOLDER'])
+if not os.path.exists(app.config['DATA_FOLDER']):
+    os.makedirs(app.config['DATA_FOLDER'])
+
+# --- Metrics ---
+# In-process counters and histograms rendered in the Prometheus text format by
+# /metrics. Recording is a dict update under one lock, cheap enough to stay on in
+# production. Values are per process: with several Gunicorn workers each scrape
+# is answered by whichever worker gets the request, so every sample carries a pid
+# label, and process_start_time_seconds tells a restarted worker's reset counters
+# apart from a drop. Aggregate across workers in queries, e.g. sum without (pid).
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+UPSTREAM_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30)
+TASK_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(label_names, label_values, *extra):
+    """extra: already formatted pairs appended after the metric's own labels, e.g. the process label."""
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    pairs.extend(pair for pair in extra if pair)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, registry, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = registry.lock
+        self.values = {} # label values tuple -> value
+        registry.metrics.append(self)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.metric_type}']
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self, process_label=''):
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f'{self.name}{_format_labels(self.label_names, labels, process_label)} {_format_value(value)}'
+                                for labels, value in items]
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, registry, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value) # first bucket with le >= value
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                state = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def render(self, process_label=''):
+        with self.lock:
+            items = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
+        lines = self.header()
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                bucket_labels = _format_labels(self.label_names, labels, process_label, 'le="%s"' % le)
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, labels, process_label)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, labels, process_label)} {cumulative}')
+        return lines
+
+class CallbackMetric(Metric):
+    """
+    A value read when /metrics is rendered, for state other components already keep
+    (cache sizes, queue lengths, their own counters). callback returns a number or
+    {label values tuple: number}. A shared metric reads state all workers share (an
+    SQLite store), so every worker reports the same series and it carries no pid label.
+    """
+
+    def __init__(self, registry, name, help_text, callback, label_names=(), metric_type='gauge', shared=False):
+        super().__init__(registry, name, help_text, label_names)
+        self.callback = callback
+        self.metric_type = metric_type
+        self.shared = shared
+
+    def render(self, process_label=''):
+        if self.shared:
+            process_label = ''
+        try:
+            values = self.callback()
+        except Exception as e: # a broken gauge must not take the whole endpoint down
+            app.logger.warning(f"Metric {self.name} failed: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return self.header() + [f'{self.name}{_format_labels(self.label_names, labels, process_label)} {_format_value(value)}'
+                                for labels, value in sorted(values.items())]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def render(self):
+        # Read at render time: with gunicorn --preload this module is imported before the workers fork
+        process_label = f'pid="{os.getpid()}"'
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(process_label))
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+process_started_at = time.time()
+
+def _reset_process_start():
+    global process_started_at
+    process_started_at = time.time()
+
+os.register_at_fork(after_in_child=_reset_process_start) # a forked worker is a new process to Prometheus
+CallbackMetric(metrics, 'process_start_time_seconds', 'Start time of the process since unix epoch in seconds.',
+               lambda: process_started_at)
+http_requests = Counter(metrics, 'bqb_http_requests_total', 'Requests handled, by endpoint, method and status.',
+                        ('endpoint', 'method', 'status'))
+http_request_seconds = Histogram(metrics, 'bqb_http_request_duration_seconds',
+                                 'Time from routing to the response headers (to the end of the body for the async proxy), by endpoint.',
+                                 ('endpoint',))
+http_response_bytes = Counter(metrics, 'bqb_http_response_bytes_total',
+                              'Response body bytes, from Content-Length or counted as streamed bodies are sent, by endpoint.',
+                              ('endpoint',))
+upstream_responses = Counter(metrics, 'bqb_upstream_responses_total',
+                             'Outbound fetches (image proxy, URL import), by host and HTTP status or error kind.', ('host', 'status'))
+upstream_request_seconds = Histogram(metrics, 'bqb_upstream_request_duration_seconds',
+                                     'Time until an origin sent its response headers, by host.', ('host',), UPSTREAM_BUCKETS)
+fs_scan_seconds = Histogram(metrics, 'bqb_fs_scan_duration_seconds',
+                            'Directory scans, by kind (category: one category directory, category_list: EMOTICONS_FOLDER).', ('kind',))
+category_index_builds = Counter(metrics, 'bqb_category_index_builds_total', 'Random endpoint item indexes rebuilt from the catalog.')
+import_items = Counter(metrics, 'bqb_import_items_total', 'Imported items, by source (upload, url, archive) and status.',
+                       ('source', 'status'))
+import_bytes = Counter(metrics, 'bqb_import_bytes_total', 'Bytes written by imports, by source.', ('source',))
+import_task_seconds = Histogram(metrics, 'bqb_import_task_duration_seconds', 'Duration of finished URL import tasks.',
+                                buckets=TASK_BUCKETS)
+link_checks = Counter(metrics, 'bqb_link_checks_total', 'External link health checks, by result (healthy, failed, inconclusive).',
+                      ('result',))
+
+def record_upstream_response(url, status, started_at):
+    """Records one outbound fetch; status is the HTTP status or an error kind such as 'timeout'."""
+    host = (urlparse(url).hostname or '').lower()
+    upstream_request_seconds.observe(time.perf_counter() - started_at, host)
+    upstream_responses.inc(host, str(status))
+
+# --- End Metrics ---
+
+# --- Outbound HTTP Client ---
+# One pooled requests.Session for every outbound fetch, so repeated requests to the
+# same image host reuse keep-alive connections instead of a new TCP+TLS handshake.
+
+def create_http_client():
+    """Builds the shared session with per-host connection pools and default headers."""
+    client = requests.Session()
+    adapter = HTTPAdapter(pool_connections=app.config['HTTP_POOL_CONNECTIONS'],
+                          pool_maxsize=app.config['HTTP_POOL_MAXSIZE'])
+    client.mount('http://', adapter)
+    client.mount('https://', adapter)
+    client.headers['User-Agent'] = app.config['HTTP_USER_AGENT']
+    # The session is shared by all requests, never carry cookies from one origin response to the next
+    client.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    return client
+
+http_client = create_http_client()
+
+def http_request(method, url, **kwargs):
+    """A request through the shared client, applying the configured (connect, read) timeouts."""
+    kwargs.setdefault('timeout', (app.config['HTTP_CONNECT_TIMEOUT'], app.config['HTTP_READ_TIMEOUT']))
+    started_at = time.perf_counter()
+    try:
+        response = http_client.request(method, url, **kwargs)
+    except requests.exceptions.Timeout:
+        record_upstream_response(url, 'timeout', started_at)
+        raise
+    except requests.exceptions.RequestException:
+        record_upstream_response(url, 'error', started_at)
+        raise
+    record_upstream_response(url, response.status_code, started_at)
+    return response
+
+def http_get(url, **kwargs):
+    return http_request('GET', url, **kwargs)
+
+# --- End Outbound HTTP Client ---
+
+# --- SQLite Helpers ---
+
+class SQLiteDatabase:
+    """Base for the SQLite-backed stores: one connection per thread, WAL journal."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    def _ensure_columns(self, conn, table, columns):
+        """Adds columns missing from a table created by an older version."""
+        existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+        for column, definition in columns.items():
+            if column not in existing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+# --- End SQLite Helpers ---
+
+# --- Metadata Catalog ---
+# External links and local-file metadata of every category live in one SQLite
+# catalog (DATA_FOLDER/catalog.sqlite3), replacing the per-category
+# external_links.json files. Each category row carries a version that every
+# write bumps, and the directory mtime the local files were last synced at.
 
-# --- Helper Functions for External Links ---
 def generate_unique_id():
     """Generates a unique ID string."""
     return str(uuid.uuid4())
 
 def get_external_links_path(category_name):
-    """Gets the full path to the external_links.json file for a category."""
+    """Gets the full path to the legacy external_links.json file for a category."""
     # The category_name received here should already be validated by the route
     # For path construction, we use the original category_name as it's used for directory names
     category_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name)
     return os.path.join(category_path, 'external_links.json')
 
 def load_external_links(category_name):
-    """Loads external links for a given category from its JSON file."""
+    """Loads external links for a given category from its legacy JSON file (used by the migration)."""
     links_file_path = get_external_links_path(category_name)
 
     if not os.path.exists(links_file_path):
@@ -65,30 +394,2499 @@ def load_external_links(category_name):
         app.logger.error(f"Error loading external links for {category_name}: {e}")
         return []
 
-def save_external_links(category_name, links_data):
-    """Saves external links for a given category to its JSON file."""
-    links_file_path = get_external_links_path(category_name)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def normalize_url(url):
+    """
+    Canonical form of an http(s) URL used for duplicate detection and downloading:
+    lower-case scheme and host, default port dropped, empty path as '/', no fragment.
+    Raises ValueError for URLs that cannot be parsed.
+    """
+    parsed_url = urlparse(url.strip())
+    scheme = parsed_url.scheme.lower()
+    netloc = (parsed_url.hostname or '').lower()
+    if ':' in netloc:
+        netloc = f'[{netloc}]' # IPv6 literal
+    port = parsed_url.port
+    if port is not None and DEFAULT_PORTS.get(scheme) != port:
+        netloc = f'{netloc}:{port}'
+    if parsed_url.username is not None:
+        userinfo = parsed_url.username if parsed_url.password is None else f'{parsed_url.username}:{parsed_url.password}'
+        netloc = f'{userinfo}@{netloc}'
+    return urlunparse((scheme, netloc, parsed_url.path or '/', parsed_url.params, parsed_url.query, ''))
+
+def url_key(url):
+    """normalize_url for values already stored, falling back to the raw URL if it does not parse."""
+    try:
+        return normalize_url(url)
+    except ValueError:
+        return url
+
+def file_added_at(modified_time):
+    """Formats a file mtime the way added_at is stored."""
+    return datetime.datetime.fromtimestamp(modified_time, datetime.timezone.utc).isoformat()
+
+class Catalog(SQLiteDatabase):
+    """Indexed catalog of the items (local files and external links) in each category."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS categories (
+                                name TEXT PRIMARY KEY,
+                                version INTEGER NOT NULL DEFAULT 0,
+                                dir_mtime_ns INTEGER
+                            )''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS items (
+                                category TEXT NOT NULL,
+                                type TEXT NOT NULL,
+                                id TEXT NOT NULL,
+                                name TEXT NOT NULL,
+                                url TEXT,
+                                added_at TEXT NOT NULL,
+                                size INTEGER,
+                                PRIMARY KEY (category, type, id)
+                            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_items_id ON items (id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_items_url ON items (category, url)')
+            # Listing order of the admin view, the trailing id makes keyset cursors unique
+            conn.execute('DROP INDEX IF EXISTS idx_items_added_at')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_items_listing ON items (category, added_at, name, id)')
+            # crc32 is cached for the zip export and only trusted while size and mtime match
+            self._ensure_columns(conn, 'items', {'url_key': 'TEXT', 'sha256': 'TEXT',
+                                                 'crc32': 'INTEGER', 'crc_size': 'INTEGER', 'crc_mtime_ns': 'INTEGER'})
+            # Link health: status is NULL until the first check, then 'ok' or 'dead'; a NULL next check means due now
+            self._ensure_columns(conn, 'items', {'health_status': 'TEXT', 'health_detail': 'TEXT', 'health_failures': 'INTEGER',
+                                                 'health_checked_at': 'TEXT', 'health_next_check': 'TEXT', 'health_claim': 'TEXT'})
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_items_health ON items (type, health_next_check)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_items_sha256 ON items (sha256)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_items_url_key ON items (category, url_key)')
+            # Links stored before url_key existed
+            missing_keys = conn.execute("SELECT category, id, url FROM items WHERE type = 'external' AND url_key IS NULL").fetchall()
+            conn.executemany("UPDATE items SET url_key = ? WHERE category = ? AND type = 'external' AND id = ?",
+                             [(url_key(row['url']), row['category'], row['id']) for row in missing_keys])
+
+    def _bump_version(self, conn, category_name, dir_mtime_ns=None):
+        conn.execute('INSERT OR IGNORE INTO categories (name) VALUES (?)', (category_name,))
+        if dir_mtime_ns is None:
+            conn.execute('UPDATE categories SET version = version + 1 WHERE name = ?', (category_name,))
+        else:
+            conn.execute('UPDATE categories SET version = version + 1, dir_mtime_ns = ? WHERE name = ?',
+                         (dir_mtime_ns, category_name))
+
+    def _bump_version_after_write(self, conn, category_name, category_path, dir_mtime_before):
+        """
+        Bumps the version after the app itself changed a category directory. The directory's new
+        mtime is only recorded as synced if the catalog was in sync right before the write (its
+        stored mtime equals dir_mtime_before, stat'ed before touching the directory). Otherwise the
+        stored mtime stays stale, and the next read rescans the directory and picks up the files
+        the catalog has not seen yet, e.g. those of a library that was never scanned.
+        """
+        row = conn.execute('SELECT dir_mtime_ns FROM categories WHERE name = ?', (category_name,)).fetchone()
+        in_sync = row is not None and dir_mtime_before is not None and row['dir_mtime_ns'] == dir_mtime_before
+        self._bump_version(conn, category_name, _stat_mtime_ns(category_path) if in_sync else None)
+
+    def get_category_state(self, category_name):
+        """Returns (version, dir_mtime_ns) for a category, or None if it was never synced."""
+        row = self._connect().execute('SELECT version, dir_mtime_ns FROM categories WHERE name = ?',
+                                      (category_name,)).fetchone()
+        return (row['version'], row['dir_mtime_ns']) if row else None
+
+    # Local files
+
+    def sync_local_files(self, category_name, category_path, dir_mtime_ns):
+        """
+        Reconciles the local file rows of a category with its directory, e.g. after files
+        were dropped in or removed out-of-band. Only new files are stat'ed.
+        """
+        on_disk = set()
+        scan_started_at = time.perf_counter()
+        with os.scandir(category_path) as entries:
+            for entry in entries:
+                if allowed_file(entry.name) and entry.is_file():
+                    on_disk.add(entry.name)
+        fs_scan_seconds.observe(time.perf_counter() - scan_started_at, 'category')
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            known = {row['id'] for row in conn.execute("SELECT id FROM items WHERE category = ? AND type = 'local'", (category_name,))}
+            added_rows = []
+            for filename in on_disk - known:
+                try:
+                    file_stat = os.stat(os.path.join(category_path, filename))
+                except OSError:
+                    continue
+                added_rows.append((category_name, filename, filename, file_added_at(file_stat.st_mtime), file_stat.st_size))
+            conn.executemany("INSERT OR REPLACE INTO items (category, type, id, name, added_at, size) VALUES (?, 'local', ?, ?, ?, ?)", added_rows)
+            removed = known - on_disk
+            conn.executemany("DELETE FROM items WHERE category = ? AND type = 'local' AND id = ?",
+                             [(category_name, filename) for filename in removed])
+            self._bump_version(conn, category_name, dir_mtime_ns)
+        if added_rows or removed:
+            app.logger.info(f"Synced category {category_name}: {len(added_rows)} new, {len(removed)} removed local files")
+
+    def add_local_file(self, category_name, category_path, filename, dir_mtime_before, sha256=None, added_at=None):
+        """
+        Records a file the app just wrote into a category directory. dir_mtime_before is the
+        directory's mtime before the write, see _bump_version_after_write. added_at defaults to the file's mtime.
+        """
+        with self._connect() as conn:
+            self._insert_local_file(conn, category_name, category_path, filename, dir_mtime_before, sha256, added_at)
+
+    def add_local_file_deduplicated(self, category_name, category_path, filename, dir_mtime_before, sha256, resolve):
+        """
+        Looks up the local files with the same content hash and records the new file in one
+        write transaction, so two workers storing the same content at once cannot both miss
+        each other. resolve(candidates) gets the (category, filename) pairs with that hash,
+        acts on the new file and returns (keep, added_at, duplicate); the file is recorded
+        only if keep is true. Returns (keep, duplicate).
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            candidates = [(row['category'], row['id']) for row in conn.execute(
+                "SELECT category, id FROM items WHERE sha256 = ? AND type = 'local'", (sha256,))]
+            keep, added_at, duplicate = resolve(candidates)
+            if keep:
+                self._insert_local_file(conn, category_name, category_path, filename, dir_mtime_before, sha256, added_at)
+        return keep, duplicate
+
+    def _insert_local_file(self, conn, category_name, category_path, filename, dir_mtime_before, sha256, added_at):
+        file_stat = os.stat(os.path.join(category_path, filename))
+        conn.execute("INSERT OR REPLACE INTO items (category, type, id, name, added_at, size, sha256) VALUES (?, 'local', ?, ?, ?, ?, ?)",
+                     (category_name, filename, filename, added_at or file_added_at(file_stat.st_mtime), file_stat.st_size, sha256))
+        self._bump_version_after_write(conn, category_name, category_path, dir_mtime_before)
+
+    def find_local_files_by_sha256(self, sha256):
+        """Returns (category, filename) pairs of local files with the given content hash."""
+        return [(row['category'], row['id']) for row in self._connect().execute(
+            "SELECT category, id FROM items WHERE sha256 = ? AND type = 'local'", (sha256,))]
+
+    def get_local_file_sha256(self, category_name, filename):
+        row = self._connect().execute("SELECT sha256 FROM items WHERE category = ? AND type = 'local' AND id = ?",
+                                      (category_name, filename)).fetchone()
+        return row['sha256'] if row else None
+
+    def list_local_files_without_sha256(self, category_name):
+        return [row['id'] for row in self._connect().execute(
+            "SELECT id FROM items WHERE category = ? AND type = 'local' AND sha256 IS NULL ORDER BY id", (category_name,))]
+
+    def set_local_file_hashes(self, category_name, hashes):
+        """Stores content hashes computed after the fact, hashes maps filename -> SHA-256."""
+        with self._connect() as conn:
+            conn.executemany("UPDATE items SET sha256 = ? WHERE category = ? AND type = 'local' AND id = ?",
+                             [(sha256, category_name, filename) for filename, sha256 in hashes.items()])
+
+    def get_local_file_crcs(self, category_name):
+        """Returns {filename: (crc32, size, mtime_ns)} for the local files with a cached CRC-32."""
+        return {row['id']: (row['crc32'], row['crc_size'], row['crc_mtime_ns']) for row in self._connect().execute(
+            "SELECT id, crc32, crc_size, crc_mtime_ns FROM items WHERE category = ? AND type = 'local' AND crc32 IS NOT NULL",
+            (category_name,))}
+
+    def set_local_file_crcs(self, category_name, crcs):
+        """Caches CRC-32s given as (filename, crc32, size, mtime_ns) tuples."""
+        with self._connect() as conn:
+            conn.executemany("UPDATE items SET crc32 = ?, crc_size = ?, crc_mtime_ns = ? WHERE category = ? AND type = 'local' AND id = ?",
+                             [(crc, size, mtime_ns, category_name, filename) for filename, crc, size, mtime_ns in crcs])
+
+    def rename_local_file(self, category_name, category_path, old_filename, new_filename, dir_mtime_before):
+        with self._connect() as conn:
+            conn.execute("UPDATE items SET id = ?, name = ? WHERE category = ? AND type = 'local' AND id = ?",
+                         (new_filename, new_filename, category_name, old_filename))
+            self._bump_version_after_write(conn, category_name, category_path, dir_mtime_before)
+
+    def delete_local_files(self, category_name, category_path, filenames, dir_mtime_before):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM items WHERE category = ? AND type = 'local' AND id = ?",
+                             [(category_name, filename) for filename in filenames])
+            self._bump_version_after_write(conn, category_name, category_path, dir_mtime_before)
+
+    # External links
+
+    def get_external_link(self, category_name, link_id):
+        row = self._connect().execute("SELECT id, url, added_at FROM items WHERE category = ? AND type = 'external' AND id = ?",
+                                      (category_name, link_id)).fetchone()
+        return dict(row) if row else None
+
+    def get_external_link_by_id(self, link_id):
+        """Looks a link up by id alone (ids are unique across categories); the result includes its category."""
+        row = self._connect().execute("SELECT category, id, url, added_at FROM items WHERE id = ? AND type = 'external'",
+                                      (link_id,)).fetchone()
+        return dict(row) if row else None
+
+    def find_external_link_by_url(self, category_name, url):
+        """Finds a link whose URL normalizes to the same key as url."""
+        row = self._connect().execute("SELECT id, url, added_at FROM items WHERE category = ? AND type = 'external' AND url_key = ?",
+                                      (category_name, url_key(url))).fetchone()
+        return dict(row) if row else None
+
+    def existing_url_keys(self, category_name, keys):
+        """Returns the subset of normalized URL keys already present in a category."""
+        keys = list(keys)
+        found = set()
+        conn = self._connect()
+        for start in range(0, len(keys), 500): # stay below SQLite's bound parameter limit
+            chunk = keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            found.update(row['url_key'] for row in conn.execute(
+                f"SELECT url_key FROM items WHERE category = ? AND type = 'external' AND url_key IN ({placeholders})",
+                [category_name] + chunk))
+        return found
+
+    def add_external_links(self, category_name, links):
+        """Inserts links given as dicts with id, url and added_at."""
+        with self._connect() as conn:
+            conn.executemany("INSERT OR IGNORE INTO items (category, type, id, name, url, url_key, added_at) VALUES (?, 'external', ?, ?, ?, ?, ?)",
+                             [(category_name, link['id'], link['url'], link['url'], url_key(link['url']), link['added_at']) for link in links])
+            self._bump_version(conn, category_name)
+
+    def update_external_link_url(self, category_name, link_id, url):
+        with self._connect() as conn:
+            # A new URL has not been checked yet, whatever the old one's health was
+            updated = conn.execute("UPDATE items SET url = ?, name = ?, url_key = ?, health_status = NULL, health_detail = NULL, "
+                                   "health_failures = 0, health_checked_at = NULL, health_next_check = NULL "
+                                   "WHERE category = ? AND type = 'external' AND id = ?",
+                                   (url, url, url_key(url), category_name, link_id)).rowcount
+            if updated:
+                self._bump_version(conn, category_name)
+        return updated > 0
+
+    def delete_external_links(self, category_name, link_ids):
+        """Deletes links by id and returns the set of ids that existed."""
+        deleted_ids = set()
+        with self._connect() as conn:
+            for link_id in set(link_ids):
+                if conn.execute("DELETE FROM items WHERE category = ? AND type = 'external' AND id = ?",
+                                (category_name, link_id)).rowcount:
+                    deleted_ids.add(link_id)
+            if deleted_ids:
+                self._bump_version(conn, category_name)
+        return deleted_ids
+
+    # Link health
+
+    def claim_due_links(self, limit, lease_seconds, category_name=None):
+        """
+        Claims up to limit external links whose health check is due, never checked ones first,
+        and returns them as dicts with category, id and url. The claim moves their next check
+        lease_seconds ahead, so other workers skip them and a check that never finished is retried.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        lease_until = (now + datetime.timedelta(seconds=lease_seconds)).isoformat()
+        claim = secrets.token_hex(8)
+        category_filter = 'AND category = ?' if category_name is not None else ''
+        with self._connect() as conn:
+            # A single UPDATE, so two workers can never claim the same link
+            conn.execute(f"""UPDATE items SET health_claim = ?, health_next_check = ? WHERE rowid IN (
+                                SELECT rowid FROM items WHERE type = 'external' {category_filter}
+                                AND (health_next_check IS NULL OR health_next_check <= ?)
+                                ORDER BY health_next_check LIMIT ?)""",
+                         [claim, lease_until] + ([category_name] if category_name is not None else []) + [now.isoformat(), limit])
+        return [dict(row) for row in self._connect().execute(
+            "SELECT category, id, url FROM items WHERE type = 'external' AND health_claim = ?", (claim,))]
+
+    def record_link_health(self, category_name, link_id, url, healthy, detail, next_check, failure_threshold):
+        """
+        Stores a check result (healthy is None for an inconclusive one). A link is dead after
+        failure_threshold consecutive failures and ok again after one success; a change between the
+        two bumps the category version. Returns True if the link died or recovered.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with self._connect() as conn:
+            row = conn.execute("SELECT health_status, health_failures FROM items WHERE category = ? AND type = 'external' AND id = ? AND url = ?",
+                               (category_name, link_id, url)).fetchone()
+            if row is None:
+                return False # deleted, or its URL edited, while it was being checked
+            status, failures = row['health_status'], row['health_failures'] or 0
+            if healthy:
+                status, failures = 'ok', 0
+            elif healthy is not None:
+                failures += 1
+                if failures >= failure_threshold:
+                    status = 'dead'
+            conn.execute("UPDATE items SET health_status = ?, health_detail = ?, health_failures = ?, health_checked_at = ?, "
+                         "health_next_check = ?, health_claim = NULL WHERE category = ? AND type = 'external' AND id = ?",
+                         (status, detail, failures, now, next_check, category_name, link_id))
+            changed = (status == 'dead') != (row['health_status'] == 'dead')
+            if changed:
+                self._bump_version(conn, category_name)
+        return changed
+
+    def schedule_link_checks(self, category_name=None, link_id=None, include_dead=True):
+        """Makes the health checks of a category's links (or of one link) due now. Returns the number of links."""
+        conditions, params = ["type = 'external'"], []
+        if category_name is not None:
+            conditions.append('category = ?')
+            params.append(category_name)
+        if link_id is not None:
+            conditions.append('id = ?')
+            params.append(link_id)
+        if not include_dead:
+            conditions.append("health_status IS NOT 'dead'")
+        with self._connect() as conn:
+            return conn.execute(f"UPDATE items SET health_next_check = NULL WHERE {' AND '.join(conditions)}", params).rowcount
+
+    def list_dead_links(self, category_name=None):
+        """Dead links as dicts with category, id, url, health_detail and health_checked_at."""
+        columns = "SELECT category, id, url, health_detail, health_checked_at FROM items WHERE type = 'external' AND health_status = 'dead'"
+        if category_name is None:
+            rows = self._connect().execute(f'{columns} ORDER BY category, url')
+        else:
+            rows = self._connect().execute(f'{columns} AND category = ? ORDER BY url', (category_name,))
+        return [dict(row) for row in rows]
+
+    def count_dead_links(self, category_name):
+        return self._connect().execute("SELECT COUNT(*) FROM items WHERE category = ? AND type = 'external' AND health_status = 'dead'",
+                                       (category_name,)).fetchone()[0]
+
+    # Listing
+
+    def list_items_page(self, category_name, limit, offset=0, after=None, before=None):
+        """
+        Returns one page of a category, newest first (added_at, name, id descending).
+        after/before are (added_at, name, id) keys of the item the page continues from;
+        with neither the page starts at offset.
+        """
+        columns = ('SELECT type, id, name, url, added_at, health_status, health_detail, health_failures, health_checked_at '
+                   'FROM items WHERE category = ?')
+        if after is not None:
+            rows = self._connect().execute(f'{columns} AND (added_at, name, id) < (?, ?, ?) ORDER BY added_at DESC, name DESC, id DESC LIMIT ?',
+                                           (category_name, *after, limit)).fetchall()
+        elif before is not None:
+            rows = self._connect().execute(f'{columns} AND (added_at, name, id) > (?, ?, ?) ORDER BY added_at, name, id LIMIT ?',
+                                           (category_name, *before, limit)).fetchall()
+            rows.reverse()
+        else:
+            rows = self._connect().execute(f'{columns} ORDER BY added_at DESC, name DESC, id DESC LIMIT ? OFFSET ?',
+                                           (category_name, limit, offset)).fetchall()
+        return [dict(row) for row in rows]
+
+    def list_index_items(self, category_name):
+        """Returns (local filenames, external (id, url) pairs) in a stable order for the random index; dead links are left out."""
+        conn = self._connect()
+        local_files = [row['id'] for row in conn.execute("SELECT id FROM items WHERE category = ? AND type = 'local' ORDER BY id", (category_name,))]
+        external_links = [(row['id'], row['url']) for row in conn.execute(
+            "SELECT id, url FROM items WHERE category = ? AND type = 'external' AND health_status IS NOT 'dead' ORDER BY added_at, id", (category_name,))]
+        return local_files, external_links
+
+    def list_external_links(self, category_name):
+        """Returns the external links of a category as (id, url, added_at) in index order."""
+        return [(row['id'], row['url'], row['added_at']) for row in self._connect().execute(
+            "SELECT id, url, added_at FROM items WHERE category = ? AND type = 'external' ORDER BY added_at, id", (category_name,))]
+
+    # Categories
+
+    def rename_category(self, old_name, new_name):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM items WHERE category = ?', (new_name,))
+            conn.execute('DELETE FROM categories WHERE name = ?', (new_name,))
+            conn.execute('UPDATE items SET category = ? WHERE category = ?', (new_name, old_name))
+            conn.execute('UPDATE categories SET name = ? WHERE name = ?', (new_name, old_name))
+            self._bump_version(conn, new_name)
+
+    def delete_category(self, category_name):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM items WHERE category = ?', (category_name,))
+            conn.execute('DELETE FROM categories WHERE name = ?', (category_name,))
+
+    # Migration
+
+    def migrate_external_links_json(self, category_name):
+        """
+        One-time import of a category's legacy external_links.json. The file is renamed to
+        external_links.json.migrated afterwards so it is not imported again.
+        """
+        links_file_path = get_external_links_path(category_name)
+        if not os.path.exists(links_file_path):
+            return 0
+        links = [link for link in load_external_links(category_name) if link.get('id') and link.get('url')]
+        self.add_external_links(category_name, links)
+        try:
+            os.replace(links_file_path, links_file_path + '.migrated')
+        except OSError as e:
+            # Another worker may have migrated it at the same time, the inserts above are idempotent
+            app.logger.warning(f"Could not rename migrated {links_file_path}: {e}")
+        app.logger.info(f"Migrated {len(links)} external links of category {category_name} into the catalog.")
+        return len(links)
+
+    def migrate_all_external_links_json(self, emoticons_dir):
+        for category_name in os.listdir(emoticons_dir):
+            if os.path.isfile(get_external_links_path(category_name)):
+                try:
+                    self.migrate_external_links_json(category_name)
+                except (OSError, sqlite3.Error) as e:
+                    app.logger.error(f"Error migrating external links of category {category_name}: {e}")
+
+catalog = Catalog(app.config['CATALOG_PATH'])
+catalog.migrate_all_external_links_json(app.config['EMOTICONS_FOLDER'])
+
+def _stat_mtime_ns(path):
+    """Returns st_mtime_ns for path, or None if it does not exist."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
 
-    category_dir = os.path.dirname(links_file_path)
-    # Category directory should exist if the category itself exists.
-    if not os.path.exists(category_dir):
+def refresh_category_catalog(category_name):
+    """
+    Makes sure the catalog reflects a category directory, re-syncing local files when the
+    directory mtime moved. Returns the category version, or None if the category does not exist.
+    """
+    category_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name)
+    try:
+        dir_stat = os.stat(category_path)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(dir_stat.st_mode):
+        return None
+    state = catalog.get_category_state(category_name)
+    if state is None or state[1] != dir_stat.st_mtime_ns:
+        # A category copied in with a legacy links file gets migrated on first sight
+        catalog.migrate_external_links_json(category_name)
+        catalog.sync_local_files(category_name, category_path, dir_stat.st_mtime_ns)
+        state = catalog.get_category_state(category_name)
+    return state[0]
+
+# --- End Metadata Catalog ---
+
+# --- Category Item Index ---
+# Process-level cache of each category's items, so the public random endpoint
+# does not have to query every item of the category on every hit. The cached index
+# is reused while the catalog version of the category is unchanged; the catalog
+# itself picks up files dropped in out-of-band through the directory mtime check.
+
+class CategoryIndex:
+    """Array-backed snapshot of the items in one category."""
+    __slots__ = ('local_files', 'external_links', 'positions', 'version', 'dead_link_count')
+
+    def __init__(self, local_files, external_links, version, dead_link_count=0):
+        self.local_files = local_files # list of filenames
+        self.external_links = external_links # list of (id, url) tuples, dead links excluded
+        self.dead_link_count = dead_link_count # links of the category left out of external_links
+        # (type, id) -> position in the combined array, for O(1) last-shown lookups
+        self.positions = {('local', filename): position for position, filename in enumerate(local_files)}
+        offset = len(local_files)
+        for position, (link_id, _) in enumerate(external_links):
+            self.positions[('external', link_id)] = offset + position
+        self.version = version
+
+    def __len__(self):
+        return len(self.local_files) + len(self.external_links)
+
+    def item_at(self, position):
+        """Returns the item at a position in the combined local + external array."""
+        if position < len(self.local_files):
+            filename = self.local_files[position]
+            return {'id': filename, 'type': 'local', 'filename': filename}
+        link_id, link_url = self.external_links[position - len(self.local_files)]
+        return {'id': link_id, 'type': 'external', 'url': link_url}
+
+    def position_of(self, item_type, item_id):
+        """Returns the position of an item, or None if it is no longer in the category."""
+        return self.positions.get((item_type, item_id))
+
+def pick_random_position(size, excluded_position=None):
+    """
+    Picks a uniformly random position in range(size), skipping excluded_position.
+    Draws from size - 1 slots and shifts past the excluded one, so no list is built.
+    """
+    if excluded_position is None or size < 2:
+        return random.randrange(size)
+    position = random.randrange(size - 1)
+    if position >= excluded_position:
+        position += 1
+    return position
+
+# Shuffle bag: each client walks its own random permutation of a category's positions.
+# The permutation is a keyed Feistel network over [0, 4**half_bits), so the state is just
+# (seed, step, half_bits) however large the category is. Slots >= the category size are
+# skipped (cycle walking); the domain is less than 4x the size, so that costs a few hashes.
+# Items added mid-cycle are shown if their slot is still ahead, otherwise in the next cycle.
+# Removing items shifts later positions, which may let a few of them repeat in that cycle.
+ShuffleBag = collections.namedtuple('ShuffleBag', 'seed step half_bits')
+
+MASK64 = (1 << 64) - 1
+
+def _mix64(value):
+    """splitmix64 finalizer, a cheap well-mixed 64-bit hash."""
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+def feistel_permute(index, seed, half_bits, rounds=4):
+    """Maps index to its place in the seed's permutation of range(4 ** half_bits)."""
+    mask = (1 << half_bits) - 1
+    left, right = index >> half_bits, index & mask
+    for round_number in range(rounds):
+        round_key = _mix64((seed + round_number) & MASK64)
+        left, right = right, left ^ (_mix64(right ^ round_key) & mask)
+    return (left << half_bits) | right
+
+def new_shuffle_bag(size):
+    half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+    return ShuffleBag(random.getrandbits(64), 0, half_bits)
+
+def next_shuffle_position(bag, size, excluded_position=None):
+    """
+    Returns (position, bag): the client's next position in range(size) and its advanced bag.
+    A new cycle (new seed) starts when the bag is used up or no longer fits the category size.
+    A new cycle whose first item would be excluded_position (the item shown last) is reseeded,
+    so the same item is not shown twice in a row across cycles.
+    """
+    # A bag is only handed back after it yielded an item, so a cycle is fresh iff it starts here
+    fresh_cycle = bag is None or not (size <= 4 ** bag.half_bits < 16 * size)
+    if fresh_cycle:
+        bag = new_shuffle_bag(size)
+    while True:
+        if bag.step >= 4 ** bag.half_bits:
+            bag, fresh_cycle = new_shuffle_bag(size), True
+        position = feistel_permute(bag.step, bag.seed, bag.half_bits)
+        if position >= size:
+            bag = bag._replace(step=bag.step + 1)
+            continue
+        if fresh_cycle and position == excluded_position and size > 1:
+            bag = new_shuffle_bag(size)
+            continue
+        return position, bag._replace(step=bag.step + 1)
+
+def uses_shuffle_bag(category_name):
+    """Whether a random draw from this category walks the client's shuffle bag."""
+    mode = request.args.get('mode')
+    if mode in ('shuffle', 'random'):
+        return mode == 'shuffle'
+    shuffle_categories = {name.strip() for name in app.config['SHUFFLE_CATEGORIES'].split(',') if name.strip()}
+    return '*' in shuffle_categories or category_name in shuffle_categories
+
+category_index_cache = {}
+category_index_lock = threading.Lock()
+
+def get_category_index(category_name):
+    """
+    Returns the CategoryIndex for a category, or None if the category does not exist.
+    A cached index is reused as long as the category's catalog version is unchanged.
+    """
+    version = refresh_category_catalog(category_name)
+    if version is None:
+        invalidate_category_index(category_name)
+        return None
+
+    index = category_index_cache.get(category_name)
+    if index is not None and index.version == version:
+        return index
+
+    local_files, external_links = catalog.list_index_items(category_name)
+    index = CategoryIndex(local_files, external_links, version, catalog.count_dead_links(category_name))
+    category_index_builds.inc()
+    with category_index_lock:
+        category_index_cache[category_name] = index
+    app.logger.debug(f"Rebuilt index for category {category_name}: {len(index)} items")
+    return index
+
+def invalidate_category_index(category_name):
+    """Drops the cached index for a category so the next read rebuilds it."""
+    with category_index_lock:
+        category_index_cache.pop(category_name, None)
+
+# --- End Category Item Index ---
+
+# --- Client State ---
+# What the random endpoint remembers per client and category: (last shown (type, id), shuffle bag or None).
+# The session cookie only holds a short client token, so it stays the same size no
+# matter how many categories a client visits; the state itself is kept server side,
+# bounded to CLIENT_STATE_MAX_ENTRIES with the least recently used entries dropped.
+# The default SQLite store is shared by all Gunicorn workers, so a client's last shown
+# item and shuffle bag hold whichever worker serves the next request.
+
+class MemoryClientStateStore:
+    """Keeps client states in an LRU dict. Only usable with a single worker process."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict() # (client token, category) -> value, least recently used first
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, token, category_name):
+        key = (token, category_name)
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, token, category_name, value):
+        key = (token, category_name)
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete_category(self, category_name):
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == category_name]:
+                del self.entries[key]
+
+    def rename_category(self, old_name, new_name):
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == old_name]:
+                self.entries[(key[0], new_name)] = self.entries.pop(key)
+
+class SQLiteClientStateStore(SQLiteDatabase):
+    """Keeps client states in a local SQLite file shared by all worker processes."""
+
+    PRUNE_EVERY = 1000 # writes of a process between two trims down to max_entries
+
+    def __init__(self, path, max_entries):
+        super().__init__(path)
+        self.max_entries = max_entries
+        self.writes = itertools.count(1)
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS client_state (
+                                token TEXT NOT NULL,
+                                category TEXT NOT NULL,
+                                last_type TEXT NOT NULL,
+                                last_id TEXT NOT NULL,
+                                bag_seed TEXT,
+                                bag_step INTEGER,
+                                bag_half_bits INTEGER,
+                                used_at REAL NOT NULL,
+                                PRIMARY KEY (token, category)
+                            ) WITHOUT ROWID''')
+            self._ensure_columns(conn, 'client_state', {'bag_seed': 'TEXT', 'bag_step': 'INTEGER', 'bag_half_bits': 'INTEGER'})
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_client_state_used_at ON client_state (used_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_client_state_category ON client_state (category)')
+
+    def _connect(self):
+        conn = super()._connect()
+        if not getattr(self.local, 'tuned', False):
+            # Written on every random hit and cheap to lose, so skip the fsync of each commit
+            conn.execute('PRAGMA synchronous=OFF')
+            self.local.tuned = True
+        return conn
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM client_state').fetchone()[0]
+
+    def get(self, token, category_name):
+        row = self._connect().execute('SELECT * FROM client_state WHERE token = ? AND category = ?',
+                                      (token, category_name)).fetchone()
+        if row is None:
+            return None
+        bag = None
+        if row['bag_seed'] is not None:
+            # The 64-bit seed does not fit a signed SQLite integer, it is stored as text
+            bag = ShuffleBag(int(row['bag_seed']), row['bag_step'], row['bag_half_bits'])
+        return (row['last_type'], row['last_id']), bag
+
+    def set(self, token, category_name, value):
+        (last_type, last_id), bag = value
+        with self._connect() as conn:
+            conn.execute('''INSERT OR REPLACE INTO client_state
+                            (token, category, last_type, last_id, bag_seed, bag_step, bag_half_bits, used_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                         (token, category_name, last_type, last_id,
+                          str(bag.seed) if bag else None, bag.step if bag else None, bag.half_bits if bag else None,
+                          time.time()))
+        if next(self.writes) % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def delete_category(self, category_name):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM client_state WHERE category = ?', (category_name,))
+
+    def rename_category(self, old_name, new_name):
+        with self._connect() as conn:
+            conn.execute('UPDATE OR REPLACE client_state SET category = ? WHERE category = ?', (new_name, old_name))
+
+    def prune(self):
+        """Drops the least recently used states beyond max_entries."""
+        with self._connect() as conn:
+            conn.execute('''DELETE FROM client_state WHERE used_at <
+                                (SELECT used_at FROM client_state ORDER BY used_at DESC LIMIT 1 OFFSET ?)''',
+                         (self.max_entries - 1,))
+
+def create_client_state_store():
+    """Builds the client state store selected by the CLIENT_STATE_STORE setting."""
+    if app.config['CLIENT_STATE_STORE'] == 'memory':
+        return MemoryClientStateStore(app.config['CLIENT_STATE_MAX_ENTRIES'])
+    if app.config['CLIENT_STATE_STORE'] != 'sqlite':
+        app.logger.warning(f"Unknown CLIENT_STATE_STORE '{app.config['CLIENT_STATE_STORE']}', falling back to sqlite.")
+    return SQLiteClientStateStore(app.config['CLIENT_STATE_PATH'], app.config['CLIENT_STATE_MAX_ENTRIES'])
+
+client_state = create_client_state_store()
+
+def get_client_token():
+    """
+    Returns the client token sent back in the session cookie, or None.
+    A first visit only sets the token in the cookie and gets no state stored:
+    clients that never keep cookies (scripts, hotlinks) would otherwise leave
+    a new state behind on every request.
+    """
+    if 'last_shown_v2' in session:
+        session.pop('last_shown_v2') # state of older versions, kept in the cookie itself
+    token = session.get('client_token')
+    if token is None:
+        session['client_token'] = secrets.token_urlsafe(6)
+    return token
+
+# --- End Client State ---
+
+# --- Category List ---
+# Sorted category directory names shared by the index page, the admin page and the
+# category view dropdown. The category routes invalidate it; changes made outside the
+# app are picked up because they change the emoticons root's mtime.
+category_list_cache = None # (root mtime_ns, tuple of names), replaced as a whole
+
+def get_category_list():
+    """Returns the sorted category names. Raises OSError if the emoticons folder cannot be read."""
+    global category_list_cache
+    emoticons_dir = app.config['EMOTICONS_FOLDER']
+    # Stat before listing, a change made while scanning then shows up as a new mtime next time
+    mtime_ns = os.stat(emoticons_dir).st_mtime_ns
+    cached = category_list_cache
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+
+    scan_started_at = time.perf_counter()
+    with os.scandir(emoticons_dir) as entries:
+        names = tuple(sorted(entry.name for entry in entries if entry.is_dir())) # d_type, no stat per entry
+    fs_scan_seconds.observe(time.perf_counter() - scan_started_at, 'category_list')
+    category_list_cache = (mtime_ns, names)
+    return names
+
+def invalidate_category_list():
+    global category_list_cache
+    category_list_cache = None
+
+# --- End Category List ---
+
+# --- Thumbnails ---
+# WebP previews of local images for the admin grid, stored as
+# THUMBNAIL_FOLDER/<category>/<filename>.webp. A thumbnail older than its original
+# is stale. Rendering runs in a process pool (imaging.render_thumbnail); without
+# Pillow the admin grid keeps showing the originals.
+thumbnail_pool = None
+thumbnail_pool_lock = threading.Lock()
+pending_thumbnails = {} # (category, filename) -> Future of a render still under way
+pending_thumbnails_lock = threading.Lock()
+
+def get_thumbnail_pool():
+    global thumbnail_pool
+    with thumbnail_pool_lock:
+        if thumbnail_pool is None:
+            # 'spawn' workers do not inherit this process's threads, locks or SQLite connections
+            thumbnail_pool = concurrent.futures.ProcessPoolExecutor(max_workers=app.config['THUMBNAIL_WORKERS'],
+                                                                    mp_context=multiprocessing.get_context('spawn'))
+        return thumbnail_pool
+
+def reset_thumbnail_pool():
+    """Drops a broken pool (e.g. a worker was killed) so the next submit starts a new one."""
+    global thumbnail_pool
+    with thumbnail_pool_lock:
+        broken_pool, thumbnail_pool = thumbnail_pool, None
+    if broken_pool is not None:
+        broken_pool.shutdown(wait=False)
+
+def thumbnail_path(category_name, filename):
+    return os.path.join(app.config['THUMBNAIL_FOLDER'], category_name, filename + '.webp')
+
+def thumbnail_is_fresh(source_path, target_path):
+    try:
+        return os.stat(target_path).st_mtime_ns >= os.stat(source_path).st_mtime_ns
+    except OSError:
+        return False
+
+def schedule_thumbnail(category_name, filename):
+    """
+    Queues rendering of a local file's thumbnail, or returns the render already queued for it.
+    Returns the Future, or None if thumbnails are unavailable.
+    """
+    if not imaging.available():
+        return None
+    key = (category_name, filename)
+    source_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name, filename)
+    with pending_thumbnails_lock:
+        future = pending_thumbnails.get(key)
+        if future is not None:
+            return future
         try:
-            # This case should ideally not be hit if category management is correct
-            os.makedirs(category_dir)
-            app.logger.info(f"Created missing directory for external links: {category_dir}")
+            future = get_thumbnail_pool().submit(imaging.render_thumbnail, source_path,
+                                                 thumbnail_path(category_name, filename), app.config['THUMBNAIL_SIZE'])
+        except concurrent.futures.process.BrokenProcessPool as e:
+            app.logger.warning(f"Thumbnail pool broken, restarting it: {e}")
+            reset_thumbnail_pool()
+            return None
+        pending_thumbnails[key] = future
+    future.add_done_callback(lambda _: _forget_pending_thumbnail(key, future))
+    return future
+
+def _forget_pending_thumbnail(key, future):
+    with pending_thumbnails_lock:
+        if pending_thumbnails.get(key) is future:
+            del pending_thumbnails[key]
+
+def rename_thumbnail(category_name, old_filename, new_filename):
+    try:
+        os.replace(thumbnail_path(category_name, old_filename), thumbnail_path(category_name, new_filename))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        app.logger.warning(f"Could not rename thumbnail of {category_name}/{old_filename}: {e}")
+
+def remove_thumbnails(category_name, filenames):
+    for filename in filenames:
+        try:
+            os.remove(thumbnail_path(category_name, filename))
+        except FileNotFoundError:
+            pass
         except OSError as e:
-            app.logger.error(f"Error creating directory {category_dir} for external links: {e}")
-            return False
+            app.logger.warning(f"Could not remove thumbnail of {category_name}/{filename}: {e}")
 
+def rename_thumbnail_category(old_name, new_name):
+    old_dir = os.path.join(app.config['THUMBNAIL_FOLDER'], old_name)
+    new_dir = os.path.join(app.config['THUMBNAIL_FOLDER'], new_name)
+    shutil.rmtree(new_dir, ignore_errors=True) # leftovers of an earlier category with the new name
     try:
-        with open(links_file_path, 'w', encoding='utf-8') as f:
-            json.dump(links_data, f, ensure_ascii=False, indent=2)
-        return True
-    except IOError as e:
-        app.logger.error(f"Error saving external links for {category_name}: {e}")
+        os.rename(old_dir, new_dir)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        app.logger.warning(f"Could not move thumbnails of category {old_name} to {new_name}: {e}")
+
+def remove_thumbnail_category(category_name):
+    shutil.rmtree(os.path.join(app.config['THUMBNAIL_FOLDER'], category_name), ignore_errors=True)
+
+@app.cli.command('backfill-thumbnails')
+@click.option('--category', 'categories', multiple=True, help='Only these categories (repeatable). Default: all.')
+@click.option('--force', is_flag=True, help='Re-render thumbnails that are already up to date.')
+def backfill_thumbnails_command(categories, force):
+    """Renders missing or stale thumbnails for local images."""
+    if not imaging.available():
+        raise click.ClickException('Pillow is not installed, thumbnails are disabled.')
+    for category_name in categories or get_category_list():
+        if not is_valid_category_name(category_name) or refresh_category_catalog(category_name) is None:
+            click.echo(f'{category_name}: not found, skipped')
+            continue
+        category_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name)
+        local_files, _ = catalog.list_index_items(category_name)
+        futures = [schedule_thumbnail(category_name, filename) for filename in local_files
+                   if force or not thumbnail_is_fresh(os.path.join(category_path, filename), thumbnail_path(category_name, filename))]
+        rendered = failed = 0
+        for future in concurrent.futures.as_completed([future for future in futures if future is not None]):
+            if future.result():
+                rendered += 1
+            else:
+                failed += 1
+        click.echo(f'{category_name}: {rendered} rendered, {failed} failed, {len(local_files) - len(futures)} up to date')
+
+# --- End Thumbnails ---
+
+# --- Image Variants ---
+# WebP / AVIF re-encodings of local images, stored as VARIANT_FOLDER/<category>/<filename>.<format>
+# and rendered in the thumbnail process pool after uploads and imports (or on the first request
+# that could use one). Image responses pick the first IMAGE_VARIANTS format the client lists in
+# its Accept header and carry "Vary: Accept"; without a fresh variant the original is sent.
+# A variant that came out no smaller than its original, or could not be rendered, is stored
+# empty and never sent.
+VARIANT_MIMETYPES = {'webp': 'image/webp', 'avif': 'image/avif'}
+def enabled_variant_formats():
+    formats = []
+    for fmt in app.config['IMAGE_VARIANTS']:
+        if fmt not in VARIANT_MIMETYPES:
+            app.logger.warning(f"Unknown image variant format '{fmt}' in IMAGE_VARIANTS, ignored.")
+        elif fmt not in imaging.supported_variant_formats():
+            app.logger.warning(f"Pillow cannot encode {fmt} here, {fmt} variants are disabled.")
+        else:
+            formats.append(fmt)
+    return formats
+
+variant_formats = enabled_variant_formats()
+pending_variants = set() # (category, filename, format) queued in the pool, so requests do not queue them again
+pending_variants_lock = threading.Lock()
+
+def variant_path(category_name, filename, fmt):
+    return os.path.join(app.config['VARIANT_FOLDER'], category_name, f'{filename}.{fmt}')
+
+def variant_formats_for(filename):
+    """The enabled variant formats that differ from the file's own format."""
+    extension = filename.rsplit('.', 1)[-1].lower()
+    return [fmt for fmt in variant_formats if fmt != extension]
+
+def schedule_variant(category_name, filename, fmt):
+    """Queues rendering of one variant. Returns the Future, or None if it is already queued or the pool is broken."""
+    key = (category_name, filename, fmt)
+    with pending_variants_lock:
+        if key in pending_variants:
+            return None
+        pending_variants.add(key)
+    source_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name, filename)
+    try:
+        future = get_thumbnail_pool().submit(imaging.render_variant, source_path, variant_path(category_name, filename, fmt),
+                                             fmt, app.config['VARIANT_QUALITY'])
+    except concurrent.futures.process.BrokenProcessPool as e:
+        app.logger.warning(f"Thumbnail pool broken, restarting it: {e}")
+        reset_thumbnail_pool()
+        future = None
+    if future is None:
+        with pending_variants_lock:
+            pending_variants.discard(key)
+        return None
+    def forget(_):
+        with pending_variants_lock:
+            pending_variants.discard(key)
+    future.add_done_callback(forget)
+    return future
+
+def schedule_variants(category_name, filename):
+    """Queues every enabled variant of a local file, returns the Futures that were queued."""
+    futures = [schedule_variant(category_name, filename, fmt) for fmt in variant_formats_for(filename)]
+    return [future for future in futures if future is not None]
+
+def pick_variant(category_name, filename):
+    """
+    Returns (path, mimetype) of the preferred fresh variant the client accepts, or None.
+    Missing or stale variants of accepted formats are queued for the next request.
+    """
+    accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+    source_mtime_ns = None
+    for fmt in variant_formats_for(filename):
+        if VARIANT_MIMETYPES[fmt] not in accepted: # explicit listing only, */* does not mean AVIF is decodable
+            continue
+        if source_mtime_ns is None:
+            source_mtime_ns = _stat_mtime_ns(os.path.join(app.config['EMOTICONS_FOLDER'], category_name, filename))
+            if source_mtime_ns is None:
+                return None
+        target_path = variant_path(category_name, filename, fmt)
+        try:
+            target_stat = os.stat(target_path)
+        except OSError:
+            target_stat = None
+        if target_stat is None or target_stat.st_mtime_ns < source_mtime_ns:
+            schedule_variant(category_name, filename, fmt)
+        elif target_stat.st_size:
+            return target_path, VARIANT_MIMETYPES[fmt]
+    return None
+
+def send_local_image(category_name, filename):
+    """send_local_file for a local image, or its best accepted variant."""
+    variant = pick_variant(category_name, filename) if variant_formats else None
+    if variant is None:
+        response = send_local_file(os.path.join(app.config['EMOTICONS_FOLDER'], category_name), filename)
+    else:
+        target_path, mimetype = variant
+        response = send_file(target_path, mimetype=mimetype)
+    if variant_formats:
+        response.vary.add('Accept')
+    return response
+
+def rename_variants(category_name, old_filename, new_filename):
+    for fmt in VARIANT_MIMETYPES:
+        try:
+            os.replace(variant_path(category_name, old_filename, fmt), variant_path(category_name, new_filename, fmt))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            app.logger.warning(f"Could not rename {fmt} variant of {category_name}/{old_filename}: {e}")
+
+def remove_variants(category_name, filenames):
+    for filename in filenames:
+        for fmt in VARIANT_MIMETYPES:
+            try:
+                os.remove(variant_path(category_name, filename, fmt))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                app.logger.warning(f"Could not remove {fmt} variant of {category_name}/{filename}: {e}")
+
+def rename_variant_category(old_name, new_name):
+    old_dir = os.path.join(app.config['VARIANT_FOLDER'], old_name)
+    new_dir = os.path.join(app.config['VARIANT_FOLDER'], new_name)
+    shutil.rmtree(new_dir, ignore_errors=True)
+    try:
+        os.rename(old_dir, new_dir)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        app.logger.warning(f"Could not move variants of category {old_name} to {new_name}: {e}")
+
+def remove_variant_category(category_name):
+    shutil.rmtree(os.path.join(app.config['VARIANT_FOLDER'], category_name), ignore_errors=True)
+
+@app.cli.command('backfill-variants')
+@click.option('--category', 'categories', multiple=True, help='Only these categories (repeatable). Default: all.')
+def backfill_variants_command(categories):
+    """Renders missing or stale WebP/AVIF variants of local images."""
+    if not variant_formats:
+        raise click.ClickException('No image variant format is enabled (IMAGE_VARIANTS, Pillow).')
+    for category_name in categories or get_category_list():
+        if not is_valid_category_name(category_name) or refresh_category_catalog(category_name) is None:
+            click.echo(f'{category_name}: not found, skipped')
+            continue
+        category_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name)
+        local_files, _ = catalog.list_index_items(category_name)
+        futures = [schedule_variant(category_name, filename, fmt) for filename in local_files for fmt in variant_formats_for(filename)
+                   if not thumbnail_is_fresh(os.path.join(category_path, filename), variant_path(category_name, filename, fmt))]
+        rendered = kept_original = failed = 0
+        for future in concurrent.futures.as_completed([future for future in futures if future is not None]):
+            size = future.result()
+            if size is None:
+                failed += 1
+            elif size:
+                rendered += 1
+            else:
+                kept_original += 1
+        click.echo(f'{category_name}: {rendered} rendered, {kept_original} not smaller than the original, {failed} failed')
+
+# --- End Image Variants ---
+
+# --- Content Deduplication ---
+# Uploads and URL imports hash the bytes while writing them to disk, then look the
+# SHA-256 up in the catalog. What happens to a duplicate depends on DEDUP_MODE. The
+# lookup and the insert of the new file share one catalog write transaction, so
+# concurrent imports in different worker processes cannot both keep the same content.
+DEDUP_MODES = ('link', 'reject', 'off')
+if app.config['DEDUP_MODE'] not in DEDUP_MODES:
+    app.logger.warning(f"Unknown DEDUP_MODE '{app.config['DEDUP_MODE']}', falling back to link.")
+    app.config['DEDUP_MODE'] = 'link'
+
+def copy_stream_hashed(read_chunk, file_obj):
+    """Copies chunks returned by read_chunk() into file_obj until it returns b''. Returns the SHA-256 hex digest."""
+    hasher = hashlib.sha256()
+    for chunk in iter(read_chunk, b''):
+        hasher.update(chunk)
+        file_obj.write(chunk)
+    return hasher.hexdigest()
+
+def find_duplicate(category_name, filename, candidates):
+    """
+    Returns (category, filename) of another stored file among the candidates (catalog entries
+    with the same content hash), same category first, or None.
+    """
+    for candidate_category, candidate_filename in sorted(candidates, key=lambda candidate: candidate[0] != category_name):
+        if (candidate_category, candidate_filename) == (category_name, filename):
+            continue
+        # The catalog may lag behind files removed outside the app
+        if os.path.isfile(os.path.join(app.config['EMOTICONS_FOLDER'], candidate_category, candidate_filename)):
+            return candidate_category, candidate_filename
+    return None
+
+def store_deduplicated(category_name, filename, sha256, dir_mtime_before):
+    """
+    Applies DEDUP_MODE to a file just written into a category and records it in the catalog.
+    dir_mtime_before is the category directory's mtime from before the file was created.
+    Returns (kept, duplicate_of): kept is False if the new file was removed as a duplicate,
+    duplicate_of is {'category', 'filename'} of the existing copy, or None.
+    """
+    category_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name)
+    save_path = os.path.join(category_path, filename)
+    if app.config['DEDUP_MODE'] == 'off':
+        catalog.add_local_file(category_name, category_path, filename, dir_mtime_before, sha256=sha256)
+        return True, None
+
+    def resolve(candidates):
+        # Runs inside the catalog write transaction, which serializes it across workers
+        duplicate = find_duplicate(category_name, filename, candidates)
+        if duplicate is None:
+            return True, None, None
+        if app.config['DEDUP_MODE'] == 'reject' or duplicate[0] == category_name:
+            os.remove(save_path)
+            return False, None, duplicate
+
+        # 'link': swap the fresh copy for a hard link to the existing file
+        link_path = f'{save_path}.link'
+        try:
+            os.link(os.path.join(app.config['EMOTICONS_FOLDER'], *duplicate), link_path)
+            os.replace(link_path, save_path)
+        except OSError as e: # e.g. another filesystem, keep the copy
+            app.logger.warning(f"Could not hard link {category_name}/{filename} to {duplicate[0]}/{duplicate[1]}: {e}")
+            _remove_partial_download(link_path)
+        # A hard link shares the original's mtime, list the new entry as added now
+        return True, datetime.datetime.now(datetime.timezone.utc).isoformat(), duplicate
+
+    kept, duplicate = catalog.add_local_file_deduplicated(category_name, category_path, filename, dir_mtime_before,
+                                                          sha256, resolve)
+    return kept, ({'category': duplicate[0], 'filename': duplicate[1]} if duplicate else None)
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, 1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+@app.cli.command('backfill-hashes')
+@click.option('--category', 'categories', multiple=True, help='Only these categories (repeatable). Default: all.')
+def backfill_hashes_command(categories):
+    """Computes content hashes of local files added outside the app, so new uploads are checked against them."""
+    for category_name in categories or get_category_list():
+        if not is_valid_category_name(category_name) or refresh_category_catalog(category_name) is None:
+            click.echo(f'{category_name}: not found, skipped')
+            continue
+        category_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name)
+        hashes = {}
+        for filename in catalog.list_local_files_without_sha256(category_name):
+            try:
+                hashes[filename] = hash_file(os.path.join(category_path, filename))
+            except OSError as e:
+                click.echo(f'{category_name}/{filename}: {e}')
+        catalog.set_local_file_hashes(category_name, hashes)
+        click.echo(f'{category_name}: {len(hashes)} hashed')
+
+# --- End Content Deduplication ---
+
+# --- Local File Offload ---
+FILE_OFFLOAD_MODES = ('', 'sendfile', 'nginx')
+if app.config['FILE_OFFLOAD'] not in FILE_OFFLOAD_MODES:
+    app.logger.warning(f"Unknown FILE_OFFLOAD '{app.config['FILE_OFFLOAD']}', sending files directly.")
+    app.config['FILE_OFFLOAD'] = ''
+
+def send_local_file(directory, filename, **kwargs):
+    """
+    send_from_directory for files under EMOTICONS_FOLDER that honours FILE_OFFLOAD.
+    When offloading, the response carries only headers (type, length, ETag, caching)
+    and the front server sends the bytes, so the worker is free right away.
+    """
+    if not app.config['FILE_OFFLOAD']:
+        return send_from_directory(directory, filename, **kwargs)
+
+    # Same as Flask's send_from_directory, but with X-Sendfile for this call only,
+    # thumbnails, image variants and the proxy cache under DATA_FOLDER are still sent directly.
+    # Conditional requests are answered here (304); Range requests are left to the front server.
+    environ = {key: value for key, value in request.environ.items() if key not in ('HTTP_RANGE', 'HTTP_IF_RANGE')}
+    kwargs.setdefault('max_age', app.get_send_file_max_age)
+    response = werkzeug.utils.send_from_directory(os.path.join(app.root_path, directory), filename, environ,
+                                                  use_x_sendfile=True, response_class=app.response_class, **kwargs)
+    file_path = response.headers.get('X-Sendfile')
+    if file_path is None: # 304 Not Modified
+        return response
+    del response.headers['Content-Length'] # the body here is empty, the front server sets the real length
+    if app.config['FILE_OFFLOAD'] == 'nginx':
+        del response.headers['X-Sendfile']
+        relative_path = os.path.relpath(file_path, os.path.join(app.root_path, app.config['EMOTICONS_FOLDER']))
+        response.headers['X-Accel-Redirect'] = app.config['FILE_OFFLOAD_PREFIX'].rstrip('/') + '/' + quote(relative_path.replace(os.sep, '/'))
+    else:
+        # WSGI headers are latin-1 strings, pass a non-ASCII path through as its raw UTF-8 bytes
+        response.headers['X-Sendfile'] = file_path.encode('utf-8').decode('latin-1')
+    return response
+
+# --- End Local File Offload ---
+
+# --- Proxy Content Cache ---
+# Disk-backed LRU cache for the bytes of proxied external images, keyed by link id.
+# Each entry is a <key>.bin body file. Its metadata (origin URL, Content-Type, ETag /
+# Last-Modified validators, fetch time, size and last use) lives in an SQLite index
+# next to the bodies, so every Gunicorn worker shares one size cap, one LRU order and
+# one set of counters.
+
+class ProxyCache(SQLiteDatabase):
+    """Size-capped LRU cache of proxied external images with TTL and revalidation."""
+
+    STAT_NAMES = ('hits', 'misses', 'revalidated', 'stores', 'evictions')
+    USED_AT_RESOLUTION = 60 # seconds; a hit only rewrites an entry's last use once it is older than this
+    STATS_FLUSH_INTERVAL = 5 # seconds between writes of the hit/miss counters to the index
+
+    def __init__(self, cache_dir, max_bytes, max_item_bytes, ttl, temp_max_age):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.ttl = ttl
+        self.temp_max_age = temp_max_age
+        super().__init__(os.path.join(self.cache_dir, 'index.sqlite3'))
+        self.lock = threading.Lock()
+        self.pending_stats = dict.fromkeys(self.STAT_NAMES, 0) # counted by this process, not yet written
+        self.stats_flushed_at = time.monotonic()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS entries (
+                                key TEXT PRIMARY KEY,
+                                link_id TEXT NOT NULL,
+                                url TEXT NOT NULL,
+                                content_type TEXT,
+                                etag TEXT,
+                                last_modified TEXT,
+                                fetched_at REAL NOT NULL,
+                                size INTEGER NOT NULL,
+                                used_at REAL NOT NULL
+                            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_entries_used_at ON entries (used_at)')
+            conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0)')
+            conn.executemany('INSERT OR IGNORE INTO stats (name) VALUES (?)', [(name,) for name in self.STAT_NAMES])
+        self._remove_stale_temp_files()
+
+    def _key(self, link_id):
+        return hashlib.sha256(link_id.encode('utf-8')).hexdigest()
+
+    def data_path(self, link_id):
+        return os.path.join(self.cache_dir, self._key(link_id) + '.bin')
+
+    def _remove_stale_temp_files(self):
+        """
+        Removes temp files left behind by interrupted downloads. A download in progress in
+        another worker writes to its temp file at least once per read timeout, so only files
+        untouched for longer than temp_max_age are treated as abandoned.
+        """
+        stale_before = time.time() - self.temp_max_age
+        try:
+            with os.scandir(self.cache_dir) as dir_entries:
+                for entry in dir_entries:
+                    if not entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        if entry.stat().st_mtime < stale_before:
+                            os.remove(entry.path)
+                    except OSError:
+                        pass
+        except OSError as e:
+            app.logger.error(f"Error reading proxy cache directory {self.cache_dir}: {e}")
+
+    def lookup(self, link_id, url):
+        """Returns the cached metadata for a link, or None if missing or cached for another URL."""
+        key = self._key(link_id)
+        row = self._connect().execute('SELECT * FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None or row['url'] != url or not os.path.isfile(self.data_path(link_id)):
+            return None
+        now = time.time()
+        if now - row['used_at'] >= self.USED_AT_RESOLUTION:
+            # Eviction only needs a coarse recency, so most hits stay read-only
+            with self._connect() as conn:
+                conn.execute('UPDATE entries SET used_at = ? WHERE key = ?', (now, key))
+        return dict(row)
+
+    def is_fresh(self, meta):
+        return time.time() - meta.get('fetched_at', 0) < self.ttl
+
+    def conditional_headers(self, meta):
+        """Builds If-None-Match / If-Modified-Since headers from the stored validators."""
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def mark_revalidated(self, link_id, meta, response_headers):
+        """Extends an entry's lifetime after the origin answered 304 Not Modified."""
+        now = time.time()
+        meta = dict(meta, fetched_at=now, used_at=now)
+        if response_headers.get('ETag'):
+            meta['etag'] = response_headers['ETag']
+        if response_headers.get('Last-Modified'):
+            meta['last_modified'] = response_headers['Last-Modified']
+        try:
+            with self._connect() as conn:
+                conn.execute('UPDATE entries SET etag = ?, last_modified = ?, fetched_at = ?, used_at = ? WHERE key = ?',
+                             (meta.get('etag'), meta.get('last_modified'), now, now, self._key(link_id)))
+        except sqlite3.Error as e:
+            app.logger.warning(f"Could not update proxy cache metadata for link {link_id}: {e}")
+        return meta
+
+    def record(self, stat_name):
+        """Counts a lookup outcome; counters are written to the index every few seconds."""
+        with self.lock:
+            self.pending_stats[stat_name] += 1
+            flush_due = time.monotonic() - self.stats_flushed_at >= self.STATS_FLUSH_INTERVAL
+        if flush_due:
+            self._flush_stats()
+
+    def _flush_stats(self):
+        with self.lock:
+            pending = [(count, name) for name, count in self.pending_stats.items() if count]
+            self.pending_stats = dict.fromkeys(self.STAT_NAMES, 0)
+            self.stats_flushed_at = time.monotonic()
+        if not pending:
+            return
+        try:
+            with self._connect() as conn:
+                conn.executemany('UPDATE stats SET count = count + ? WHERE name = ?', pending)
+        except sqlite3.Error as e:
+            app.logger.warning(f"Could not write proxy cache counters: {e}")
+
+    def stream_and_store(self, link_id, url, response):
+        """
+        Yields the origin response body to the client while writing it to the cache.
+        The entry is only committed once the whole body arrived and fits max_item_bytes.
+        """
+        writer = ProxyCacheWriter(self, link_id, url)
+        completed = False
+        try:
+            for chunk in response.iter_content(chunk_size=8192):
+                if not chunk:
+                    continue
+                writer.write(chunk)
+                yield chunk
+            completed = True
+        finally:
+            response.close()
+            if completed:
+                writer.commit(response.headers)
+            else:
+                writer.discard()
+
+    def _commit(self, link_id, url, response_headers, tmp_path, size):
+        key = self._key(link_id)
+        now = time.time()
+        try:
+            conn = self._connect()
+            with conn:
+                # The write lock serializes stores and evictions of all workers against one size cap
+                conn.execute('BEGIN IMMEDIATE')
+                os.replace(tmp_path, self.data_path(link_id))
+                conn.execute('''INSERT OR REPLACE INTO entries
+                                    (key, link_id, url, content_type, etag, last_modified, fetched_at, size, used_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                             (key, link_id, url, response_headers.get('Content-Type'), response_headers.get('ETag'),
+                              response_headers.get('Last-Modified'), now, size, now))
+                evicted = self._evict(conn)
+                conn.execute("UPDATE stats SET count = count + 1 WHERE name = 'stores'")
+                conn.execute("UPDATE stats SET count = count + ? WHERE name = 'evictions'", (evicted,))
+        except (OSError, sqlite3.Error) as e:
+            app.logger.warning(f"Could not store proxy cache entry for link {link_id}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _evict(self, conn):
+        """Removes least recently used entries until the cache fits max_bytes. Returns how many were removed."""
+        total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return 0
+        evicted = 0
+        for row in conn.execute('SELECT key, size FROM entries ORDER BY used_at').fetchall():
+            if total_bytes <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM entries WHERE key = ?', (row['key'],))
+            self._remove_body(row['key'])
+            total_bytes -= row['size']
+            evicted += 1
+        return evicted
+
+    def _remove_body(self, key):
+        try:
+            os.remove(os.path.join(self.cache_dir, key + '.bin'))
+        except OSError:
+            pass
+
+    def remove(self, link_id):
+        """Drops a link's entry, e.g. after the link was edited or deleted."""
+        key = self._key(link_id)
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self._remove_body(key)
+
+    def snapshot(self):
+        """Returns counters and usage figures for operators, across all worker processes."""
+        self._flush_stats()
+        conn = self._connect()
+        stats = {row['name']: row['count'] for row in conn.execute('SELECT name, count FROM stats')}
+        usage = conn.execute('SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS total_bytes FROM entries').fetchone()
+        lookups = stats['hits'] + stats['revalidated'] + stats['misses']
+        return dict(stats,
+                    entries=usage['entries'],
+                    total_bytes=usage['total_bytes'],
+                    max_bytes=self.max_bytes,
+                    ttl=self.ttl,
+                    hit_ratio=round((stats['hits'] + stats['revalidated']) / lookups, 4) if lookups else None)
+
+class ProxyCacheWriter:
+    """Copies an origin body into a temp file as it is relayed; commit() turns it into a cache entry."""
+
+    def __init__(self, cache, link_id, url):
+        self.cache = cache
+        self.link_id = link_id
+        self.url = url
+        self.tmp_path = os.path.join(cache.cache_dir, f"{cache._key(link_id)}.{uuid.uuid4().hex}.tmp")
+        self.size = 0
+        try:
+            self.tmp_file = open(self.tmp_path, 'wb')
+        except OSError as e:
+            app.logger.warning(f"Could not open proxy cache file for link {link_id}: {e}")
+            self.tmp_file = None
+
+    def write(self, chunk):
+        if self.tmp_file is None:
+            return
+        self.size += len(chunk)
+        if self.size > self.cache.max_item_bytes:
+            self.discard() # too big to cache, keep relaying without a copy
+        else:
+            self.tmp_file.write(chunk)
+
+    def commit(self, response_headers):
+        if self.tmp_file is not None:
+            self.tmp_file.close()
+            self.tmp_file = None
+            self.cache._commit(self.link_id, self.url, response_headers, self.tmp_path, self.size)
+
+    def discard(self):
+        if self.tmp_file is not None:
+            self.tmp_file.close()
+            self.tmp_file = None
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+
+proxy_cache = ProxyCache(os.path.join(app.config['DATA_FOLDER'], 'proxy_cache'),
+                         app.config['PROXY_CACHE_MAX_BYTES'],
+                         app.config['PROXY_CACHE_MAX_ITEM_BYTES'],
+                         app.config['PROXY_CACHE_TTL'],
+                         app.config['HTTP_READ_TIMEOUT'])
+
+# --- End Proxy Content Cache ---
+
+# --- Link Health ---
+# A background thread checks every external link once per LINK_CHECK_INTERVAL: a
+# conditional GET when the proxy cache holds a copy (an unchanged image costs a 304),
+# otherwise HEAD, confirmed with a GET when HEAD fails since some hosts refuse it. After
+# LINK_CHECK_FAILURES failed checks in a row a link is dead and left out of the random
+# index, so the random endpoint stops spending a timeout on it; one successful check
+# brings it back. Due links are claimed in the catalog, so with several workers each
+# link is still checked once. A proxy fetch that fails makes the link due right away.
+
+LINK_CHECK_BATCH = 100 # links claimed per round
+LINK_CHECK_LEASE = 600 # seconds before a claimed link whose check never finished is claimed again
+LINK_CHECK_RETRY = 600 # seconds before a failed, not yet dead link is checked again
+LINK_CHECK_IDLE = 60 # seconds the checker sleeps when no link is due
+
+def check_link(link_id, url):
+    """
+    Checks one external link without reading its body. Returns (healthy, detail): healthy is
+    None when the answer says nothing about the link (rate limited), detail is shown in the admin view.
+    """
+    timeout = (app.config['HTTP_CONNECT_TIMEOUT'], app.config['LINK_CHECK_TIMEOUT'])
+    headers = {'Referer': ''} # same as the proxy, some hosts reject foreign referrers
+    cached_meta = proxy_cache.lookup(link_id, url)
+    try:
+        if cached_meta is not None:
+            response = http_get(url, headers=dict(headers, **proxy_cache.conditional_headers(cached_meta)), stream=True, timeout=timeout)
+        else:
+            response = http_request('HEAD', url, headers=headers, timeout=timeout)
+            if response.status_code >= 400:
+                response.close()
+                response = http_get(url, headers=headers, stream=True, timeout=timeout)
+        response.close()
+    except requests.exceptions.Timeout:
+        return False, '请求超时'
+    except requests.exceptions.RequestException as e:
+        return False, f'连接失败: {type(e).__name__}'
+
+    if response.status_code == 304:
+        return True, 'HTTP 304'
+    if response.status_code == 429:
+        return None, 'HTTP 429'
+    if response.status_code >= 400:
+        return False, f'HTTP {response.status_code}'
+    content_type = (response.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+    if content_type and not content_type.startswith('image/'):
+        return False, f'不是图片 ({content_type})'
+    return True, f'HTTP {response.status_code}'
+
+def run_link_checks(executor, limit, category_name=None):
+    """Claims up to limit due links, checks them on executor and records the results. Returns the number checked."""
+    links = catalog.claim_due_links(limit, LINK_CHECK_LEASE, category_name)
+    interval = app.config['LINK_CHECK_INTERVAL'] or 24 * 3600 # check-links also runs with the background checker off
+    futures = {executor.submit(check_link, link['id'], link['url']): link for link in links}
+    for future in concurrent.futures.as_completed(futures):
+        link = futures[future]
+        healthy, detail = future.result()
+        link_checks.inc({True: 'healthy', False: 'failed', None: 'inconclusive'}[healthy])
+        next_check = time.time() + (interval if healthy is not False else min(LINK_CHECK_RETRY, interval))
+        next_check_at = datetime.datetime.fromtimestamp(next_check, datetime.timezone.utc).isoformat()
+        changed = catalog.record_link_health(link['category'], link['id'], link['url'], healthy, detail, next_check_at,
+                                             app.config['LINK_CHECK_FAILURES'])
+        if changed:
+            invalidate_category_index(link['category'])
+            app.logger.info(f"External link {link['id']} of category {link['category']} is now "
+                            f"{'healthy' if healthy else 'dead'} ({detail}): {link['url']}")
+    return len(links)
+
+class LinkHealthChecker:
+    """The background thread, started with the first request of a worker when LINK_CHECK_INTERVAL is set."""
+
+    def __init__(self):
+        self.started = False
+        self.lock = threading.Lock()
+
+    def ensure_started(self):
+        if self.started or app.config['LINK_CHECK_INTERVAL'] <= 0:
+            return
+        with self.lock:
+            if not self.started:
+                self.started = True
+                threading.Thread(target=self._run, name='link-health', daemon=True).start()
+
+    def _run(self):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.config['LINK_CHECK_CONCURRENCY'],
+                                                         thread_name_prefix='link-check')
+        while True:
+            try:
+                checked = run_link_checks(executor, LINK_CHECK_BATCH)
+            except sqlite3.Error as e:
+                app.logger.error(f"Link health check round failed: {e}")
+                checked = 0
+            if not checked:
+                time.sleep(LINK_CHECK_IDLE)
+
+link_health_checker = LinkHealthChecker()
+
+@app.before_request
+def start_link_health_checker():
+    link_health_checker.ensure_started()
+
+def request_link_check(link_id):
+    """Makes a link that just failed to proxy due for a check, unless it is already known to be dead."""
+    if app.config['LINK_CHECK_INTERVAL'] <= 0:
+        return
+    try:
+        catalog.schedule_link_checks(link_id=link_id, include_dead=False)
+    except sqlite3.Error as e:
+        app.logger.warning(f"Could not schedule a health check of link {link_id}: {e}")
+
+@app.cli.command('check-links')
+@click.option('--category', 'categories', multiple=True, help='Only these categories (repeatable). Default: all.')
+def check_links_command(categories):
+    """Checks external links now and prints the ones that are dead."""
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.config['LINK_CHECK_CONCURRENCY'])
+    for category_name in categories or [None]:
+        catalog.schedule_link_checks(category_name)
+        checked = 0
+        while True:
+            claimed = run_link_checks(executor, LINK_CHECK_BATCH, category_name)
+            if not claimed:
+                break
+            checked += claimed
+            click.echo(f'{category_name or "all categories"}: {checked} checked')
+        for link in catalog.list_dead_links(category_name):
+            click.echo(f"dead  {link['category']}  {link['url']}  ({link['health_detail']})")
+
+# --- End Link Health ---
+
+# --- URL Import Engine ---
+# Downloads for URL import tasks run on a shared pool of worker threads. A job is
+# only started when its host is below IMPORT_MAX_PER_HOST running downloads, so a
+# batch dominated by one slow host does not hold up URLs on other hosts.
+
+class ImportEngine:
+    """Runs import jobs with a global concurrency cap and a per-host cap."""
+
+    def __init__(self, max_workers, max_per_host):
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.host_queues = collections.OrderedDict() # host -> deque of pending jobs
+        self.host_active = collections.Counter()
+        self.condition = threading.Condition()
+        self.worker_count = 0
+
+    def submit(self, url, job):
+        """Queues job (a callable) to run once a worker and a slot for url's host are free."""
+        host = (urlparse(url).hostname or '').lower()
+        with self.condition:
+            self.host_queues.setdefault(host, collections.deque()).append(job)
+            if self.worker_count < self.max_workers:
+                self.worker_count += 1
+                threading.Thread(target=self._work, name='url-import', daemon=True).start()
+            self.condition.notify()
+
+    def _next_job(self):
+        """Pops the first pending job whose host has a free slot. Caller holds the condition."""
+        for host, jobs in self.host_queues.items():
+            if self.host_active[host] < self.max_per_host:
+                job = jobs.popleft()
+                if not jobs:
+                    del self.host_queues[host]
+                else:
+                    # Rotate the host to the back so hosts take turns
+                    self.host_queues.move_to_end(host)
+                self.host_active[host] += 1
+                return host, job
+        return None, None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                host, job = self._next_job()
+                while job is None:
+                    if not self.host_queues:
+                        # Idle workers exit, submit() starts new ones on demand
+                        self.worker_count -= 1
+                        return
+                    self.condition.wait()
+                    host, job = self._next_job()
+            try:
+                job()
+            except Exception as e:
+                app.logger.error(f"Unhandled error in URL import job for host {host}: {e}", exc_info=True)
+            finally:
+                with self.condition:
+                    self.host_active[host] -= 1
+                    if not self.host_active[host]:
+                        del self.host_active[host]
+                    self.condition.notify_all()
+
+import_engine = ImportEngine(app.config['IMPORT_MAX_WORKERS'], app.config['IMPORT_MAX_PER_HOST'])
+
+def import_url_item(task_id, index, image_url, category_name, emit):
+    """
+    Downloads one URL of an import task into the category, retrying on network errors.
+    Progress is reported through emit(event_name, payload); an 'item_done' event is always sent last.
+    """
+    progress_item_id = f"task-{task_id}-item-{index}"
+    success = False
+    try:
+        success = _download_url_item(task_id, progress_item_id, image_url, category_name, emit)
+    finally:
+        emit('item_done', {'id': progress_item_id, 'success': success})
+
+def _download_url_item(task_id, progress_item_id, image_url, category_name, emit):
+    category_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name)
+    app.logger.info(f"[Task {task_id} - Item {progress_item_id}] 处理 URL: {image_url}")
+    emit('progress', {'id': progress_item_id, 'url': image_url, 'status': '准备中', 'progress': 0})
+
+    MAX_RETRIES = 3
+
+    last_exception_message = "未知错误"
+    downloaded = None # (filename, sha256, directory mtime before the write) once an attempt got the whole file
+    for attempt in range(MAX_RETRIES):
+        save_path = None
+        try:
+            app.logger.info(f"[Task {task_id} - Item {progress_item_id}] Attempt {attempt + 1}/{MAX_RETRIES} for URL: {image_url}")
+
+            parsed_url = urlparse(image_url)
+            if not all([parsed_url.scheme, parsed_url.netloc]) or parsed_url.scheme not in ('http', 'https'):
+                raise ValueError("无效的 URL 格式或协议")
+            clean_url = normalize_url(image_url)
+
+            with http_get(clean_url, stream=True) as response:
+                response.raise_for_status()
+
+                content_type = response.headers.get('content-type')
+                content_type_main = content_type.split(';')[0].strip().lower() if content_type else ''
+                if content_type_main not in ('image/jpeg', 'image/png', 'image/gif'):
+                    raise ValueError(f'不支持的内容类型: {content_type_main or "未知"}')
+
+                file_extension = mimetypes.guess_extension(content_type_main)
+                if not file_extension or file_extension.lstrip('.').lower() not in ALLOWED_EXTENSIONS:
+                    _, ext_from_url = os.path.splitext(os.path.basename(parsed_url.path))
+                    if ext_from_url and ext_from_url.lstrip('.').lower() in ALLOWED_EXTENSIONS:
+                        file_extension = ext_from_url
+                    else:
+                        raise ValueError('无法确定有效扩展名')
+
+                original_filename = os.path.basename(parsed_url.path) or "image"
+                filename_base, _ = os.path.splitext(original_filename)
+                safe_filename_base = secure_filename(filename_base)
+                if not safe_filename_base: safe_filename_base = "image"
+
+                safe_extension = file_extension.lower()
+                if not safe_extension.startswith('.'): safe_extension = '.' + safe_extension
+
+                total_size_str = response.headers.get('content-length')
+                total_size = int(total_size_str) if total_size_str and total_size_str.isdigit() else None
+
+                downloaded_size = 0
+                last_progress_time = datetime.datetime.now()
+
+                emit('progress', {'id': progress_item_id, 'url': image_url, 'status': f'下载中 (尝试 {attempt + 1})', 'progress': 0, 'downloaded': 0, 'total': total_size})
+
+                dir_mtime_before = _stat_mtime_ns(category_path)
+                # Several items of a task download at once, so claim the filename exclusively
+                new_filename, f = create_unique_file(category_path, safe_filename_base, safe_extension)
+                save_path = os.path.join(category_path, new_filename)
+
+                hasher = hashlib.sha256() # content hash for deduplication, computed while streaming
+                with f:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        if chunk:
+                            f.write(chunk)
+                            hasher.update(chunk)
+                            downloaded_size += len(chunk)
+                            now_chunk_time = datetime.datetime.now()
+                            if (now_chunk_time - last_progress_time).total_seconds() > 0.2 or \
+                               (total_size is not None and downloaded_size == total_size):
+                                progress_percent = -1
+                                if total_size is not None and total_size > 0:
+                                    progress_percent = round((downloaded_size / total_size) * 100)
+
+                                emit('progress', {'id': progress_item_id, 'url': image_url, 'status': f'下载中 (尝试 {attempt + 1})', 'progress': progress_percent, 'downloaded': downloaded_size, 'total': total_size})
+                                last_progress_time = now_chunk_time
+
+            downloaded = (new_filename, hasher.hexdigest(), dir_mtime_before)
+            break
+
+        except requests.exceptions.Timeout as e_timeout:
+            last_exception_message = f'下载超时 (尝试 {attempt + 1}/{MAX_RETRIES})'
+            app.logger.warning(f"[Task {task_id} - Item {progress_item_id}] {last_exception_message}: {e_timeout}")
+            _remove_partial_download(save_path)
+            if attempt < MAX_RETRIES - 1:
+                emit('progress', {'id': progress_item_id, 'url': image_url, 'status': f'超时，重试中... ({attempt + 2}/{MAX_RETRIES})', 'progress': 0, 'message': last_exception_message})
+                time.sleep(1)
+
+        except requests.exceptions.RequestException as e_req:
+            last_exception_message = f'网络错误 (尝试 {attempt + 1}/{MAX_RETRIES})'
+            app.logger.warning(f"[Task {task_id} - Item {progress_item_id}] {last_exception_message}: {e_req}")
+            _remove_partial_download(save_path)
+            if attempt < MAX_RETRIES - 1:
+                emit('progress', {'id': progress_item_id, 'url': image_url, 'status': f'网络错误，重试中... ({attempt + 2}/{MAX_RETRIES})', 'progress': 0, 'message': last_exception_message})
+                time.sleep(1)
+
+        except (IOError, ValueError, Exception) as e_proc:
+            last_exception_message = f'处理失败: {str(e_proc)}'
+            app.logger.warning(f"[Task {task_id} - Item {progress_item_id}] {last_exception_message}", exc_info=True)
+            _remove_partial_download(save_path)
+            break
+
+    if downloaded is None:
+        app.logger.error(f"[Task {task_id} - Item {progress_item_id}] URL {image_url} failed. Last error: {last_exception_message}")
+        emit('progress', {'id': progress_item_id, 'url': image_url, 'status': '错误', 'progress': 0, 'message': last_exception_message})
+        import_items.inc('url', 'error')
+        return False
+
+    # The file is complete from here on. It is never removed on a later error: if it cannot be
+    # recorded now, the catalog is out of sync with the directory and the next read rescans it.
+    new_filename, sha256, dir_mtime_before = downloaded
+    try:
+        kept, duplicate_of = store_deduplicated(category_name, new_filename, sha256, dir_mtime_before)
+    except (OSError, sqlite3.Error) as e:
+        app.logger.error(f"[Task {task_id} - Item {progress_item_id}] Could not record {new_filename} in the catalog: {e}")
+        emit('progress', {'id': progress_item_id, 'url': image_url, 'status': '错误', 'progress': 100, 'new_filename': new_filename,
+                          'message': f'文件已下载，但记录到目录时出错: {e}'})
+        import_items.inc('url', 'error')
         return False
+    if not kept:
+        app.logger.info(f"[Task {task_id} - Item {progress_item_id}] Duplicate of {duplicate_of['category']}/{duplicate_of['filename']}, not stored")
+        emit('progress', {'id': progress_item_id, 'url': image_url, 'status': '重复', 'progress': 100, 'duplicate_of': duplicate_of,
+                          'message': f"与已有文件 {duplicate_of['category']}/{duplicate_of['filename']} 内容相同，未保存"})
+        import_items.inc('url', 'duplicate')
+        return True
+    invalidate_category_index(category_name)
+    schedule_thumbnail(category_name, new_filename)
+    schedule_variants(category_name, new_filename)
+    app.logger.info(f"[Task {task_id} - Item {progress_item_id}] Attempt {attempt + 1} Succeeded. Saved as: {new_filename}")
+    import_items.inc('url', 'success')
+    import_bytes.inc('url', amount=downloaded_size)
+    payload = {'id': progress_item_id, 'url': image_url, 'status': '完成', 'progress': 100, 'new_filename': new_filename, 'message': '上传成功'}
+    if duplicate_of:
+        payload['duplicate_of'] = duplicate_of
+        payload['message'] = f"上传成功（与 {duplicate_of['category']}/{duplicate_of['filename']} 内容相同，已作为硬链接保存）"
+    emit('progress', payload)
+    return True
+
+def create_unique_file(category_path, safe_filename_base, safe_extension):
+    """Creates <base>_<timestamp><ext> exclusively, retrying on a clash. Returns (filename, binary file object)."""
+    while True:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+        new_filename = f"{safe_filename_base}_{timestamp}{safe_extension}"
+        try:
+            return new_filename, open(os.path.join(category_path, new_filename), 'xb')
+        except FileExistsError:
+            continue
+
+def _remove_partial_download(save_path):
+    """Deletes a file left behind by a failed download attempt."""
+    if save_path and os.path.exists(save_path):
+        try:
+            os.remove(save_path)
+        except OSError as e:
+            app.logger.warning(f"Could not remove partial download {save_path}: {e}")
+
+# --- End URL Import Engine ---
+
+# --- Archive Import ---
+# A zip or tar upload is extracted member by member in fixed-size chunks, so memory
+# stays bounded whatever the archive holds. Members are only kept if their extension
+# is allowed and their first bytes match that image type.
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+IMAGE_SIGNATURES = {
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'jpg': (b'\xff\xd8\xff',),
+    'jpeg': (b'\xff\xd8\xff',),
+    'gif': (b'GIF87a', b'GIF89a'),
+}
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+class ArchiveMemberError(Exception):
+    """A member was not stored; the message is shown to the admin."""
+
+def is_archive_filename(filename):
+    return filename.lower().endswith(ARCHIVE_SUFFIXES)
+
+def iter_archive_members(archive_stream):
+    """
+    Yields (name, size, compressed size or None, open_member) for the regular files of a zip
+    or tar (optionally gzip/bz2/xz compressed) archive. Zip needs a seekable stream, which
+    uploads are (Werkzeug spools them to a temporary file); tar is read front to back, so
+    its other entries are yielded too, with open_member None, as skipping them costs reading.
+    Each member must be read before asking for the next one.
+    Raises zipfile.BadZipFile or tarfile.TarError for anything else.
+    """
+    head = archive_stream.read(4)
+    archive_stream.seek(0)
+    if head in (b'PK\x03\x04', b'PK\x05\x06'):
+        with zipfile.ZipFile(archive_stream) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size, info.compress_size, functools.partial(archive.open, info)
+    else:
+        with tarfile.open(fileobj=archive_stream, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, member.size, None, functools.partial(archive.extractfile, member)
+                else: # directories, links, devices: never extracted
+                    yield member.name, member.size, None, None
+
+def extract_archive_member(open_member, category_path, member_name, max_bytes):
+    """
+    Writes one member into the category under a new unique name, hashing it on the way.
+    Returns (new_filename, sha256, size). Raises ArchiveMemberError if it is not an allowed
+    image or grows past max_bytes; nothing is left on disk in that case.
+    """
+    filename_base, file_extension = os.path.splitext(posixpath.basename(member_name.replace('\\', '/')))
+    extension = file_extension.lower().lstrip('.')
+    if extension not in ALLOWED_EXTENSIONS:
+        raise ArchiveMemberError(f'不允许的扩展名 ({file_extension or "无"})')
+
+    new_filename, f = create_unique_file(category_path, secure_filename(filename_base) or 'file', '.' + extension)
+    save_path = os.path.join(category_path, new_filename)
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with f, open_member() as source:
+            for chunk in iter(functools.partial(source.read, ARCHIVE_CHUNK_SIZE), b''):
+                if size == 0 and not chunk.startswith(IMAGE_SIGNATURES[extension]):
+                    raise ArchiveMemberError(f'文件内容不是 {extension} 图片')
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ArchiveMemberError('文件过大')
+                hasher.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise ArchiveMemberError('空文件')
+    except (ArchiveMemberError, OSError, RuntimeError, zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+        _remove_partial_download(save_path)
+        if isinstance(e, ArchiveMemberError):
+            raise
+        raise ArchiveMemberError(f'解压失败: {e}') # e.g. encrypted zip member (RuntimeError), bad CRC, truncated archive
+    return new_filename, hasher.hexdigest(), size
+
+def import_archive(archive_stream, category_name):
+    """
+    Extracts the images of an archive into a category. Returns one result dict per member
+    (name, status: success/duplicate/skipped/error, message, new_filename, duplicate_of).
+    """
+    category_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name)
+    max_members = app.config['ARCHIVE_MAX_MEMBERS']
+    max_member_bytes = app.config['ARCHIVE_MAX_MEMBER_BYTES']
+    remaining_bytes = app.config['ARCHIVE_MAX_TOTAL_BYTES']
+    stored_bytes = 0
+    results = []
+    try:
+        for position, (member_name, size, compressed_size, open_member) in enumerate(iter_archive_members(archive_stream)):
+            if position >= max_members:
+                results.append({'name': member_name, 'status': 'error', 'message': f'成员数量超过上限 ({max_members})，其余部分未处理'})
+                break
+            # Getting past a tar member decompresses it whether it is extracted or skipped, so
+            # tar members are charged their declared size up front, and the loop stops before
+            # reading past the limit. Zip members are skipped by seeking and charged what they wrote.
+            streamed = compressed_size is None
+            over_limit = size > remaining_bytes if streamed else remaining_bytes <= 0
+            if over_limit:
+                results.append({'name': member_name, 'status': 'error', 'message': '解压总大小超过上限，其余部分未处理'})
+                break
+            extract_limit = min(max_member_bytes, remaining_bytes)
+            if streamed:
+                remaining_bytes -= size
+            if open_member is None:
+                continue
+            basename = posixpath.basename(member_name.replace('\\', '/'))
+            if not basename or basename.startswith('.') or member_name.startswith('__MACOSX/'):
+                results.append({'name': member_name, 'status': 'skipped', 'message': '隐藏或系统文件'})
+                continue
+            # Declared sizes are only a first filter, extraction enforces the real byte counts
+            if size > max_member_bytes:
+                results.append({'name': member_name, 'status': 'error', 'message': '文件过大'})
+                continue
+            if compressed_size is not None and size > app.config['ARCHIVE_MAX_RATIO'] * max(compressed_size, 1):
+                results.append({'name': member_name, 'status': 'error', 'message': '压缩比异常，已跳过'})
+                continue
+
+            dir_mtime_before = _stat_mtime_ns(category_path)
+            try:
+                new_filename, sha256, written = extract_archive_member(open_member, category_path, member_name, extract_limit)
+            except ArchiveMemberError as e:
+                status = 'skipped' if str(e).startswith('不允许的扩展名') else 'error'
+                results.append({'name': member_name, 'status': status, 'message': str(e)})
+                continue
+            if not streamed:
+                remaining_bytes -= written
+
+            kept, duplicate_of = store_deduplicated(category_name, new_filename, sha256, dir_mtime_before)
+            if not kept:
+                results.append({'name': member_name, 'status': 'duplicate', 'duplicate_of': duplicate_of,
+                                'message': f"与已有文件 {duplicate_of['category']}/{duplicate_of['filename']} 内容相同，未保存"})
+                continue
+            schedule_thumbnail(category_name, new_filename)
+            schedule_variants(category_name, new_filename)
+            stored_bytes += written
+            result = {'name': member_name, 'status': 'success', 'new_filename': new_filename, 'message': '上传成功'}
+            if duplicate_of:
+                result['duplicate_of'] = duplicate_of
+            results.append(result)
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as e:
+        # A broken archive stops here; members stored so far stay
+        results.append({'name': '', 'status': 'error', 'message': f'读取压缩包出错: {e}'})
+    finally:
+        invalidate_category_index(category_name)
+        for result in results:
+            import_items.inc('archive', result['status'])
+        import_bytes.inc('archive', amount=stored_bytes)
+    return results
+
+# --- End Archive Import ---
+
+# --- Category Export ---
+# A category is exported as a stored (uncompressed, the images already are) zip built
+# on the fly from the directory, plus an external_links.json manifest in the legacy
+# format, so unpacking the zip into EMOTICONS_FOLDER recreates the category with its
+# links. The layout only depends on names and sizes: the length, every offset and the
+# ETag are known before the first byte is sent, which is what makes Range / If-Range
+# resumption possible without temp files. The CRC-32 of a file is computed just before
+# its header is sent and cached in the catalog (keyed by size and mtime).
+
+EXPORT_CHUNK_SIZE = 256 * 1024
+EXPORT_MANIFEST_NAME = 'external_links.json'
+EXPORT_CRC_FLUSH_EVERY = 500
+ZIP64_LIMIT = 0xFFFFFFFF # sizes / offsets from here on go into zip64 extra fields
+ZIP64_MARKER = 0xFFFFFFFF
+ZIP_UTF8_FLAG = 0x0800
+ZIP_FILE_ATTRIBUTES = 0o100644 << 16
+
+class ExportChangedError(Exception):
+    """A file changed size or mtime after the export layout was computed."""
+
+class ExportEntry:
+    __slots__ = ('name', 'path', 'data', 'size', 'mtime_ns', 'crc', 'offset', 'header_size', 'dos_time', 'dos_date')
+
+    def __init__(self, name, size, mtime_ns, path=None, data=None, crc=None):
+        self.name = name.encode('utf-8')
+        self.path = path
+        self.data = data
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.crc = crc
+        self.offset = 0
+        self.header_size = 30 + len(self.name) + (20 if size >= ZIP64_LIMIT else 0)
+        self.dos_date, self.dos_time = zip_dos_datetime(mtime_ns / 1e9)
+
+    def central_extra(self):
+        """The zip64 extra field of the central directory record (empty when not needed)."""
+        values = []
+        if self.size >= ZIP64_LIMIT:
+            values += [self.size, self.size] # uncompressed and compressed size
+        if self.offset >= ZIP64_LIMIT:
+            values.append(self.offset)
+        return struct.pack(f'<HH{len(values)}Q', 1, 8 * len(values), *values) if values else b''
+
+    def central_size(self):
+        return 46 + len(self.name) + len(self.central_extra())
+
+def zip_dos_datetime(timestamp):
+    """(date, time) in MS-DOS format, clamped to the 1980-2107 range it can represent."""
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return (1 << 5) | 1, 0
+    if t.tm_year > 2107:
+        return (127 << 9) | (12 << 5) | 31, (23 << 11) | (59 << 5) | 29
+    return ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday, (t.tm_hour << 11) | (t.tm_min << 5) | (min(t.tm_sec, 59) // 2)
+
+class CategoryExport:
+    """Byte layout of a category's export zip; iter_bytes(start, end) produces any slice of it."""
+
+    def __init__(self, category_name):
+        self.category_name = category_name
+        category_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name)
+        local_files, _ = catalog.list_index_items(category_name)
+        external_links = catalog.list_external_links(category_name)
+        cached_crcs = catalog.get_local_file_crcs(category_name)
+        self.entries = []
+        for filename in local_files:
+            file_path = os.path.join(category_path, filename)
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                continue # removed since the last catalog sync
+            if not stat.S_ISREG(file_stat.st_mode):
+                continue
+            cached = cached_crcs.get(filename)
+            crc = cached[0] if cached and cached[1:] == (file_stat.st_size, file_stat.st_mtime_ns) else None
+            self.entries.append(ExportEntry(filename, file_stat.st_size, file_stat.st_mtime_ns, path=file_path, crc=crc))
+
+        manifest = json.dumps([{'id': link_id, 'url': url, 'type': 'external', 'added_at': added_at}
+                               for link_id, url, added_at in external_links],
+                              ensure_ascii=False, indent=2).encode('utf-8')
+        self.entries.append(ExportEntry(EXPORT_MANIFEST_NAME, len(manifest), _stat_mtime_ns(category_path) or 0,
+                                        data=manifest, crc=zlib.crc32(manifest)))
+
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            offset += entry.header_size + entry.size
+        self.central_offset = offset
+        self.central_size = sum(entry.central_size() for entry in self.entries)
+        self.needs_zip64_end = (len(self.entries) >= 0xFFFF or self.central_offset >= ZIP64_LIMIT
+                                or self.central_size >= ZIP64_LIMIT)
+        self.length = self.central_offset + self.central_size + len(self._end_records())
+
+        etag_hash = hashlib.sha256(category_name.encode('utf-8'))
+        for entry in self.entries:
+            etag_hash.update(b'%s\0%d\0%d\0' % (entry.name, entry.size, entry.mtime_ns))
+        etag_hash.update(manifest)
+        self.etag = etag_hash.hexdigest()[:32]
+        self._pending_crcs = []
+
+    # CRC-32
+
+    def _ensure_crc(self, entry):
+        if entry.crc is not None:
+            return
+        crc = 0
+        with open(entry.path, 'rb') as f:
+            self._check_unchanged(entry, os.fstat(f.fileno()))
+            for chunk in iter(lambda: f.read(EXPORT_CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+        entry.crc = crc
+        self._pending_crcs.append((entry.name.decode('utf-8'), crc, entry.size, entry.mtime_ns))
+        if len(self._pending_crcs) >= EXPORT_CRC_FLUSH_EVERY:
+            self.flush_crcs()
+
+    def flush_crcs(self):
+        if self._pending_crcs:
+            catalog.set_local_file_crcs(self.category_name, self._pending_crcs)
+            self._pending_crcs = []
+
+    @staticmethod
+    def _check_unchanged(entry, file_stat):
+        if file_stat.st_size != entry.size or file_stat.st_mtime_ns != entry.mtime_ns:
+            raise ExportChangedError(f'{entry.path} changed during export')
+
+    # Records
+
+    def _local_header(self, entry):
+        self._ensure_crc(entry)
+        zip64 = entry.size >= ZIP64_LIMIT
+        stored_size = ZIP64_MARKER if zip64 else entry.size
+        extra = struct.pack('<HHQQ', 1, 16, entry.size, entry.size) if zip64 else b''
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, ZIP_UTF8_FLAG, 0,
+                           entry.dos_time, entry.dos_date, entry.crc, stored_size, stored_size,
+                           len(entry.name), len(extra)) + entry.name + extra
+
+    def _central_record(self, entry):
+        self._ensure_crc(entry)
+        extra = entry.central_extra()
+        stored_size = ZIP64_MARKER if entry.size >= ZIP64_LIMIT else entry.size
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 45, 45 if extra else 20, ZIP_UTF8_FLAG, 0,
+                           entry.dos_time, entry.dos_date, entry.crc, stored_size, stored_size,
+                           len(entry.name), len(extra), 0, 0, 0, ZIP_FILE_ATTRIBUTES,
+                           ZIP64_MARKER if entry.offset >= ZIP64_LIMIT else entry.offset) + entry.name + extra
+
+    def _end_records(self):
+        records = b''
+        entry_count = len(self.entries)
+        if self.needs_zip64_end:
+            zip64_end_offset = self.central_offset + self.central_size
+            records += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0,
+                                   entry_count, entry_count, self.central_size, self.central_offset)
+            records += struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+        if self.needs_zip64_end: # the classic record only points at the zip64 one
+            entry_count, central_size, central_offset = 0xFFFF, ZIP64_MARKER, ZIP64_MARKER
+        else:
+            central_size, central_offset = self.central_size, self.central_offset
+        records += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, entry_count, entry_count, central_size, central_offset, 0)
+        return records
+
+    def _read_data(self, entry, skip, length):
+        if entry.data is not None:
+            yield entry.data[skip:skip + length]
+            return
+        with open(entry.path, 'rb') as f:
+            self._check_unchanged(entry, os.fstat(f.fileno()))
+            f.seek(skip)
+            while length > 0:
+                chunk = f.read(min(EXPORT_CHUNK_SIZE, length))
+                if not chunk:
+                    raise ExportChangedError(f'{entry.path} was truncated during export')
+                length -= len(chunk)
+                yield chunk
+
+    def _pieces(self):
+        """Yields (size, produce) in file order; produce(skip, length) yields that part of the piece."""
+        def record(build):
+            return lambda skip, length: iter((build()[skip:skip + length],))
+        for entry in self.entries:
+            yield entry.header_size, record(lambda entry=entry: self._local_header(entry))
+            yield entry.size, lambda skip, length, entry=entry: self._read_data(entry, skip, length)
+        for entry in self.entries:
+            yield entry.central_size(), record(lambda entry=entry: self._central_record(entry))
+        end_records = self._end_records()
+        yield len(end_records), record(lambda: end_records)
+
+    def iter_bytes(self, start, end):
+        """Yields the bytes in [start, end) of the zip."""
+        position = 0
+        try:
+            for size, produce in self._pieces():
+                piece_end = position + size
+                if piece_end > start and size:
+                    skip = max(start - position, 0)
+                    yield from produce(skip, min(piece_end, end) - position - skip)
+                position = piece_end
+                if position >= end:
+                    break
+        except (OSError, ExportChangedError) as e:
+            # The response is already under way, ending it short makes the client retry
+            app.logger.error(f"Export of category {self.category_name} aborted: {e}")
+        finally:
+            self.flush_crcs()
+
+def content_disposition_attachment(filename):
+    """Content-Disposition for a download name that may be non-ASCII (RFC 6266 / 5987)."""
+    stem, extension = os.path.splitext(filename)
+    ascii_name = (secure_filename(stem) or 'download') + extension
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+# --- End Category Export ---
+
+# --- URL Import Task Store ---
+# Imports run in the background (see start_import_task). Their progress events are
+# appended to the task store, so stream_url_download_progress can run in any Gunicorn
+# worker, and a reconnecting EventSource resumes from its Last-Event-ID.
+
+class TaskStore(abc.ABC):
+    """Interface of the URL import task store."""
+
+    @abc.abstractmethod
+    def create(self, task_id, task):
+        """Stores a new task: a dict with category, urls, status and created_at."""
+
+    @abc.abstractmethod
+    def get(self, task_id):
+        """Returns the task dict, or None if it does not exist or has expired."""
+
+    @abc.abstractmethod
+    def update_status(self, task_id, status):
+        """Sets the status of a task, e.g. 'running'."""
+
+    @abc.abstractmethod
+    def complete(self, task_id, result):
+        """Marks a task as completed and stores its result summary."""
+
+    @abc.abstractmethod
+    def heartbeat(self, task_ids):
+        """Records that the calling process is still running these tasks (owner_pid, heartbeat_ts)."""
+
+    @abc.abstractmethod
+    def fail(self, task_id, stale_before, message):
+        """
+        Marks a running task as failed and appends an 'error' event with message, unless the task
+        got a heartbeat at or after stale_before. Returns whether the task was marked.
+        """
+
+    @abc.abstractmethod
+    def append_event(self, task_id, event_name, payload):
+        """Appends a progress event and returns its id (increasing, usable as the SSE event id)."""
+
+    @abc.abstractmethod
+    def get_events(self, task_id, after_event_id=0):
+        """Returns the (event_id, event_name, payload) tuples recorded after after_event_id."""
+
+    @abc.abstractmethod
+    def delete(self, task_id):
+        """Removes a task and its events."""
+
+    @abc.abstractmethod
+    def cleanup_expired(self):
+        """Removes tasks older than TASK_TTL and returns how many were removed."""
+
+class MemoryTaskStore(TaskStore):
+    """Keeps tasks in a dict. Only usable with a single worker process."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.tasks = {}
+        self.events = {} # task_id -> list of (event_id, event_name, payload)
+        self.event_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def create(self, task_id, task):
+        with self.lock:
+            self.tasks[task_id] = dict(task, created_ts=time.time(), result=None, owner_pid=None, heartbeat_ts=None)
+            self.events[task_id] = []
+
+    def get(self, task_id):
+        with self.lock:
+            task = self.tasks.get(task_id)
+        if task is None or time.time() - task['created_ts'] > self.ttl:
+            return None
+        return task
+
+    def update_status(self, task_id, status):
+        with self.lock:
+            if task_id in self.tasks:
+                self.tasks[task_id]['status'] = status
+
+    def complete(self, task_id, result):
+        with self.lock:
+            if task_id in self.tasks:
+                self.tasks[task_id].update(status='completed', result=result)
+
+    def heartbeat(self, task_ids):
+        now = time.time()
+        with self.lock:
+            for task_id in task_ids:
+                if task_id in self.tasks:
+                    self.tasks[task_id].update(owner_pid=os.getpid(), heartbeat_ts=now)
+
+    def fail(self, task_id, stale_before, message):
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None or task['status'] != 'running' or (task['heartbeat_ts'] or 0) >= stale_before:
+                return False
+            task.update(status='failed', result={'error': message})
+            self.events[task_id].append((next(self.event_ids), 'error', {'message': message}))
+        return True
+
+    def append_event(self, task_id, event_name, payload):
+        with self.lock:
+            event_id = next(self.event_ids)
+            if task_id in self.events:
+                self.events[task_id].append((event_id, event_name, payload))
+        return event_id
+
+    def get_events(self, task_id, after_event_id=0):
+        with self.lock:
+            return [event for event in self.events.get(task_id, []) if event[0] > after_event_id]
+
+    def delete(self, task_id):
+        with self.lock:
+            self.tasks.pop(task_id, None)
+            self.events.pop(task_id, None)
+
+    def cleanup_expired(self):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            expired = [task_id for task_id, task in self.tasks.items() if task['created_ts'] < cutoff]
+            for task_id in expired:
+                del self.tasks[task_id]
+                self.events.pop(task_id, None)
+        return len(expired)
+
+class SQLiteTaskStore(SQLiteDatabase, TaskStore):
+    """Keeps tasks in a local SQLite file shared by all worker processes."""
+
+    def __init__(self, path, ttl):
+        super().__init__(path)
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS tasks (
+                                id TEXT PRIMARY KEY,
+                                category TEXT NOT NULL,
+                                urls TEXT NOT NULL,
+                                status TEXT NOT NULL,
+                                created_at TEXT NOT NULL,
+                                created_ts REAL NOT NULL
+                            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_created_ts ON tasks (created_ts)')
+            self._ensure_columns(conn, 'tasks', {'result': 'TEXT', 'owner_pid': 'INTEGER', 'heartbeat_ts': 'REAL'})
+            conn.execute('''CREATE TABLE IF NOT EXISTS task_events (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                task_id TEXT NOT NULL,
+                                event TEXT NOT NULL,
+                                data TEXT NOT NULL
+                            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_task_events_task_id ON task_events (task_id, id)')
+
+    def create(self, task_id, task):
+        with self._connect() as conn:
+            conn.execute('INSERT INTO tasks (id, category, urls, status, created_at, created_ts) VALUES (?, ?, ?, ?, ?, ?)',
+                         (task_id, task['category'], json.dumps(task['urls'], ensure_ascii=False),
+                          task['status'], task['created_at'], time.time()))
+
+    def get(self, task_id):
+        row = self._connect().execute('SELECT * FROM tasks WHERE id = ? AND created_ts >= ?',
+                                      (task_id, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        return {'category': row['category'], 'urls': json.loads(row['urls']),
+                'status': row['status'], 'created_at': row['created_at'],
+                'result': json.loads(row['result']) if row['result'] else None,
+                'owner_pid': row['owner_pid'], 'heartbeat_ts': row['heartbeat_ts']}
+
+    def update_status(self, task_id, status):
+        with self._connect() as conn:
+            conn.execute('UPDATE tasks SET status = ? WHERE id = ?', (status, task_id))
+
+    def complete(self, task_id, result):
+        with self._connect() as conn:
+            conn.execute('UPDATE tasks SET status = ?, result = ? WHERE id = ?',
+                         ('completed', json.dumps(result, ensure_ascii=False), task_id))
+
+    def heartbeat(self, task_ids):
+        with self._connect() as conn:
+            conn.executemany('UPDATE tasks SET owner_pid = ?, heartbeat_ts = ? WHERE id = ?',
+                             [(os.getpid(), time.time(), task_id) for task_id in task_ids])
+
+    def fail(self, task_id, stale_before, message):
+        conn = self._connect()
+        with conn:
+            # One write transaction, so only one of the workers noticing the orphan records the error
+            conn.execute('BEGIN IMMEDIATE')
+            marked = conn.execute('''UPDATE tasks SET status = 'failed', result = ?
+                                     WHERE id = ? AND status = 'running' AND (heartbeat_ts IS NULL OR heartbeat_ts < ?)''',
+                                  (json.dumps({'error': message}, ensure_ascii=False), task_id, stale_before)).rowcount
+            if marked:
+                conn.execute('INSERT INTO task_events (task_id, event, data) VALUES (?, ?, ?)',
+                             (task_id, 'error', json.dumps({'message': message}, ensure_ascii=False)))
+        return bool(marked)
+
+    def append_event(self, task_id, event_name, payload):
+        with self._connect() as conn:
+            return conn.execute('INSERT INTO task_events (task_id, event, data) VALUES (?, ?, ?)',
+                                (task_id, event_name, json.dumps(payload, ensure_ascii=False))).lastrowid
+
+    def get_events(self, task_id, after_event_id=0):
+        rows = self._connect().execute('SELECT id, event, data FROM task_events WHERE task_id = ? AND id > ? ORDER BY id',
+                                       (task_id, after_event_id)).fetchall()
+        return [(row['id'], row['event'], json.loads(row['data'])) for row in rows]
+
+    def delete(self, task_id):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM task_events WHERE task_id = ?', (task_id,))
+            conn.execute('DELETE FROM tasks WHERE id = ?', (task_id,))
+
+    def cleanup_expired(self):
+        cutoff = time.time() - self.ttl
+        with self._connect() as conn:
+            conn.execute('DELETE FROM task_events WHERE task_id IN (SELECT id FROM tasks WHERE created_ts < ?)', (cutoff,))
+            return conn.execute('DELETE FROM tasks WHERE created_ts < ?', (cutoff,)).rowcount
+
+def create_task_store():
+    """Builds the task store selected by the TASK_STORE setting."""
+    if app.config['TASK_STORE'] == 'memory':
+        return MemoryTaskStore(app.config['TASK_TTL'])
+    if app.config['TASK_STORE'] != 'sqlite':
+        app.logger.warning(f"Unknown TASK_STORE '{app.config['TASK_STORE']}', falling back to sqlite.")
+    return SQLiteTaskStore(app.config['TASK_STORE_PATH'], app.config['TASK_TTL'])
+
+task_store = create_task_store()
+
+class TaskHeartbeat:
+    """
+    Refreshes heartbeat_ts of the tasks running in this process. Import threads are daemon
+    threads and die with their worker, so a task whose heartbeat stops is an orphan.
+    """
+
+    def __init__(self):
+        self.task_ids = set()
+        self.started = False
+        self.lock = threading.Lock()
+
+    def __contains__(self, task_id):
+        with self.lock:
+            return task_id in self.task_ids
+
+    def add(self, task_id):
+        with self.lock:
+            self.task_ids.add(task_id)
+            if not self.started:
+                self.started = True
+                threading.Thread(target=self._run, name='task-heartbeat', daemon=True).start()
+        task_store.heartbeat([task_id])
+
+    def discard(self, task_id):
+        with self.lock:
+            self.task_ids.discard(task_id)
+
+    def _run(self):
+        interval = max(app.config['TASK_HEARTBEAT_TIMEOUT'] / 4, 1)
+        while True:
+            time.sleep(interval)
+            with self.lock:
+                task_ids = list(self.task_ids)
+            if task_ids:
+                try:
+                    task_store.heartbeat(task_ids)
+                except sqlite3.Error as e:
+                    app.logger.error(f"Could not record the heartbeat of {len(task_ids)} URL import tasks: {e}")
+
+task_heartbeat = TaskHeartbeat()
+
+def fail_orphaned_task(task_id, task):
+    """
+    Marks a running task as failed when no worker runs it anymore: its heartbeat is older than
+    TASK_HEARTBEAT_TIMEOUT, or its owner is this very process, which does not run it (a restarted
+    worker that got the same pid). Returns the task as it is afterwards.
+    """
+    if task['status'] != 'running' or task_id in task_heartbeat:
+        return task
+    stale_before = time.time() - app.config['TASK_HEARTBEAT_TIMEOUT']
+    if task['owner_pid'] == os.getpid():
+        stale_before = float('inf')
+    if (task['heartbeat_ts'] or 0) >= stale_before:
+        return task
+    if task_store.fail(task_id, stale_before, '任务所在的工作进程已退出，导入已中断，请重新提交未完成的 URL。'):
+        app.logger.warning(f"[Task {task_id}] Worker {task['owner_pid']} stopped running the task, marked as failed.")
+    return task_store.get(task_id) or task
+
+def start_import_task(task_id, category_name, image_urls):
+    """
+    Queues every URL of a task on the import engine and returns immediately.
+    Events go to the task store; the last finished item writes the 'end' event and the result.
+    """
+    lock = threading.Lock()
+    started_at = time.perf_counter()
+    item_results = {} # progress item id -> last progress payload
+    finished = {'count': 0, 'processed': 0}
+
+    def emit(event_name, payload):
+        if event_name == 'item_done':
+            # Internal marker from import_url_item, not recorded as an event
+            with lock:
+                finished['count'] += 1
+                if payload['success']:
+                    finished['processed'] += 1
+                is_last = finished['count'] == len(image_urls)
+            if is_last:
+                finish()
+            return
+        if event_name == 'progress':
+            with lock:
+                item_results[payload['id']] = payload
+        task_store.append_event(task_id, event_name, payload)
+
+    def finish():
+        processed_count = finished['processed']
+        app.logger.info(f"[Task {task_id}] 所有 URL 处理完毕. Processed: {processed_count}/{len(image_urls)}")
+        items = []
+        for index, image_url in enumerate(image_urls):
+            payload = item_results.get(f"task-{task_id}-item-{index}", {})
+            items.append({key: payload[key] for key in ('id', 'url', 'status', 'new_filename', 'duplicate_of', 'message') if key in payload})
+        task_store.append_event(task_id, 'end', {'message': f'任务 {task_id} 处理完毕。成功处理 {processed_count} / {len(image_urls)} 个 URL。'})
+        task_store.complete(task_id, {'processed': processed_count, 'total': len(image_urls), 'items': items})
+        task_heartbeat.discard(task_id)
+        import_task_seconds.observe(time.perf_counter() - started_at)
 
-# --- End Helper Functions for External Links ---
+    task_heartbeat.add(task_id) # records this process as the owner before the task counts as running
+    task_store.update_status(task_id, 'running')
+    task_store.append_event(task_id, 'message', {'type': 'info', 'message': f'开始处理任务 {task_id}，共 {len(image_urls)} 个 URL...'})
+    for index, image_url in enumerate(image_urls):
+        import_engine.submit(image_url, functools.partial(import_url_item, task_id, index, image_url, category_name, emit))
+
+# --- End URL Import Task Store ---
 
 def login_required(view):
     @functools.wraps(view)
@@ -121,8 +2919,7 @@ def index():
     if os.path.exists(app.config['EMOTICONS_FOLDER']):
         try:
             # 只列出目录
-            categories = sorted([d for d in os.listdir(app.config['EMOTICONS_FOLDER'])
-                                 if os.path.isdir(os.path.join(app.config['EMOTICONS_FOLDER'], d))])
+            categories = get_category_list()
         except OSError as e:
             flash(f"无法读取表情包目录: {e}", "danger")
             categories = [] # 出错时返回空列表
@@ -151,7 +2948,7 @@ def login():
 def logout():
     """处理用户登出。"""
     session.pop('logged_in', None)
-    session.pop('last_shown', None) # Clear last shown for all categories on logout
+    session.pop('client_token', None) # Forget the random endpoint's state of this client
     flash('您已成功登出。', 'info')
     return redirect(url_for('index'))
 
@@ -177,7 +2974,7 @@ def admin():
     emoticons_path = app.config['EMOTICONS_FOLDER']
     if os.path.exists(emoticons_path):
         try:
-            all_categories_list = sorted([d for d in os.listdir(emoticons_path) if os.path.isdir(os.path.join(emoticons_path, d))])
+            all_categories_list = get_category_list()
         except OSError as e:
             flash(f'无法读取表情包目录: {e}', 'danger')
     
@@ -220,6 +3017,7 @@ def create_category():
     else:
         try:
             os.makedirs(category_path)
+            invalidate_category_list()
             flash(f'分类 "{category_name}" 创建成功。', 'success') # Use original name in message
         except OSError as e:
             flash(f'创建分类时出错: {e}', 'danger')
@@ -242,12 +3040,13 @@ def delete_category(category_name):
     else:
         try:
             shutil.rmtree(category_path)
+            catalog.delete_category(category_name)
+            invalidate_category_index(category_name)
+            invalidate_category_list()
+            remove_thumbnail_category(category_name)
+            client_state.delete_category(category_name)
+            remove_variant_category(category_name)
             flash(f'分类 "{category_name}" 已成功删除。', 'success') # Use original name
-            last_shown = session.get('last_shown', {})
-            if category_name in last_shown: # Use original name
-                del last_shown[category_name]
-                session['last_shown'] = last_shown
-                session.modified = True
         except OSError as e:
             flash(f'删除分类时出错: {e}', 'danger')
 
@@ -285,23 +3084,14 @@ def rename_category(old_category_name):
 
     try:
         os.rename(old_category_path, new_category_path)
+        catalog.rename_category(old_category_name, new_category_name)
+        invalidate_category_index(old_category_name)
+        invalidate_category_list()
+        rename_thumbnail_category(old_category_name, new_category_name)
+        client_state.rename_category(old_category_name, new_category_name)
+        rename_variant_category(old_category_name, new_category_name)
         flash(f'分类已从 "{old_category_name}" 重命名为 "{new_category_name}"。', 'success')
 
-        # Update session cache if necessary (e.g., last_shown_v2)
-        last_shown_v2 = session.get('last_shown_v2', {})
-        if old_category_name in last_shown_v2:
-            last_shown_v2[new_category_name] = last_shown_v2.pop(old_category_name)
-            session['last_shown_v2'] = last_shown_v2
-            session.modified = True
-        
-        # Also update 'last_shown' if it's still in use for some reason
-        last_shown_old_format = session.get('last_shown', {})
-        if old_category_name in last_shown_old_format:
-            last_shown_old_format[new_category_name] = last_shown_old_format.pop(old_category_name)
-            session['last_shown'] = last_shown_old_format
-            session.modified = True
-
-
     except OSError as e:
         app.logger.error(f"Error renaming category '{old_category_name}' to '{new_category_name}': {e}")
         flash(f'重命名分类时出错: {e}', 'danger')
@@ -309,6 +3099,23 @@ def rename_category(old_category_name):
     return redirect(url_for('admin', page=request.args.get('page', 1)))
 
 
+def encode_listing_cursor(catalog_item):
+    """Opaque pagination cursor for the (added_at, name, id) listing key of an item."""
+    key = json.dumps([catalog_item['added_at'], catalog_item['name'], catalog_item['id']], ensure_ascii=False)
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_listing_cursor(cursor):
+    """Returns the listing key of a cursor, or None if it is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not (isinstance(key, list) and len(key) == 3 and all(isinstance(part, str) for part in key)):
+        return None
+    return tuple(key)
+
 @app.route('/admin/category/<path:category_name>')
 @login_required
 def view_category(category_name):
@@ -334,64 +3141,74 @@ def view_category(category_name):
     if per_page not in ALLOWED_PER_PAGE:
         per_page = 100
 
-    all_items = []
-
-    # 1. Load local images
+    # 1. Count and page come from the catalog index, only the items on this page are read.
+    # Prev/next links carry a keyset cursor; plain page/per_page links fall back to OFFSET.
+    after = decode_listing_cursor(request.args.get('after'))
+    before = decode_listing_cursor(request.args.get('before'))
+    catalog_items = []
+    total_items_count = 0
     try:
-        local_image_files = [f for f in os.listdir(category_path)
-                             if os.path.isfile(os.path.join(category_path, f)) and allowed_file(f)]
-        for filename in local_image_files:
-            file_path = os.path.join(category_path, filename)
-            try:
-                modified_time = os.path.getmtime(file_path)
-                added_at_iso = datetime.datetime.fromtimestamp(modified_time, datetime.timezone.utc).isoformat()
-            except OSError:
-                # Fallback if cannot get modification time
-                added_at_iso = datetime.datetime.min.isoformat() + "Z"
-            
-            all_items.append({
+        index = get_category_index(category_name)
+        total_items_count = len(index) + index.dead_link_count if index is not None else 0 # the listing shows dead links too
+    except (OSError, sqlite3.Error) as e:
+        flash(f'无法读取分类 "{category_name}" 的内容: {e}', 'danger')
+        index = None
+
+    # 2. Pagination
+    total_pages = math.ceil(total_items_count / per_page) if per_page > 0 else 1
+    if page > total_pages and total_pages > 0:
+        page = total_pages
+
+    if index is not None:
+        try:
+            if after is not None or before is not None:
+                catalog_items = catalog.list_items_page(category_name, per_page, after=after, before=before)
+                if before is not None and len(catalog_items) < per_page:
+                    page = 1 # Reached the newest items, show a full first page instead
+                    catalog_items = []
+            if not catalog_items:
+                catalog_items = catalog.list_items_page(category_name, per_page, offset=(page - 1) * per_page)
+        except sqlite3.Error as e:
+            flash(f'无法读取分类 "{category_name}" 的内容: {e}', 'danger')
+            catalog_items = []
+
+    items_on_page = []
+    for catalog_item in catalog_items:
+        if catalog_item['type'] == 'local':
+            filename = catalog_item['id']
+            items_on_page.append({
                 'id': filename, # Use filename as ID for local files
                 'name': filename,
                 'type': 'local',
                 'view_url': url_for('serve_emoticon_file', category_name=category_name, filename=filename),
+                'thumb_url': (url_for('serve_thumbnail', category_name=category_name, filename=filename, v=catalog_item['added_at'])
+                              if imaging.available() else None),
                 'download_url': url_for('download_emoticon', category_name=category_name, filename=filename),
-                'added_at': added_at_iso
+                'added_at': catalog_item['added_at']
+            })
+        else:
+            items_on_page.append({
+                'id': catalog_item['id'],
+                'name': catalog_item['url'], # Display URL as name
+                'type': 'external',
+                'view_url': catalog_item['url'], # For direct linking
+                'added_at': catalog_item['added_at'],
+                'health_status': catalog_item['health_status'],
+                'health_detail': catalog_item['health_detail'],
+                'health_failures': catalog_item['health_failures'] or 0,
+                'health_checked_at': catalog_item['health_checked_at']
+                # 'download_url' is not applicable for external links in the same way
             })
-    except OSError as e:
-        flash(f'无法读取分类 "{category_name}" 的本地图片内容: {e}', 'danger')
-
-    # 2. Load external links
-    external_links = load_external_links(category_name)
-    for link in external_links:
-        all_items.append({
-            'id': link['id'], # Use the ID from external_links.json
-            'name': link['url'], # Display URL as name
-            'type': 'external',
-            'view_url': link['url'], # For direct linking
-            'added_at': link.get('added_at', datetime.datetime.min.isoformat() + "Z") # Ensure added_at exists
-            # 'download_url' is not applicable for external links in the same way
-        })
-
-    # 3. Sort all items by 'added_at' in descending order (newest first)
-    all_items.sort(key=lambda x: x['added_at'], reverse=True)
 
-    # 4. Pagination
-    total_items_count = len(all_items)
-    total_pages = math.ceil(total_items_count / per_page) if per_page > 0 else 1
-    if page > total_pages and total_pages > 0:
-        page = total_pages
+    prev_cursor = encode_listing_cursor(catalog_items[0]) if catalog_items and page > 1 else None
+    next_cursor = encode_listing_cursor(catalog_items[-1]) if catalog_items and page < total_pages else None
 
-    start_index = (page - 1) * per_page
-    end_index = start_index + per_page
-    items_on_page = all_items[start_index:end_index]
-
-    # 5. Get all category names for dropdown
+    # 3. Get all category names for dropdown
     all_categories_list = []
-    emoticons_dir = app.config['EMOTICONS_FOLDER']
     try:
-        all_categories_list = sorted([d for d in os.listdir(emoticons_dir) if os.path.isdir(os.path.join(emoticons_dir, d))])
+        all_categories_list = get_category_list()
     except OSError as e:
-        app.logger.warning(f'Could not list directories in {emoticons_dir}: {e}')
+        app.logger.warning(f"Could not list directories in {app.config['EMOTICONS_FOLDER']}: {e}")
 
     return render_template('category_view.html',
                            category_name=category_name,
@@ -400,7 +3217,11 @@ def view_category(category_name):
                            page=page,
                            per_page=per_page,
                            total_items=total_items_count, # Changed from 'total_images'
+                           dead_link_count=index.dead_link_count if index is not None else 0,
+                           link_check_enabled=app.config['LINK_CHECK_INTERVAL'] > 0,
                            total_pages=total_pages,
+                           prev_cursor=prev_cursor,
+                           next_cursor=next_cursor,
                            allowed_per_page_values=ALLOWED_PER_PAGE)
 
 def allowed_file(filename):
@@ -446,8 +3267,32 @@ def upload_file():
 
         new_filename = f"{safe_filename_base}_{timestamp}{safe_extension}"
         save_path = os.path.join(category_path, new_filename)
-        file.save(save_path)
-
+        dir_mtime_before = _stat_mtime_ns(category_path)
+        with open(save_path, 'wb') as f:
+            sha256 = copy_stream_hashed(functools.partial(file.stream.read, 64 * 1024), f)
+            stored_bytes = f.tell()
+        kept, duplicate_of = store_deduplicated(category_name_raw, new_filename, sha256, dir_mtime_before)
+        import_items.inc('upload', 'success' if kept else 'duplicate')
+        if not kept:
+            return jsonify(
+                status='duplicate',
+                message=f"文件 '{original_full_filename}' 与已有文件 {duplicate_of['category']}/{duplicate_of['filename']} 内容相同，未保存",
+                filename=original_full_filename,
+                duplicate_of=duplicate_of
+            ), 409
+        import_bytes.inc('upload', amount=stored_bytes)
+        invalidate_category_index(category_name_raw)
+        schedule_thumbnail(category_name_raw, new_filename)
+        schedule_variants(category_name_raw, new_filename)
+
+        if duplicate_of:
+            return jsonify(
+                status='success',
+                message=f"文件 '{original_full_filename}' 成功上传为 '{new_filename}'（与 {duplicate_of['category']}/{duplicate_of['filename']} 内容相同，已作为硬链接保存）",
+                original_filename=original_full_filename,
+                new_filename=new_filename,
+                duplicate_of=duplicate_of
+            )
         return jsonify(
             status='success',
             message=f"文件 '{original_full_filename}' 成功上传为 '{new_filename}'",
@@ -457,8 +3302,43 @@ def upload_file():
 
     except Exception as e:
         app.logger.error(f"Error saving file {original_full_filename}: {e}")
+        import_items.inc('upload', 'error')
         return jsonify(status='error', message=f'保存文件时出错: {e}', filename=original_full_filename), 500
 
+@app.route('/admin/upload_archive', methods=['POST'])
+@login_required
+def upload_archive():
+    """Extracts the images of a zip/tar archive into a category in one request."""
+    category_name_raw = request.form.get('category', '')
+    archive = request.files.get('archive')
+    archive_filename = archive.filename if archive else ''
+
+    if not is_valid_category_name(category_name_raw):
+        return jsonify(status='error', message='无效的分类名称', filename=archive_filename), 400
+    if not archive or archive_filename == '':
+        return jsonify(status='error', message='缺少压缩包', filename=archive_filename), 400
+    if not os.path.isdir(os.path.join(app.config['EMOTICONS_FOLDER'], category_name_raw)):
+        return jsonify(status='error', message=f'分类 "{category_name_raw}" 不存在', filename=archive_filename), 400
+
+    results = import_archive(archive.stream, category_name_raw)
+    counts = collections.Counter(result['status'] for result in results)
+    stored_count = counts['success']
+    app.logger.info(f"Archive {archive_filename} -> {category_name_raw}: {dict(counts)}")
+
+    message = (f"压缩包 '{archive_filename}' 处理完毕：成功 {stored_count} 个，重复 {counts['duplicate']} 个，"
+               f"跳过 {counts['skipped']} 个，出错 {counts['error']} 个。")
+    if stored_count and stored_count == len(results):
+        status = 'success'
+    elif stored_count:
+        status = 'partial_success'
+    elif counts['error'] and not counts['duplicate']:
+        status = 'error'
+    else:
+        status = 'warning'
+    return jsonify(status=status, message=message, filename=archive_filename,
+                   counts={key: counts[key] for key in ('success', 'duplicate', 'skipped', 'error')},
+                   results=results)
+
 @app.route('/admin/initiate_url_download_task', methods=['POST'])
 @login_required
 def initiate_url_download_task():
@@ -485,12 +3365,16 @@ def initiate_url_download_task():
             return jsonify(status='error', message=f'分类 "{category_name_raw}" 不存在。'), 404
 
         task_id = str(uuid.uuid4())
-        url_processing_tasks[task_id] = {
+        removed_count = task_store.cleanup_expired()
+        if removed_count:
+            app.logger.info(f"Removed {removed_count} expired URL import tasks.")
+        task_store.create(task_id, {
             'category': category_name_raw,
             'urls': [url.strip() for url in urls], # Store cleaned URLs
             'status': 'pending',
             'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat()
-        }
+        })
+        start_import_task(task_id, category_name_raw, [url.strip() for url in urls])
         app.logger.info(f"Task {task_id} initiated for category '{category_name_raw}' with {len(urls)} URLs.")
         return jsonify({'task_id': task_id, 'status': 'Task initiated successfully'}), 202
     except Exception as e:
@@ -507,161 +3391,68 @@ def stream_url_download_progress(): # New function name
             yield f"event: error\ndata: {json.dumps({'message': '错误：缺少任务ID。'})}\n\n"
         return Response(error_stream_no_task_id(), mimetype='text/event-stream')
 
-    task_data = url_processing_tasks.get(task_id)
+    task_data = task_store.get(task_id)
     if not task_data:
         app.logger.error(f"SSE stream: Task ID '{task_id}' not found or expired.")
         def error_stream_invalid_task_id():
             yield f"event: error\ndata: {json.dumps({'message': '错误：无效或已过期的任务ID。'})}\n\n"
         return Response(error_stream_invalid_task_id(), mimetype='text/event-stream')
 
-    category_name_raw = task_data['category']
-    image_urls = task_data['urls']
-    category_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name_raw)
+    # EventSource sends Last-Event-ID when it reconnects, resume right after that event
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_event_id = 0
 
     def generate_events_for_task():
         HEARTBEAT_INTERVAL = 20  # seconds
-        last_event_or_heartbeat_time = datetime.datetime.now()
-
-        # Helper to manage yielding events and updating the last event time
-        def yield_event_with_tracking(event_data_str):
-            nonlocal last_event_or_heartbeat_time
-            yield event_data_str
-            last_event_or_heartbeat_time = datetime.datetime.now()
-
-        # Helper to try sending a heartbeat if the interval has passed
-        def try_send_heartbeat_if_needed():
-            nonlocal last_event_or_heartbeat_time
-            now = datetime.datetime.now()
-            if (now - last_event_or_heartbeat_time).total_seconds() >= HEARTBEAT_INTERVAL:
-                app.logger.debug(f"[Task {task_id}] Sending heartbeat.")
-                # Use yield from with the tracking helper
-                yield from yield_event_with_tracking(f"event: heartbeat\ndata: {json.dumps({'timestamp': now.isoformat()})}\n\n")
-        
-        app.logger.info(f"SSE stream starting for task_id: {task_id} (Category: {category_name_raw}, URLs: {len(image_urls)})")
-        yield from yield_event_with_tracking(f"event: message\ndata: {json.dumps({'type': 'info', 'message': f'开始处理任务 {task_id}，共 {len(image_urls)} 个 URL...'})}\n\n")
-        
-        processed_count = 0
-        for index, image_url in enumerate(image_urls):
-            for _ in try_send_heartbeat_if_needed(): yield _ # Check before each item
-
-            progress_item_id = f"task-{task_id}-item-{index}"
-            app.logger.info(f"[Task {task_id} - Item {progress_item_id}] 处理 URL: {image_url}")
-            yield from yield_event_with_tracking(f"event: progress\ndata: {json.dumps({'id': progress_item_id, 'url': image_url, 'status': '准备中', 'progress': 0})}\n\n")
-            
-            MAX_RETRIES = 3
-            CONNECT_TIMEOUT = 5
-            READ_TIMEOUT = 15
-
-            success = False
-            last_exception_message = "未知错误"
-            item_timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
-
-            for attempt in range(MAX_RETRIES):
-                for _ in try_send_heartbeat_if_needed(): yield _ # Check before each attempt
-                try:
-                    app.logger.info(f"[Task {task_id} - Item {progress_item_id}] Attempt {attempt + 1}/{MAX_RETRIES} for URL: {image_url}")
-                    
-                    parsed_url = urlparse(image_url)
-                    if not all([parsed_url.scheme, parsed_url.netloc]) or parsed_url.scheme not in ('http', 'https'):
-                        raise ValueError("无效的 URL 格式或协议")
-                    clean_url = urlunparse((parsed_url.scheme, parsed_url.netloc, parsed_url.path, parsed_url.params, parsed_url.query, ''))
-                    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'}
-
-                    response = requests.get(clean_url, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), headers=headers)
-                    response.raise_for_status()
-                    
-                    content_type = response.headers.get('content-type')
-                    content_type_main = content_type.split(';')[0].strip().lower() if content_type else ''
-                    if content_type_main not in ('image/jpeg', 'image/png', 'image/gif'):
-                        raise ValueError(f'不支持的内容类型: {content_type_main or "未知"}')
-
-                    file_extension = mimetypes.guess_extension(content_type_main)
-                    if not file_extension or file_extension.lstrip('.').lower() not in ALLOWED_EXTENSIONS:
-                        _, ext_from_url = os.path.splitext(os.path.basename(parsed_url.path))
-                        if ext_from_url and ext_from_url.lstrip('.').lower() in ALLOWED_EXTENSIONS:
-                            file_extension = ext_from_url
-                        else:
-                            raise ValueError('无法确定有效扩展名')
-                    
-                    original_filename = os.path.basename(parsed_url.path) or "image"
-                    filename_base, _ = os.path.splitext(original_filename)
-                    safe_filename_base = secure_filename(filename_base)
-                    if not safe_filename_base: safe_filename_base = "image"
-                    
-                    safe_extension = file_extension.lower()
-                    if not safe_extension.startswith('.'): safe_extension = '.' + safe_extension
-                    new_filename = f"{safe_filename_base}_{item_timestamp}{safe_extension}"
-                    save_path = os.path.join(category_path, new_filename)
-                    
-                    total_size_str = response.headers.get('content-length')
-                    total_size = int(total_size_str) if total_size_str and total_size_str.isdigit() else None
-                    
-                    downloaded_size = 0
-                    last_progress_yield_time = datetime.datetime.now()
-
-                    yield from yield_event_with_tracking(f"event: progress\ndata: {json.dumps({'id': progress_item_id, 'url': image_url, 'status': f'下载中 (尝试 {attempt + 1})', 'progress': 0, 'downloaded': 0, 'total': total_size})}\n\n")
-
-                    with open(save_path, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                                downloaded_size += len(chunk)
-                                now_chunk_time = datetime.datetime.now()
-                                # Heartbeat check during long download chunk loop
-                                for _ in try_send_heartbeat_if_needed(): yield _
-
-                                if (now_chunk_time - last_progress_yield_time).total_seconds() > 0.2 or \
-                                   (total_size is not None and downloaded_size == total_size) or \
-                                   (total_size is None and (now_chunk_time - last_progress_yield_time).total_seconds() > 1):
-                                    progress_percent = -1
-                                    if total_size is not None and total_size > 0:
-                                        progress_percent = round((downloaded_size / total_size) * 100)
-                                    
-                                    yield from yield_event_with_tracking(f"event: progress\ndata: {json.dumps({'id': progress_item_id, 'url': image_url, 'status': f'下载中 (尝试 {attempt + 1})', 'progress': progress_percent, 'downloaded': downloaded_size, 'total': total_size})}\n\n")
-                                    last_progress_yield_time = now_chunk_time
-                    
-                    app.logger.info(f"[Task {task_id} - Item {progress_item_id}] Attempt {attempt + 1} Succeeded. Saved as: {new_filename}")
-                    yield from yield_event_with_tracking(f"event: progress\ndata: {json.dumps({'id': progress_item_id, 'url': image_url, 'status': '完成', 'progress': 100, 'new_filename': new_filename, 'message': '上传成功'})}\n\n")
-                    success = True
-                    processed_count +=1
-                    break
-
-                except requests.exceptions.Timeout as e_timeout:
-                    last_exception_message = f'下载超时 (尝试 {attempt + 1}/{MAX_RETRIES})'
-                    app.logger.warning(f"[Task {task_id} - Item {progress_item_id}] {last_exception_message}: {e_timeout}")
-                    if attempt < MAX_RETRIES - 1:
-                        yield from yield_event_with_tracking(f"event: progress\ndata: {json.dumps({'id': progress_item_id, 'url': image_url, 'status': f'超时，重试中... ({attempt + 2}/{MAX_RETRIES})', 'progress': 0, 'message': last_exception_message})}\n\n")
-                        time.sleep(1)
-                    
-                except requests.exceptions.RequestException as e_req:
-                    last_exception_message = f'网络错误 (尝试 {attempt + 1}/{MAX_RETRIES})'
-                    app.logger.warning(f"[Task {task_id} - Item {progress_item_id}] {last_exception_message}: {e_req}")
-                    if attempt < MAX_RETRIES - 1:
-                         yield from yield_event_with_tracking(f"event: progress\ndata: {json.dumps({'id': progress_item_id, 'url': image_url, 'status': f'网络错误，重试中... ({attempt + 2}/{MAX_RETRIES})', 'progress': 0, 'message': last_exception_message})}\n\n")
-                         time.sleep(1)
-
-                except (IOError, ValueError, Exception) as e_proc:
-                    last_exception_message = f'处理失败: {str(e_proc)}'
-                    app.logger.warning(f"[Task {task_id} - Item {progress_item_id}] {last_exception_message}", exc_info=True)
-                    success = False
-                    break
-
-            if not success:
-                app.logger.error(f"[Task {task_id} - Item {progress_item_id}] URL {image_url} failed. Last error: {last_exception_message}")
-                yield from yield_event_with_tracking(f"event: progress\ndata: {json.dumps({'id': progress_item_id, 'url': image_url, 'status': '错误', 'progress': 0, 'message': last_exception_message})}\n\n")
-            
-            for _ in try_send_heartbeat_if_needed(): yield _ # Check after each item
-
-        app.logger.info(f"[Task {task_id}] 所有 URL 处理完毕. Processed: {processed_count}/{len(image_urls)}")
-        yield from yield_event_with_tracking(f"event: end\ndata: {json.dumps({'message': f'任务 {task_id} 处理完毕。成功处理 {processed_count} / {len(image_urls)} 个 URL。'})}\n\n")
-        
-        for _ in try_send_heartbeat_if_needed(): yield _ # Final check
+        POLL_INTERVAL = 0.5  # seconds between task store reads
+        after_event_id = last_event_id
+        last_sent_time = time.monotonic()
+
+        app.logger.info(f"SSE stream starting for task_id: {task_id} (resuming after event {after_event_id})")
+        yield "retry: 3000\n\n"
+        while True:
+            events = task_store.get_events(task_id, after_event_id)
+            for event_id, event_name, payload in events:
+                yield f"id: {event_id}\nevent: {event_name}\ndata: {json.dumps(payload)}\n\n"
+                after_event_id = event_id
+                last_sent_time = time.monotonic()
+                if event_name in ('end', 'error'):
+                    app.logger.info(f"[Task {task_id}] SSE stream finished.")
+                    return
+            if not events:
+                task = task_store.get(task_id)
+                if task is None:
+                    yield f"event: error\ndata: {json.dumps({'message': '错误：无效或已过期的任务ID。'})}\n\n"
+                    return
+                if task['status'] in ('completed', 'failed'):
+                    # Reconnected after the 'end' or 'error' event was already delivered
+                    return
+                if fail_orphaned_task(task_id, task)['status'] == 'failed':
+                    continue # send the 'error' event just recorded for it
+                if time.monotonic() - last_sent_time >= HEARTBEAT_INTERVAL:
+                    app.logger.debug(f"[Task {task_id}] Sending heartbeat.")
+                    yield f"event: heartbeat\ndata: {json.dumps({'timestamp': datetime.datetime.now().isoformat()})}\n\n"
+                    last_sent_time = time.monotonic()
+                time.sleep(POLL_INTERVAL)
 
-        if task_id in url_processing_tasks:
-            del url_processing_tasks[task_id]
-            app.logger.info(f"Task {task_id} data removed from memory.")
-    
     return Response(generate_events_for_task(), mimetype='text/event-stream')
+
+@app.route('/admin/url_download_task/<task_id>')
+@login_required
+def url_download_task_status(task_id):
+    """Status of a URL import task, including the per-URL result once it has finished."""
+    task_data = task_store.get(task_id)
+    if not task_data:
+        return jsonify(status='error', message='无效或已过期的任务ID。'), 404
+    task_data = fail_orphaned_task(task_id, task_data)
+    return jsonify(task_id=task_id,
+                   category=task_data['category'],
+                   task_status=task_data['status'],
+                   created_at=task_data['created_at'],
+                   total=len(task_data['urls']),
+                   result=task_data.get('result'))
 @app.route('/admin/category/<path:category_name>/add_external_links', methods=['POST'])
 @login_required
 def add_external_links(category_name):
@@ -684,10 +3475,13 @@ def add_external_links(category_name):
         # This case might be redundant if urls_text.strip() is empty, but good for clarity
         return jsonify(status='error', message='未提供任何有效的 URL'), 400
 
-    external_links = load_external_links(category_name)
+    new_links = []
     new_links_added_count = 0
     processed_urls_messages = [] # To provide feedback for each URL
 
+    # First pass: validate and normalize, so duplicates can be resolved with set lookups.
+    # Messages for valid URLs are filled in by the second pass at the same position.
+    candidates = [] # (message position, url, normalized key)
     for url_to_add in image_urls:
         try:
             parsed_url = urlparse(url_to_add)
@@ -695,20 +3489,23 @@ def add_external_links(category_name):
                 app.logger.warning(f"无效的 URL 格式或协议: {url_to_add} (分类: {category_name})")
                 processed_urls_messages.append({'url': url_to_add, 'status': 'error', 'message': '无效的URL格式或协议'})
                 continue 
+            candidates.append((len(processed_urls_messages), url_to_add, normalize_url(url_to_add)))
+            processed_urls_messages.append(None)
         except ValueError: 
             app.logger.warning(f"解析URL时出错: {url_to_add} (分类: {category_name})")
             processed_urls_messages.append({'url': url_to_add, 'status': 'error', 'message': '解析URL时出错'})
-            continue
 
-        is_duplicate = False
-        for existing_link in external_links:
-            if existing_link.get('url') == url_to_add:
-                is_duplicate = True
-                app.logger.info(f"跳过重复的 URL: {url_to_add} (分类: {category_name})")
-                processed_urls_messages.append({'url': url_to_add, 'status': 'skipped', 'message': '重复的URL'})
-                break
-        
-        if is_duplicate:
+    try:
+        existing_keys = catalog.existing_url_keys(category_name, {key for _, _, key in candidates})
+    except sqlite3.Error as e:
+        app.logger.error(f"Error checking existing external links for {category_name}: {e}")
+        return jsonify(status='error', message='检查已有外部链接时出错'), 500
+
+    seen_keys = set(existing_keys) # grows with URLs accepted earlier in this same request
+    for message_position, url_to_add, key in candidates:
+        if key in seen_keys:
+            app.logger.info(f"跳过重复的 URL: {url_to_add} (分类: {category_name})")
+            processed_urls_messages[message_position] = {'url': url_to_add, 'status': 'skipped', 'message': '重复的URL'}
             continue
 
         new_link = {
@@ -717,21 +3514,18 @@ def add_external_links(category_name):
             'type': 'external',
             'added_at': datetime.datetime.now(datetime.timezone.utc).isoformat()
         }
-        external_links.append(new_link)
+        new_links.append(new_link)
+        seen_keys.add(key)
         new_links_added_count += 1
-        processed_urls_messages.append({'url': url_to_add, 'status': 'success', 'message': '添加成功'})
+        processed_urls_messages[message_position] = {'url': url_to_add, 'status': 'success', 'message': '添加成功'}
     
     if new_links_added_count > 0:
-        if not save_external_links(category_name, external_links):
+        try:
+            catalog.add_external_links(category_name, new_links)
+        except sqlite3.Error as e:
+            app.logger.error(f"Error saving external links for {category_name}: {e}")
             return jsonify(status='error', message='保存外部链接时出错', details=processed_urls_messages), 500
-        
-        # Check if all processed URLs resulted in a successful addition
-        all_successful_adds = True
-        for detail in processed_urls_messages:
-            if detail['url'] in image_urls and detail['status'] != 'success':
-                 # This check is a bit complex because processed_urls_messages also contains skipped/error messages
-                 # A simpler check might be if new_links_added_count == len(image_urls) (assuming no invalid format errors before duplicate check)
-                 pass # For now, we rely on new_links_added_count vs image_urls length
+        invalidate_category_index(category_name)
 
         if new_links_added_count == len(image_urls): # Ideal case: all provided URLs were new and valid
              return jsonify(status='success', message=f'成功添加 {new_links_added_count} 个外部链接到分类 "{category_name}"。', details=processed_urls_messages)
@@ -768,120 +3562,493 @@ def serve_emoticon_file(category_name, filename):
         app.logger.warning(f"Emoticon file not found: {file_path}")
         abort(404)
     
-    return send_from_directory(category_path, safe_filename)
+    return send_local_image(category_name, safe_filename)
 
-@app.route('/<path:category_name>')
-def serve_random_emoticon(category_name):
+@app.route('/thumbnails/<path:category_name>/<path:filename>')
+@login_required
+def serve_thumbnail(category_name, filename):
+    """WebP thumbnail of a local image; falls back to the original if it cannot be rendered."""
     if not is_valid_category_name(category_name):
         abort(404)
+    safe_filename = secure_filename(filename)
+    if not safe_filename or safe_filename != filename:
+        abort(404)
 
-    category_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name)
-    if not os.path.isdir(category_path):
+    source_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name, safe_filename)
+    if not os.path.isfile(source_path):
         abort(404)
 
-    all_available_items = []
+    target_path = thumbnail_path(category_name, safe_filename)
+    if not thumbnail_is_fresh(source_path, target_path):
+        # Not rendered yet (e.g. before a backfill): queue it, and unless it is done within a few
+        # hundred ms, send the original now and leave the render running for the next page load
+        future = schedule_thumbnail(category_name, safe_filename)
+        rendered = False
+        if future is not None:
+            try:
+                rendered = future.result(timeout=app.config['THUMBNAIL_RENDER_TIMEOUT'])
+            except concurrent.futures.TimeoutError:
+                app.logger.debug(f"Thumbnail of {category_name}/{safe_filename} still rendering, sending the original")
+            except concurrent.futures.process.BrokenProcessPool as e:
+                app.logger.warning(f"Thumbnail pool broken while rendering {category_name}/{safe_filename}: {e}")
+                reset_thumbnail_pool()
+        if not rendered:
+            response = redirect(url_for('serve_emoticon_file', category_name=category_name, filename=safe_filename))
+            response.headers['Cache-Control'] = 'no-store' # the thumbnail URL serves the WebP once it exists
+            return response
+
+    # Thumbnail URLs carry a version of the original (?v=added_at), so they can be cached for long
+    response = send_file(target_path, mimetype='image/webp', max_age=365 * 24 * 3600)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+def send_cached_proxy_response(link_id, meta, cache_status):
+    """Sends a proxied external image from the proxy cache."""
+    response = send_file(proxy_cache.data_path(link_id), mimetype=meta.get('content_type') or 'application/octet-stream')
+    response.headers['X-Proxy-Cache'] = cache_status
+    return response
+
+@app.route('/admin/proxy_cache_stats')
+@login_required
+def proxy_cache_stats():
+    """Hit/miss counters and disk usage of the proxy content cache, for operators."""
+    return jsonify(proxy_cache.snapshot())
 
-    # 1. Load local images
-    try:
-        local_image_files = [f for f in os.listdir(category_path)
-                             if os.path.isfile(os.path.join(category_path, f)) and allowed_file(f)]
-        for filename in local_image_files:
-            all_available_items.append({
-                'id': filename, # Use filename as ID
-                'type': 'local',
-                'path': category_path, # Store path for send_from_directory
-                'filename': filename
-            })
-    except OSError:
-        # If error reading local files, we might still serve external links
-        app.logger.error(f"Error reading local files for category {category_name} in serve_random_emoticon")
+# --- Request Metrics ---
 
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
 
-    # 2. Load external links
-    external_links = load_external_links(category_name)
-    for link in external_links:
-        all_available_items.append({
-            'id': link['id'], # Use the ID from external_links.json
-            'type': 'external',
-            'url': link['url']
-        })
+def count_streamed_bytes(body, endpoint):
+    """Passes a streamed body through, counting its bytes as they are sent."""
+    try:
+        for chunk in body:
+            http_response_bytes.inc(endpoint, amount=len(chunk))
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+@app.after_request
+def record_request_metrics(response):
+    started_at = g.pop('request_started_at', None)
+    if started_at is None or ASYNC_PROXY_LINK_HEADER in response.headers:
+        return response # handed to asgi.py, which records the request once the body is sent
+    endpoint = request.endpoint or 'unmatched'
+    http_request_seconds.observe(time.perf_counter() - started_at, endpoint)
+    http_requests.inc(endpoint, request.method, str(response.status_code))
+    if request.method != 'HEAD':
+        if response.content_length is not None:
+            http_response_bytes.inc(endpoint, amount=response.content_length)
+        elif response.is_streamed:
+            response.response = count_streamed_bytes(response.response, endpoint)
+    return response
+
+def import_engine_jobs():
+    with import_engine.condition:
+        return {('queued',): sum(len(jobs) for jobs in import_engine.host_queues.values()),
+                ('running',): sum(import_engine.host_active.values())}
+
+def proxy_cache_events():
+    snapshot = proxy_cache.snapshot()
+    return {(event,): snapshot[event] for event in ProxyCache.STAT_NAMES}
+
+CallbackMetric(metrics, 'bqb_import_jobs', 'URL import jobs, by state (queued, running).', import_engine_jobs, ('state',))
+CallbackMetric(metrics, 'bqb_proxy_cache_bytes', 'Bytes stored in the proxy content cache.',
+               lambda: proxy_cache.snapshot()['total_bytes'], shared=True)
+CallbackMetric(metrics, 'bqb_proxy_cache_entries', 'Entries in the proxy content cache.',
+               lambda: proxy_cache.snapshot()['entries'], shared=True)
+CallbackMetric(metrics, 'bqb_proxy_cache_events_total', 'Proxy content cache lookups and writes, by event.',
+               proxy_cache_events, ('event',), metric_type='counter', shared=True)
+CallbackMetric(metrics, 'bqb_client_state_entries', 'Random endpoint client states kept by the client state store.',
+               lambda: len(client_state), shared=isinstance(client_state, SQLiteClientStateStore))
+CallbackMetric(metrics, 'bqb_category_indexes_cached', 'Category item indexes held in memory.', lambda: len(category_index_cache))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of this process's metrics."""
+    token = app.config['METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    if 'logged_in' not in session and not (token and secrets.compare_digest(authorization.encode('utf-8'), f'Bearer {token}'.encode('utf-8'))):
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# --- End Request Metrics ---
+
+# --- Request Profiler ---
+# cProfile capture of single requests, written to PROFILE_FOLDER as a .pstats file (readable by
+# pstats, snakeviz, flameprof, ...) plus a .json with the request details. The middleware is only
+# installed when PROFILE_SAMPLE_RATE or PROFILE_HEADER is set, otherwise requests never pass through it.
+
+PROFILE_REQUEST_HEADER = 'HTTP_X_PROFILE_REQUEST' # X-Profile-Request, as found in the WSGI environ
+PROFILE_ID_RE = re.compile(r'^\d{8}-\d{6}-[0-9a-f]{8}$')
+PROFILE_SORT_KEYS = ('cumulative', 'tottime', 'calls')
+# One capture at a time per process: on Python 3.12+ cProfile sees every thread, not just its own
+profile_lock = threading.Lock()
+
+class ProfiledResponse:
+    """
+    Response iterable that turns the profiler on while each chunk is produced, so the time spent
+    in streamed generators (the SSE progress stream, zip exports) is captured, but not the time
+    spent waiting on the client between chunks. finish runs once, when the server closes it.
+    """
+
+    def __init__(self, app_iter, profiler, finish):
+        self.app_iter = app_iter
+        self.profiler = profiler
+        self.finish = finish
+
+    def __iter__(self):
+        iterator = iter(self.app_iter)
+        while True:
+            self.profiler.enable()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.profiler.disable()
+            yield chunk
+
+    def close(self):
+        if self.finish is None:
+            return
+        finish, self.finish = self.finish, None
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.profiler.enable()
+                try:
+                    self.app_iter.close()
+                finally:
+                    self.profiler.disable()
+        finally:
+            finish()
+
+class RequestProfiler:
+    """WSGI middleware profiling a sampled fraction of requests, and those an admin asks for by header."""
+
+    def __init__(self, wsgi_app, flask_app):
+        self.wsgi_app = wsgi_app
+        self.flask_app = flask_app
+
+    def profile_reason(self, environ):
+        config = self.flask_app.config
+        if config['PROFILE_HEADER'] and environ.get(PROFILE_REQUEST_HEADER) == '1':
+            with self.flask_app.request_context(environ): # only to read the session cookie
+                if 'logged_in' in session:
+                    return 'header'
+        if config['PROFILE_SAMPLE_RATE'] > 0 and random.random() < config['PROFILE_SAMPLE_RATE']:
+            return 'sampled'
+        return None
+
+    def endpoint_for(self, environ):
+        try:
+            return self.flask_app.url_map.bind_to_environ(environ).match()[0]
+        except HTTPException:
+            return None
 
-    if not all_available_items:
-        abort(404) # No local images and no external links
+    def __call__(self, environ, start_response):
+        reason = self.profile_reason(environ)
+        if reason is None or not profile_lock.acquire(blocking=False):
+            return self.wsgi_app(environ, start_response)
 
-    last_shown_map = session.get('last_shown_v2', {}) # Use a new session key to avoid conflict with old format
-    last_shown_item_info = last_shown_map.get(category_name) # This will be a dict {'id': ..., 'type': ...} or None
-
-    eligible_items = all_available_items
-    if last_shown_item_info and len(all_available_items) > 1:
-        # Filter out the last shown item based on its id and type
-        possible_items = [
-            item for item in all_available_items
-            if not (item['id'] == last_shown_item_info['id'] and item['type'] == last_shown_item_info['type'])
-        ]
-        if possible_items:
-            eligible_items = possible_items
-    
-    if not eligible_items: # Should only happen if all_available_items had only 1 item, and it was last_shown
-        eligible_items = all_available_items # Fallback to serving any item if filtering left none
+        profiler = cProfile.Profile()
+        started_at = datetime.datetime.now(datetime.timezone.utc)
+        started = time.perf_counter()
+        statuses = []
 
-    chosen_item = random.choice(eligible_items)
+        def recording_start_response(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
 
-    # Update session with the new last shown item's id and type
-    last_shown_map[category_name] = {'id': chosen_item['id'], 'type': chosen_item['type']}
-    session['last_shown_v2'] = last_shown_map
-    session.modified = True
+        def finish():
+            try:
+                save_request_profile(profiler, {
+                    'id': f"{started_at.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(4)}",
+                    'started_at': started_at.isoformat(),
+                    'method': environ.get('REQUEST_METHOD'),
+                    'path': environ.get('PATH_INFO'),
+                    'query': environ.get('QUERY_STRING', ''),
+                    'endpoint': self.endpoint_for(environ),
+                    'status': int(statuses[-1].split(' ', 1)[0]) if statuses else None,
+                    'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+                    'reason': reason,
+                })
+            except OSError as e:
+                app.logger.warning(f"Could not save request profile: {e}")
+            finally:
+                profile_lock.release()
 
-    if chosen_item['type'] == 'local':
-        return send_from_directory(chosen_item['path'], chosen_item['filename'])
-    elif chosen_item['type'] == 'external':
-        external_url = chosen_item['url']
-        parsed_url = urlparse(external_url)
+        try:
+            profiler.enable()
+        except ValueError as e: # another profiler (a debugger, a coverage tool) is active
+            profile_lock.release()
+            app.logger.warning(f"Request profiling skipped: {e}")
+            return self.wsgi_app(environ, start_response)
+        try:
+            app_iter = self.wsgi_app(environ, recording_start_response)
+        except BaseException:
+            profiler.disable()
+            profile_lock.release()
+            raise
+        profiler.disable()
+        return ProfiledResponse(app_iter, profiler, finish)
+
+def list_request_profiles():
+    """Details of the captured profiles, slowest first."""
+    folder = app.config['PROFILE_FOLDER']
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(folder, name), 'r', encoding='utf-8') as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue # being written or pruned by another worker
+    profiles.sort(key=lambda profile: profile['duration_ms'], reverse=True)
+    return profiles
+
+def remove_request_profile(profile_id):
+    for extension in ('.json', '.pstats'):
+        try:
+            os.remove(os.path.join(app.config['PROFILE_FOLDER'], profile_id + extension))
+        except OSError:
+            pass
+
+def save_request_profile(profiler, details):
+    """Writes a capture and drops the fastest ones beyond PROFILE_MAX_FILES."""
+    folder = app.config['PROFILE_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    profiler.dump_stats(os.path.join(folder, details['id'] + '.pstats'))
+    # The .json is what the admin page lists, it only appears once the .pstats is complete
+    temp_path = os.path.join(folder, f"{details['id']}.json.tmp")
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(details, f)
+    os.replace(temp_path, os.path.join(folder, details['id'] + '.json'))
+    for profile in list_request_profiles()[app.config['PROFILE_MAX_FILES']:]:
+        remove_request_profile(profile['id'])
+
+def request_profile_summary(profile_id, sort_key):
+    """pstats report of the functions with the most time, as text."""
+    output = io.StringIO()
+    stats = pstats.Stats(os.path.join(app.config['PROFILE_FOLDER'], profile_id + '.pstats'), stream=output)
+    stats.strip_dirs().sort_stats(sort_key).print_stats(50)
+    return output.getvalue()
+
+@app.route('/admin/profiles')
+@app.route('/admin/profiles/<profile_id>')
+@login_required
+def request_profiles(profile_id=None):
+    """Captured request profiles, slowest first, with the pstats report of the selected one."""
+    selected = summary = None
+    sort_key = request.args.get('sort', 'cumulative')
+    if sort_key not in PROFILE_SORT_KEYS:
+        sort_key = 'cumulative'
+    profiles = list_request_profiles()
+    if profile_id is not None:
+        selected = next((profile for profile in profiles if profile['id'] == profile_id), None)
+        if selected is None:
+            flash('性能分析记录不存在或已被清理。', 'warning')
+            return redirect(url_for('request_profiles'))
+        try:
+            summary = request_profile_summary(profile_id, sort_key)
+        except (OSError, EOFError, ValueError) as e:
+            app.logger.warning(f"Could not read request profile {profile_id}: {e}")
+            summary = f'无法读取分析数据: {e}'
+    return render_template('profiles.html', profiles=profiles, selected=selected, summary=summary,
+                           sort_key=sort_key, sort_keys=PROFILE_SORT_KEYS,
+                           sample_rate=app.config['PROFILE_SAMPLE_RATE'], header_enabled=app.config['PROFILE_HEADER'])
+
+@app.route('/admin/profiles/<profile_id>/download')
+@login_required
+def download_request_profile(profile_id):
+    if not PROFILE_ID_RE.match(profile_id):
+        abort(404)
+    return send_from_directory(app.config['PROFILE_FOLDER'], profile_id + '.pstats', as_attachment=True,
+                               mimetype='application/octet-stream')
 
-        if not (parsed_url.scheme in ['http', 'https'] and parsed_url.netloc):
-            app.logger.error(f"serve_random_emoticon: Malformed external URL in database for proxy: {external_url}")
-            # If the URL stored is fundamentally malformed, it's an internal data issue.
-            abort(500)
+if app.config['PROFILE_SAMPLE_RATE'] > 0 or app.config['PROFILE_HEADER']:
+    app.wsgi_app = RequestProfiler(app.wsgi_app, app)
 
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.85 Safari/537.36',
-            'Referer': '' # Attempt to send no referrer. Adjust if specific sites require a different strategy.
-        }
-        try:
-            # Using stream=True to handle response efficiently and get headers first
-            proxied_response = requests.get(external_url, headers=headers, timeout=(5, 15), stream=True) # (connect_timeout, read_timeout)
-            proxied_response.raise_for_status()  # Raise an exception for HTTP errors (4xx or 5xx)
+# --- End Request Profiler ---
 
-            content_type_header = proxied_response.headers.get('Content-Type')
-            content_type = content_type_header.lower() if content_type_header else ''
+# Response headers by which proxy_external_link hands an origin fetch to asgi.py (never sent to clients)
+ASYNC_PROXY_LINK_HEADER = 'X-Async-Proxy-Link'
+ASYNC_PROXY_URL_HEADER = 'X-Async-Proxy-Url' # percent-encoded, headers are latin-1
 
-            if not content_type.startswith('image/'):
-                app.logger.warning(f"Proxied URL {external_url} returned non-image content-type: {content_type_header}")
-                abort(415) # Unsupported Media Type
+def proxy_external_link(category_name, link_id, external_url):
+    """Serves an external image through the proxy cache, fetching or revalidating it with the origin as needed."""
+    parsed_url = urlparse(external_url)
 
-            # Stream the content back to the client
-            return Response(proxied_response.iter_content(chunk_size=8192),
+    if not (parsed_url.scheme in ['http', 'https'] and parsed_url.netloc):
+        app.logger.error(f"proxy_external_link: Malformed external URL in database for proxy: {external_url}")
+        # If the URL stored is fundamentally malformed, it's an internal data issue.
+        abort(500)
+
+    cached_meta = proxy_cache.lookup(link_id, external_url)
+    if cached_meta is not None and proxy_cache.is_fresh(cached_meta):
+        proxy_cache.record('hits')
+        return send_cached_proxy_response(link_id, cached_meta, 'HIT')
+
+    if app.config['ASYNC_PROXY']:
+        # asgi.py sees the marker headers and fetches the origin itself, this thread is done
+        response = Response(status=204)
+        response.headers[ASYNC_PROXY_LINK_HEADER] = link_id
+        response.headers[ASYNC_PROXY_URL_HEADER] = quote(external_url, safe='')
+        return response
+
+    headers = {
+        'Referer': '' # Attempt to send no referrer. Adjust if specific sites require a different strategy.
+    }
+    if cached_meta is not None:
+        # Stale entry: let the origin confirm it is unchanged instead of re-sending the bytes
+        headers.update(proxy_cache.conditional_headers(cached_meta))
+    try:
+        # Using stream=True to handle response efficiently and get headers first
+        proxied_response = http_get(external_url, headers=headers, stream=True)
+        if proxied_response.status_code == 304 and cached_meta is not None:
+            proxied_response.close()
+            proxy_cache.record('revalidated')
+            cached_meta = proxy_cache.mark_revalidated(link_id, cached_meta, proxied_response.headers)
+            return send_cached_proxy_response(link_id, cached_meta, 'REVALIDATED')
+        proxied_response.raise_for_status()  # Raise an exception for HTTP errors (4xx or 5xx)
+
+        content_type_header = proxied_response.headers.get('Content-Type')
+        content_type = content_type_header.lower() if content_type_header else ''
+
+        if not content_type.startswith('image/'):
+            app.logger.warning(f"Proxied URL {external_url} returned non-image content-type: {content_type_header}")
+            request_link_check(link_id)
+            proxied_response.close() # Return the connection to the pool without reading the body
+            abort(415) # Unsupported Media Type
+
+        # Stream the content back to the client, keeping a copy in the proxy cache
+        proxy_cache.record('misses')
+        response = Response(proxy_cache.stream_and_store(link_id, external_url, proxied_response),
                             mimetype=content_type_header, # Use original Content-Type header from source
                             status=proxied_response.status_code)
+        response.headers['X-Proxy-Cache'] = 'MISS'
+        return response
+
+    except requests.exceptions.Timeout:
+        request_link_check(link_id)
+        app.logger.error(f"Timeout when proxying external image {external_url} for category {category_name}")
+        abort(504) # Gateway Timeout
+    except requests.exceptions.HTTPError as e:
+        request_link_check(link_id)
+        # Log the error and the status code from the external server
+        app.logger.error(f"HTTP error {e.response.status_code} when proxying {external_url} for {category_name}. Response: {e.response.text[:200]}")
+        # Relay the original error status code if it's a client-side error (e.g. 403, 404 from origin)
+        # For server-side errors from origin (5xx), return 502 Bad Gateway.
+        if 400 <= e.response.status_code < 500:
+             abort(e.response.status_code)
+        else:
+             abort(502) # Bad Gateway
+    except requests.exceptions.RequestException as e:
+        request_link_check(link_id)
+        app.logger.error(f"Network or request error when proxying external image {external_url} for {category_name}: {e}")
+        abort(502)  # Bad Gateway
+    except Exception as e:
+        app.logger.error(f"Unexpected error proxying external image {external_url} for {category_name}: {e}", exc_info=True)
+        abort(500) # Internal Server Error
+
+def media_url_for(category_name, item):
+    """
+    Stable URL of an item's bytes for the redirect mode: /media/<sha256><ext> for local
+    files (hashed on first use if they were added outside the app), /media/link/<id> for external links.
+    """
+    if item['type'] == 'external':
+        return url_for('serve_external_media', link_id=item['id'])
+    filename = item['filename']
+    content_hash = catalog.get_local_file_sha256(category_name, filename)
+    if content_hash is None:
+        content_hash = hash_file(os.path.join(app.config['EMOTICONS_FOLDER'], category_name, filename))
+        catalog.set_local_file_hashes(category_name, {filename: content_hash})
+    return url_for('serve_media', filename=content_hash + os.path.splitext(filename)[1].lower())
+
+@app.route('/media/<filename>')
+def serve_media(filename):
+    """Content-addressed local image, cacheable forever: the URL changes whenever the bytes do."""
+    content_hash, _ = os.path.splitext(filename)
+    if not re.fullmatch(r'[0-9a-f]{64}', content_hash):
+        abort(404)
+    for category_name, stored_filename in catalog.find_local_files_by_sha256(content_hash):
+        category_path = os.path.join(app.config['EMOTICONS_FOLDER'], category_name)
+        if os.path.isfile(os.path.join(category_path, stored_filename)):
+            # The content hash is the ETag, If-None-Match gets a 304
+            response = send_local_file(category_path, stored_filename, etag=content_hash, max_age=app.config['MEDIA_MAX_AGE'])
+            response.cache_control.immutable = True
+            return response
+    abort(404)
+
+@app.route('/media/link/<link_id>')
+def serve_external_media(link_id):
+    """External image behind a stable id-based URL. Its origin may change it, so it is cached for PROXY_CACHE_TTL only."""
+    link = catalog.get_external_link_by_id(link_id)
+    if link is None:
+        abort(404)
+    response = proxy_external_link(link['category'], link_id, link['url'])
+    response.cache_control.no_cache = None # set by send_file for cache hits
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['PROXY_CACHE_TTL']
+    return response
 
-        except requests.exceptions.Timeout:
-            app.logger.error(f"Timeout when proxying external image {external_url} for category {category_name}")
-            abort(504) # Gateway Timeout
-        except requests.exceptions.HTTPError as e:
-            # Log the error and the status code from the external server
-            app.logger.error(f"HTTP error {e.response.status_code} when proxying {external_url} for {category_name}. Response: {e.response.text[:200]}")
-            # Relay the original error status code if it's a client-side error (e.g. 403, 404 from origin)
-            # For server-side errors from origin (5xx), return 502 Bad Gateway.
-            if 400 <= e.response.status_code < 500:
-                 abort(e.response.status_code)
-            else:
-                 abort(502) # Bad Gateway
-        except requests.exceptions.RequestException as e:
-            app.logger.error(f"Network or request error when proxying external image {external_url} for {category_name}: {e}")
-            abort(502)  # Bad Gateway
-        except Exception as e:
-            app.logger.error(f"Unexpected error proxying external image {external_url} for {category_name}: {e}", exc_info=True)
-            abort(500) # Internal Server Error
+@app.route('/<path:category_name>')
+def serve_random_emoticon(category_name):
+    if not is_valid_category_name(category_name):
+        abort(404)
+
+    category_index = get_category_index(category_name)
+    if category_index is None:
+        abort(404)
+
+    total_items = len(category_index)
+    if total_items == 0:
+        abort(404) # No local images and no external links
+
+    client_token = get_client_token()
+    state = client_state.get(client_token, category_name) if client_token else None
+    last_shown_item, shuffle_bag = state or (None, None)
+
+    excluded_position = None
+    if last_shown_item:
+        excluded_position = category_index.position_of(*last_shown_item)
+
+    if uses_shuffle_bag(category_name):
+        chosen_position, shuffle_bag = next_shuffle_position(shuffle_bag, total_items, excluded_position)
+    else:
+        chosen_position = pick_random_position(total_items, excluded_position)
+    chosen_item = category_index.item_at(chosen_position)
+
+    # Remember the new last shown item's type and id, and where the client is in its shuffle bag.
+    # Nothing to write when it is unchanged, e.g. a category with a single item.
+    new_state = ((chosen_item['type'], chosen_item['id']), shuffle_bag)
+    if client_token and new_state != state:
+        client_state.set(client_token, category_name, new_state)
+
+    redirect_mode = request.args.get('redirect')
+    if redirect_mode is None:
+        use_redirect = app.config['RANDOM_REDIRECT']
+    else:
+        use_redirect = redirect_mode.lower() in ('1', 'true', 'yes', 'on')
+    if use_redirect and chosen_item['type'] in ('local', 'external'):
+        # Only this small redirect is dynamic, the bytes behind it can be cached by clients and CDNs
+        response = redirect(media_url_for(category_name, chosen_item), code=302)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    if chosen_item['type'] == 'local':
+        return send_local_image(category_name, chosen_item['filename'])
+    elif chosen_item['type'] == 'external':
+        return proxy_external_link(category_name, chosen_item['id'], chosen_item['url'])
     else:
         # Should not happen if types are only 'local' or 'external'
         app.logger.error(f"Unknown item type encountered: {chosen_item.get('type')}")
@@ -911,12 +4078,50 @@ def download_emoticon(category_name, filename):
         return redirect(url_for('view_category', category_name=category_name))
     
     try:
-        return send_from_directory(category_path, safe_filename, as_attachment=True)
+        return send_local_file(category_path, safe_filename, as_attachment=True)
     except Exception as e:
         app.logger.error(f"Error sending file {file_path} for download: {e}")
         flash('下载文件时出错。', 'danger')
         return redirect(url_for('view_category', category_name=category_name))
 
+@app.route('/admin/export/<path:category_name>')
+@login_required
+def export_category(category_name):
+    """Streams the whole category as a zip, resumable with Range / If-Range."""
+    if not is_valid_category_name(category_name):
+        flash('无效的分类名称。', 'danger')
+        return redirect(url_for('admin'))
+    if refresh_category_catalog(category_name) is None:
+        flash(f'分类 "{category_name}" 不存在。', 'warning')
+        return redirect(url_for('admin'))
+
+    export = CategoryExport(category_name)
+    start, end, status = 0, export.length, 200
+    # A Range only applies while the zip is unchanged; with a stale If-Range the whole zip is sent.
+    # Multipart responses are not supported: multi-range (and non-byte) requests get the whole zip too.
+    if (request.range and request.range.units == 'bytes' and len(request.range.ranges) == 1
+            and ('If-Range' not in request.headers or request.if_range.etag == export.etag)):
+        requested = request.range.range_for_length(export.length)
+        if requested is None:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{export.length}'
+            return response
+        start, end = requested
+        status = 206
+
+    response = Response(export.iter_bytes(start, end), status=status, mimetype='application/zip',
+                        direct_passthrough=True)
+    response.content_length = end - start
+    response.set_etag(export.etag)
+    response.accept_ranges = 'bytes'
+    if status == 206:
+        response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{export.length}'
+    response.headers['Content-Disposition'] = content_disposition_attachment(f'{category_name}.zip')
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    app.logger.info(f"Exporting category {category_name}: {len(export.entries)} entries, bytes {start}-{end}/{export.length}")
+    return response
+
 @app.route('/admin/rename/<path:category_name>/<path:filename>', methods=['POST'])
 @login_required
 def rename_emoticon(category_name, filename):
@@ -964,7 +4169,12 @@ def rename_emoticon(category_name, filename):
         return redirect(url_for('view_category', category_name=category_name))
 
     try:
+        dir_mtime_before = _stat_mtime_ns(category_path)
         os.rename(old_file_path, new_file_path)
+        catalog.rename_local_file(category_name, category_path, safe_filename_old, safe_filename_new, dir_mtime_before)
+        invalidate_category_index(category_name)
+        rename_thumbnail(category_name, safe_filename_old, safe_filename_new)
+        rename_variants(category_name, safe_filename_old, safe_filename_new)
         flash(f'文件已从 "{safe_filename_old}" 重命名为 "{safe_filename_new}".', 'success')
     except OSError as e:
         app.logger.error(f"Error renaming file {old_file_path} to {new_file_path}: {e}")
@@ -994,7 +4204,12 @@ def delete_emoticon(category_name, filename):
         flash(f'文件 "{safe_filename}" 在分类 "{category_name}" 中未找到。', 'warning') # Use original cat name
     else:
         try:
+            dir_mtime_before = _stat_mtime_ns(category_path)
             os.remove(file_path)
+            catalog.delete_local_files(category_name, category_path, [safe_filename], dir_mtime_before)
+            invalidate_category_index(category_name)
+            remove_thumbnails(category_name, [safe_filename])
+            remove_variants(category_name, [safe_filename])
             flash(f'文件 "{safe_filename}" 已成功删除。', 'success')
         except OSError as e:
             app.logger.error(f"Error deleting file {file_path}: {e}")
@@ -1024,6 +4239,8 @@ def batch_delete_emoticons(category_name):
 
     success_count = 0
     error_details = []
+    deleted_filenames = []
+    dir_mtime_before = _stat_mtime_ns(category_path)
 
     for filename in filenames_to_delete:
         safe_filename = secure_filename(filename) 
@@ -1039,12 +4256,17 @@ def batch_delete_emoticons(category_name):
         else:
             try:
                 os.remove(file_path)
+                deleted_filenames.append(safe_filename)
                 success_count += 1
             except OSError as e:
                 app.logger.error(f"Error batch deleting file {file_path}: {e}")
                 error_details.append(f"'{safe_filename}': 删除失败 ({e})")
 
     if success_count > 0:
+        catalog.delete_local_files(category_name, category_path, deleted_filenames, dir_mtime_before)
+        invalidate_category_index(category_name)
+        remove_thumbnails(category_name, deleted_filenames)
+        remove_variants(category_name, deleted_filenames)
         flash(f'成功删除了 {success_count} 个文件。', 'success')
     if error_details:
         flash(f'{len(error_details)} 个文件删除失败: {", ".join(error_details)}', 'danger')
@@ -1068,33 +4290,30 @@ def edit_external_link(category_name, link_id):
         if not all([parsed_new_url.scheme, parsed_new_url.netloc]) or parsed_new_url.scheme not in ('http', 'https'):
             flash('无效的新 URL 格式或协议。', 'warning')
             return redirect(url_for('view_category', category_name=category_name))
+        normalize_url(new_url) # rejects e.g. non-numeric ports before the duplicate check
     except ValueError:
         flash('解析新 URL 时出错。', 'warning')
         return redirect(url_for('view_category', category_name=category_name))
 
-    external_links = load_external_links(category_name)
-    link_found = False
-    for link_idx, link in enumerate(external_links):
-        if link.get('id') == link_id:
-            # Check if this new URL already exists (excluding the current link being edited)
-            for other_idx, other_link in enumerate(external_links):
-                if other_idx != link_idx and other_link.get('url') == new_url:
-                    flash(f'新的 URL "{new_url}" 已在该分类中存在。', 'warning')
-                    return redirect(url_for('view_category', category_name=category_name))
-            
-            link['url'] = new_url
-            # Optionally update 'added_at' to reflect modification time, or keep original add time
-            # link['added_at'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
-            link_found = True
-            break
-    
-    if link_found:
-        if save_external_links(category_name, external_links):
-            flash('外部链接已成功更新。', 'success')
-        else:
-            flash('保存外部链接时出错。', 'danger')
-    else:
+    if catalog.get_external_link(category_name, link_id) is None:
         flash('未找到要编辑的外部链接。', 'warning')
+        return redirect(url_for('view_category', category_name=category_name))
+
+    # Check if this new URL already exists (excluding the current link being edited)
+    existing_link = catalog.find_external_link_by_url(category_name, new_url)
+    if existing_link is not None and existing_link['id'] != link_id:
+        flash(f'新的 URL "{new_url}" 已在该分类中存在。', 'warning')
+        return redirect(url_for('view_category', category_name=category_name))
+
+    # The original 'added_at' is kept, editing does not move the link in the listing
+    try:
+        catalog.update_external_link_url(category_name, link_id, new_url)
+        proxy_cache.remove(link_id)
+        invalidate_category_index(category_name)
+        flash('外部链接已成功更新。', 'success')
+    except sqlite3.Error as e:
+        app.logger.error(f"Error updating external link {link_id} for {category_name}: {e}")
+        flash('保存外部链接时出错。', 'danger')
 
     return redirect(url_for('view_category', category_name=category_name))
 
@@ -1105,22 +4324,41 @@ def delete_external_link(category_name, link_id):
         flash('无效的分类名称。', 'danger')
         return redirect(url_for('admin'))
 
-    external_links = load_external_links(category_name)
-    original_length = len(external_links)
-    
-    # Filter out the link to be deleted
-    external_links_updated = [link for link in external_links if link.get('id') != link_id]
+    try:
+        link_deleted = bool(catalog.delete_external_links(category_name, [link_id]))
+    except sqlite3.Error as e:
+        app.logger.error(f"Error deleting external link {link_id} for {category_name}: {e}")
+        flash('保存外部链接时出错（删除操作）。', 'danger')
+        return redirect(url_for('view_category', category_name=category_name))
 
-    if len(external_links_updated) < original_length:
-        if save_external_links(category_name, external_links_updated):
-            flash('外部链接已成功删除。', 'success')
-        else:
-            flash('保存外部链接时出错（删除操作）。', 'danger')
+    if link_deleted:
+        proxy_cache.remove(link_id)
+        invalidate_category_index(category_name)
+        flash('外部链接已成功删除。', 'success')
     else:
         flash('未找到要删除的外部链接，或链接已被删除。', 'warning')
         
     return redirect(url_for('view_category', category_name=category_name))
 
+@app.route('/admin/category/<path:category_name>/check_links', methods=['POST'])
+@login_required
+def check_category_links(category_name):
+    """Makes every external link of a category due for a health check, the background checker runs them shortly."""
+    if not is_valid_category_name(category_name):
+        flash('无效的分类名称。', 'danger')
+        return redirect(url_for('admin'))
+    if app.config['LINK_CHECK_INTERVAL'] <= 0:
+        flash('外链检测未启用（LINK_CHECK_INTERVAL 为 0）。', 'warning')
+        return redirect(url_for('view_category', category_name=category_name))
+    try:
+        scheduled_count = catalog.schedule_link_checks(category_name)
+    except sqlite3.Error as e:
+        app.logger.error(f"Error scheduling link checks for {category_name}: {e}")
+        flash('安排外链检测时出错。', 'danger')
+        return redirect(url_for('view_category', category_name=category_name))
+    flash(f'已安排重新检测 {scheduled_count} 个外部链接，稍后刷新页面查看结果。', 'success')
+    return redirect(url_for('view_category', category_name=category_name))
+
 @app.route('/admin/batch_delete_categories', methods=['POST'])
 @login_required
 def batch_delete_categories():
@@ -1148,12 +4386,12 @@ def batch_delete_categories():
         else:
             try:
                 shutil.rmtree(category_path)
-                # Clear session cache for this category if needed
-                last_shown = session.get('last_shown', {})
-                if category_name in last_shown:
-                    del last_shown[category_name]
-                    session['last_shown'] = last_shown
-                    session.modified = True
+                catalog.delete_category(category_name)
+                invalidate_category_index(category_name)
+                invalidate_category_list()
+                remove_thumbnail_category(category_name)
+                client_state.delete_category(category_name)
+                remove_variant_category(category_name)
                 success_count += 1
             except OSError as e:
                 app.logger.error(f"Error batch deleting category {category_path}: {e}")
@@ -1186,8 +4424,9 @@ def batch_delete_items(category_name):
         return jsonify(status='error', message='请求体JSON解析错误。'), 400
 
     results = []
-    external_links_changed = False
-    current_external_links = None # Load only once if needed
+    deleted_filenames = []
+    dir_mtime_before = _stat_mtime_ns(category_path)
+    external_results = [] # result dicts of external links, resolved in one catalog call below
 
     for item in items_to_delete:
         item_id = item.get('id')
@@ -1210,38 +4449,42 @@ def batch_delete_items(category_name):
             else:
                 try:
                     os.remove(file_path)
+                    deleted_filenames.append(safe_filename)
                     results.append({'id': item_id, 'type': item_type, 'name': item_name, 'status': 'success', 'message': '本地文件已删除。'})
                 except OSError as e:
                     app.logger.error(f"Error deleting local file {file_path}: {e}")
                     results.append({'id': item_id, 'type': item_type, 'name': item_name, 'status': 'error', 'message': f'删除本地文件时出错: {e}'})
         
         elif item_type == 'external':
-            if current_external_links is None: # Load once
-                current_external_links = load_external_links(category_name)
-            
-            original_link_count = len(current_external_links)
-            current_external_links = [link for link in current_external_links if link.get('id') != item_id]
-            
-            if len(current_external_links) < original_link_count:
-                external_links_changed = True
-                results.append({'id': item_id, 'type': item_type, 'name': item_name, 'status': 'success', 'message': '外部链接已标记为删除。'})
-            else:
-                results.append({'id': item_id, 'type': item_type, 'name': item_name, 'status': 'error', 'message': '外部链接未找到或已被删除。'})
+            result = {'id': item_id, 'type': item_type, 'name': item_name}
+            results.append(result)
+            external_results.append(result)
         
         else:
             results.append({'id': item_id, 'type': item_type, 'name': item_name, 'status': 'error', 'message': f'未知的项目类型: {item_type}'})
 
-    if external_links_changed:
-        if not save_external_links(category_name, current_external_links):
-            # If saving fails, update status for all 'external' items that were 'success'
-            for res in results:
-                if res['type'] == 'external' and res['status'] == 'success':
-                    res['status'] = 'error'
-                    res['message'] = '外部链接已标记为删除，但保存更改失败。'
-            # Optionally, add a general error message to the response
-            # return jsonify(status='error', message='保存外部链接更改时出错。', results=results), 500
-            app.logger.error(f"Failed to save external_links.json for category {category_name} after batch delete.")
-            # The individual statuses will reflect the save failure for external links.
+    if deleted_filenames:
+        catalog.delete_local_files(category_name, category_path, deleted_filenames, dir_mtime_before)
+        remove_thumbnails(category_name, deleted_filenames)
+        remove_variants(category_name, deleted_filenames)
+
+    if external_results:
+        try:
+            deleted_link_ids = catalog.delete_external_links(category_name, [result['id'] for result in external_results])
+        except sqlite3.Error as e:
+            app.logger.error(f"Failed to delete external links of category {category_name} after batch delete: {e}")
+            deleted_link_ids = None
+        for result in external_results:
+            if deleted_link_ids is None:
+                result.update(status='error', message='删除外部链接时保存更改失败。')
+            elif result['id'] in deleted_link_ids:
+                proxy_cache.remove(result['id'])
+                result.update(status='success', message='外部链接已删除。')
+            else:
+                result.update(status='error', message='外部链接未找到或已被删除。')
+
+    if deleted_filenames or external_results:
+        invalidate_category_index(category_name)
 
     return jsonify(results=results)
 
@@ -0,0 +1,207 @@
+"""
+ASGI entry point with an asynchronous image proxy.
+
+Under the sync Gunicorn worker a slow external origin holds the worker for up to
+HTTP_READ_TIMEOUT while every other request waits. Served from here, Flask still
+handles every request (in a thread pool, through a2wsgi's WSGI adapter), but when the
+random endpoint or /media/link/<id> has to go to an image's origin, proxy_external_link
+only returns marker headers and the fetch runs on an httpx.AsyncClient instead. Hundreds
+of slow origins then overlap on one event loop, at most ASYNC_PROXY_MAX_CONNECTIONS at
+once. Local files and proxy cache hits are sent by Flask exactly as under WSGI. The proxy
+cache and catalog calls around a fetch touch disk and SQLite, so they run in the loop's
+default thread pool (asyncio.to_thread) rather than on the event loop.
+
+Run with:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 2
+"""
+import asyncio
+import http.cookiejar
+import time
+from urllib.parse import unquote
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from werkzeug.exceptions import default_exceptions
+
+from app import (app, proxy_cache, ProxyCacheWriter, ASYNC_PROXY_LINK_HEADER, ASYNC_PROXY_URL_HEADER,
+                 http_requests, http_request_seconds, http_response_bytes, record_upstream_response, request_link_check)
+
+app.config['ASYNC_PROXY'] = True
+
+CHUNK_SIZE = 8192
+CACHE_WRITE_SIZE = 64 * 1024 # relayed bytes gathered per write of the cache copy, one thread hop each
+LINK_HEADER = ASYNC_PROXY_LINK_HEADER.lower().encode('latin-1')
+URL_HEADER = ASYNC_PROXY_URL_HEADER.lower().encode('latin-1')
+# Headers of the marker response that describe its own empty body, or only apply to a successful image
+MARKER_ONLY_HEADERS = {b'content-type', b'content-length'}
+SUCCESS_ONLY_HEADERS = {b'cache-control'}
+
+def create_async_http_client():
+    """The async counterpart of app.create_http_client: same timeouts and user agent, no cookies kept."""
+    max_connections = app.config['ASYNC_PROXY_MAX_CONNECTIONS']
+    read_timeout = app.config['HTTP_READ_TIMEOUT']
+    return httpx.AsyncClient(
+        headers={'User-Agent': app.config['HTTP_USER_AGENT']},
+        cookies=http.cookiejar.CookieJar(policy=http.cookiejar.DefaultCookiePolicy(allowed_domains=[])),
+        timeout=httpx.Timeout(read_timeout, connect=app.config['HTTP_CONNECT_TIMEOUT'], pool=read_timeout),
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=min(max_connections, 50)),
+        follow_redirects=True) # like requests
+
+class AsyncProxyApplication:
+    """Runs the Flask app and serves the origin fetches it hands back."""
+
+    def __init__(self, flask_app):
+        self.wsgi_app = WSGIMiddleware(flask_app)
+        self.client = None # created on first use, inside the worker's event loop
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        started_at = time.perf_counter()
+        handoff = []
+
+        async def send_unless_handoff(message):
+            if message['type'] == 'http.response.start' and any(name == LINK_HEADER for name, _ in message['headers']):
+                handoff.append(message['headers'])
+            elif not handoff: # the marker response's own (empty) body is dropped
+                await send(message)
+
+        await self.wsgi_app(scope, receive, send_unless_handoff)
+        if not handoff:
+            return
+        sent = {'status': 500, 'bytes': 0}
+
+        async def send_and_count(message):
+            if message['type'] == 'http.response.start':
+                sent['status'] = message['status']
+            else:
+                sent['bytes'] += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.proxy(handoff[0], send_and_count)
+        finally:
+            # Flask skipped these requests in its own request metrics
+            try:
+                endpoint = app.url_map.bind('localhost').match(scope['path'], method=scope['method'])[0]
+            except Exception:
+                endpoint = 'unmatched'
+            http_request_seconds.observe(time.perf_counter() - started_at, endpoint)
+            http_requests.inc(endpoint, scope['method'], str(sent['status']))
+            http_response_bytes.inc(endpoint, amount=sent['bytes'])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client is not None:
+                    await self.client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def proxy(self, marker_headers, send):
+        """The origin half of app.proxy_external_link: fetch or revalidate, relay and cache."""
+        link_id = url = None
+        passthrough_headers = [] # e.g. the session cookie and Vary set by Flask
+        for name, value in marker_headers:
+            if name == LINK_HEADER:
+                link_id = value.decode('latin-1')
+            elif name == URL_HEADER:
+                url = unquote(value.decode('latin-1'))
+            elif name not in MARKER_ONLY_HEADERS:
+                passthrough_headers.append((name, value))
+        error_headers = [(name, value) for name, value in passthrough_headers if name not in SUCCESS_ONLY_HEADERS]
+
+        cached_meta = await asyncio.to_thread(proxy_cache.lookup, link_id, url)
+        request_headers = {'Referer': ''}
+        if cached_meta is not None:
+            request_headers.update(proxy_cache.conditional_headers(cached_meta))
+        if self.client is None:
+            self.client = create_async_http_client()
+
+        started = False
+        fetch_started_at = time.perf_counter()
+        upstream_status = None
+        try:
+            async with self.client.stream('GET', url, headers=request_headers) as upstream:
+                upstream_status = upstream.status_code
+                record_upstream_response(url, upstream_status, fetch_started_at)
+                if upstream.status_code == 304 and cached_meta is not None:
+                    await asyncio.to_thread(proxy_cache.record, 'revalidated')
+                    cached_meta = await asyncio.to_thread(proxy_cache.mark_revalidated, link_id, cached_meta, upstream.headers)
+                    started = True
+                    await self.send_cached(link_id, cached_meta, passthrough_headers, send)
+                    return
+                if upstream.status_code >= 400:
+                    app.logger.error(f"HTTP error {upstream.status_code} when proxying {url} (async)")
+                    await asyncio.to_thread(request_link_check, link_id)
+                    await send_error(send, upstream.status_code if upstream.status_code < 500 else 502, error_headers)
+                    return
+                content_type = upstream.headers.get('Content-Type') or ''
+                if not content_type.lower().startswith('image/'):
+                    app.logger.warning(f"Proxied URL {url} returned non-image content-type: {content_type}")
+                    await asyncio.to_thread(request_link_check, link_id)
+                    await send_error(send, 415, error_headers)
+                    return
+
+                await asyncio.to_thread(proxy_cache.record, 'misses')
+                await send({'type': 'http.response.start', 'status': upstream.status_code,
+                            'headers': passthrough_headers + [(b'content-type', content_type.encode('latin-1')),
+                                                              (b'x-proxy-cache', b'MISS')]})
+                started = True
+                writer = await asyncio.to_thread(ProxyCacheWriter, proxy_cache, link_id, url)
+                pending = bytearray() # relayed but not yet in the cache copy
+                completed = False
+                try:
+                    async for chunk in upstream.aiter_bytes(CHUNK_SIZE):
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                        pending += chunk
+                        if len(pending) >= CACHE_WRITE_SIZE:
+                            await asyncio.to_thread(writer.write, bytes(pending))
+                            pending.clear()
+                    if pending:
+                        await asyncio.to_thread(writer.write, bytes(pending))
+                    completed = True
+                finally:
+                    if completed:
+                        await asyncio.to_thread(writer.commit, upstream.headers)
+                    else:
+                        await asyncio.to_thread(writer.discard)
+                await send({'type': 'http.response.body', 'body': b''})
+        except httpx.HTTPError as e:
+            app.logger.error(f"Error when proxying external image {url} (async): {e!r}")
+            if upstream_status is None:
+                record_upstream_response(url, 'timeout' if isinstance(e, httpx.TimeoutException) else 'error', fetch_started_at)
+            await asyncio.to_thread(request_link_check, link_id)
+            if started:
+                raise # the response is under way, dropping the connection tells the client it is incomplete
+            await send_error(send, 504 if isinstance(e, httpx.TimeoutException) else 502, error_headers)
+
+    async def send_cached(self, link_id, meta, headers, send):
+        f = await asyncio.to_thread(open, proxy_cache.data_path(link_id), 'rb')
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': headers + [(b'content-type', (meta.get('content_type') or 'application/octet-stream').encode('latin-1')),
+                                              (b'x-proxy-cache', b'REVALIDATED')]})
+            while True:
+                chunk = await asyncio.to_thread(f.read, CHUNK_SIZE * 8)
+                if not chunk:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            f.close()
+        await send({'type': 'http.response.body', 'body': b''})
+
+async def send_error(send, status, headers):
+    """The same error page Flask's abort(status) renders."""
+    error = (default_exceptions.get(status) or default_exceptions[502])()
+    body = error.get_body().encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': headers + [(b'content-type', b'text/html; charset=utf-8'),
+                                      (b'content-length', str(len(body)).encode('latin-1'))]})
+    await send({'type': 'http.response.body', 'body': body})
+
+application = AsyncProxyApplication(app)
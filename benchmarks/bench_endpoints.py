@@ -0,0 +1,286 @@
+"""
+End-to-end benchmark of the main endpoints against a synthetic library.
+
+Generates a tree with synthetic_library.py, starts fake_origin.py in-process for
+the external links and URL imports, then imports the app with EMOTICONS_FOLDER and
+DATA_FOLDER in a temporary directory and drives it through Flask's test client
+from --concurrency threads, one client (and so one session) per thread:
+
+    random_local        GET /bench-local, serve_random_emoticon on local files only
+    random_mixed        GET /bench-big, local files and proxied external links
+    view_category       GET /admin/category/bench-big on random pages
+    upload_file         POST /admin/upload of a new PNG into bench-big
+    add_external_links  POST add_external_links with --link-batch new URLs
+    url_import          POST initiate_url_download_task with --import-batch URLs, then
+                        follow the SSE stream until its 'end' event
+
+Reads run before writes, so the write scenarios also pay for the index rebuilds
+they cause. Prints throughput and latency percentiles per scenario and writes
+them, with the run parameters, to a JSON file; compare_results.py diffs two runs.
+
+Usage:
+    python benchmarks/bench_endpoints.py [--files 10000] [--categories 20] [--links 5000]
+        [--requests 500] [--concurrency 4] [--output bench-results.json]
+"""
+import argparse
+import datetime
+import io
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, REPO_ROOT)
+
+from fake_origin import FakeOrigin, make_png # noqa: E402
+from synthetic_library import BIG_CATEGORY, LOCAL_CATEGORY, build_library, plan_categories # noqa: E402
+
+SCENARIOS = ['random_local', 'random_mixed', 'view_category', 'upload_file', 'add_external_links', 'url_import']
+PER_PAGE = 100
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+def summarize(latencies, errors, seconds, origin_requests):
+    latencies_ms = sorted(round(latency * 1000, 3) for latency in latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'throughput_rps': round(len(latencies) / seconds, 1) if seconds else None,
+        'latency_ms': {
+            'mean': round(sum(latencies_ms) / len(latencies_ms), 3) if latencies_ms else None,
+            'p50': percentile(latencies_ms, 0.50),
+            'p90': percentile(latencies_ms, 0.90),
+            'p99': percentile(latencies_ms, 0.99),
+            'max': latencies_ms[-1] if latencies_ms else None,
+        },
+        'origin_requests': origin_requests,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class EndpointBenchmark:
+    """Holds the imported app and the fake origin, and runs one scenario at a time."""
+
+    def __init__(self, flask_app, origin, args):
+        self.app = flask_app
+        self.origin = origin
+        self.args = args
+        self.big_category_pages = 1
+        self.unique = itertools.count() # keeps uploaded files and added URLs distinct across threads
+
+    def new_client(self):
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['logged_in'] = True
+        return client
+
+    # Scenarios, each returns True when the request succeeded
+
+    def random_local(self, client, rng):
+        with client.get(f'/{LOCAL_CATEGORY}') as response:
+            response.get_data()
+            return response.status_code == 200
+
+    def random_mixed(self, client, rng):
+        with client.get(f'/{BIG_CATEGORY}') as response:
+            response.get_data()
+            return response.status_code == 200
+
+    def view_category(self, client, rng):
+        page = rng.randint(1, self.big_category_pages)
+        with client.get(f'/admin/category/{BIG_CATEGORY}?page={page}&per_page={PER_PAGE}') as response:
+            response.get_data()
+            return response.status_code == 200
+
+    def upload_file(self, client, rng):
+        n = next(self.unique)
+        data = {'category': BIG_CATEGORY, 'file': (io.BytesIO(make_png(f'upload-{n}')), f'upload_{n}.png')}
+        with client.post('/admin/upload', data=data, content_type='multipart/form-data',
+                         headers={'X-Requested-With': 'XMLHttpRequest'}) as response:
+            return response.status_code == 200 and response.get_json().get('status') == 'success'
+
+    def add_external_links(self, client, rng):
+        n = next(self.unique)
+        urls = [self.origin.image_url(f'added-{n}-{i}') for i in range(self.args.link_batch)]
+        with client.post(f'/admin/category/{BIG_CATEGORY}/add_external_links', data={'urls': '\n'.join(urls)},
+                         headers={'X-Requested-With': 'XMLHttpRequest'}) as response:
+            return response.status_code == 200 and response.get_json().get('status') == 'success'
+
+    def url_import(self, client, rng):
+        n = next(self.unique)
+        urls = [self.origin.image_url(f'import-{n}-{i}') for i in range(self.args.import_batch)]
+        with client.post('/admin/initiate_url_download_task', json={'category': BIG_CATEGORY, 'urls': urls}) as response:
+            if response.status_code != 202:
+                return False
+            task_id = response.get_json()['task_id']
+        ended = False
+        with client.get(f'/admin/stream_url_download_progress?task_id={task_id}') as response:
+            for chunk in response.response:
+                text = chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+                if 'event: error' in text:
+                    return False
+                if 'event: end' in text:
+                    ended = True
+                    break
+        if not ended:
+            return False
+        with client.get(f'/admin/url_download_task/{task_id}') as response:
+            result = response.get_json().get('result') or {}
+        return result.get('processed') == len(urls)
+
+    def run(self, name, requests, concurrency, warmup):
+        """Runs warmup calls of scenario name, then requests measured calls spread over concurrency threads."""
+        scenario = getattr(self, name)
+
+        def call(client, rng):
+            started = time.perf_counter()
+            try:
+                ok = scenario(client, rng)
+            except Exception as e: # a failing scenario counts as an error, not a crashed run
+                print(f'  {name}: {type(e).__name__}: {e}', file=sys.stderr)
+                ok = False
+            return ok, time.perf_counter() - started
+
+        # The first calls pay for index builds and cache misses, time the very first one but keep them out of the stats
+        cold_seconds = None
+        warmup_client = self.new_client()
+        warmup_rng = random.Random(f'{self.args.seed}-{name}-warmup')
+        for _ in range(warmup):
+            _, elapsed = call(warmup_client, warmup_rng)
+            if cold_seconds is None:
+                cold_seconds = elapsed
+
+        counter = itertools.count()
+        lock = threading.Lock()
+        latencies = []
+        errors = [0]
+        origin_before = self.origin.requests_served
+
+        def worker(worker_number):
+            client = self.new_client()
+            rng = random.Random(f'{self.args.seed}-{name}-{worker_number}')
+            while next(counter) < requests:
+                ok, elapsed = call(client, rng)
+                with lock:
+                    latencies.append(elapsed)
+                    if not ok:
+                        errors[0] += 1
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        result = summarize(latencies, errors[0], time.perf_counter() - started, self.origin.requests_served - origin_before)
+        result['cold_ms'] = round(cold_seconds * 1000, 3) if cold_seconds is not None else None
+        return result
+
+def print_table(results):
+    print(f"{'scenario':<20} {'requests':>8} {'errors':>6} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'cold ms':>9}")
+    for name, result in results.items():
+        latency = result['latency_ms']
+        print(f"{name:<20} {result['requests']:>8} {result['errors']:>6} {result['throughput_rps'] or 0:>9.1f} "
+              f"{latency['p50'] or 0:>9.2f} {latency['p99'] or 0:>9.2f} {result['cold_ms'] or 0:>9.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=10_000, help='local files in the synthetic library')
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--links', type=int, default=5_000, help='external links, written as legacy external_links.json')
+    parser.add_argument('--requests', type=int, default=500, help='measured calls per scenario')
+    parser.add_argument('--import-requests', type=int, default=10, help='measured import tasks for url_import')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured calls before each scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='client threads per scenario')
+    parser.add_argument('--link-batch', type=int, default=50, help='URLs per add_external_links call')
+    parser.add_argument('--import-batch', type=int, default=20, help='URLs per url_import task')
+    parser.add_argument('--origin-delay-ms', type=int, default=0, help='latency of the fake origin')
+    parser.add_argument('--origin-size', type=int, default=0, help='image size served by the fake origin (0: about 100 bytes)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated subset of: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='directory for the tree and the data folder (default: a temporary one, removed afterwards)')
+    parser.add_argument('--output', default='bench-results.json', help='JSON results file')
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bqb-bench-')
+    origin = FakeOrigin(delay_ms=args.origin_delay_ms, image_size=args.origin_size).start()
+    try:
+        emoticons_folder = os.path.join(workdir, 'emoticons')
+        print(f'Generating {args.files} files and {args.links} links in {emoticons_folder} ...')
+        library = build_library(emoticons_folder, args.files, args.categories, args.links, origin.base_url, args.seed)
+
+        # app.py reads its configuration and migrates external_links.json at import time,
+        # so it can only be imported once the environment points at the generated tree
+        os.environ['EMOTICONS_FOLDER'] = emoticons_folder
+        os.environ['DATA_FOLDER'] = os.path.join(workdir, 'data')
+        # Background link checks would hit the fake origin in the middle of the measurements
+        os.environ.setdefault('LINK_CHECK_INTERVAL', '0')
+        started = time.perf_counter()
+        import app as app_module
+        startup_seconds = time.perf_counter() - started
+        print(f"Imported the app in {startup_seconds:.2f}s (includes migrating the links into the catalog)")
+
+        bench = EndpointBenchmark(app_module.app, origin, args)
+        big_files, big_links = plan_categories(args.files, args.categories, args.links)[BIG_CATEGORY]
+        bench.big_category_pages = max(1, math.ceil((big_files + big_links) / PER_PAGE))
+
+        results = {}
+        for name in SCENARIOS: # fixed order: reads before writes
+            if name not in scenarios:
+                continue
+            requests = args.import_requests if name == 'url_import' else args.requests
+            warmup = min(args.warmup, 1) if name == 'url_import' else args.warmup
+            print(f'Running {name} ...')
+            results[name] = bench.run(name, requests, args.concurrency, warmup)
+            if name == 'url_import' and results[name]['seconds']:
+                results[name]['items_per_second'] = round(results[name]['requests'] * args.import_batch / results[name]['seconds'], 1)
+
+        report = {
+            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'arguments': {key: value for key, value in vars(args).items() if key not in ('output', 'workdir')},
+            'library': {key: value for key, value in library.items() if key != 'root'},
+            'startup_seconds': round(startup_seconds, 3),
+            'scenarios': results,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print()
+        print_table(results)
+        print(f'\nResults written to {args.output}')
+    finally:
+        origin.shutdown()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
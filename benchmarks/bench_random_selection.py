@@ -0,0 +1,73 @@
+"""
+Micro-benchmark for the random endpoint's item selection.
+
+Compares the old approach (build a list of dicts for every item, filter out the
+last shown one, random.choice) with the CategoryIndex + pick_random_position
+path used by serve_random_emoticon, for categories of 1k / 100k / 1M items.
+
+Usage:
+    python benchmarks/bench_random_selection.py [--draws 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+# app.py creates EMOTICONS_FOLDER on import, keep it out of the working tree
+os.environ.setdefault('EMOTICONS_FOLDER', tempfile.mkdtemp(prefix='bqb-bench-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import CategoryIndex, pick_random_position # noqa: E402
+
+SIZES = [1_000, 100_000, 1_000_000]
+
+def make_index(size):
+    """Builds an index that is 90% local files and 10% external links."""
+    external_count = size // 10
+    local_files = [f'image_{i:07d}.png' for i in range(size - external_count)]
+    external_links = [(f'link-{i:07d}', f'https://example.com/{i}.png') for i in range(external_count)]
+    return CategoryIndex(local_files, external_links, 0)
+
+def legacy_pick(index, last_shown):
+    """The selection logic serve_random_emoticon used before the index existed."""
+    all_items = [index.item_at(position) for position in range(len(index))]
+    eligible_items = all_items
+    if last_shown and len(all_items) > 1:
+        possible_items = [item for item in all_items
+                          if not (item['id'] == last_shown['id'] and item['type'] == last_shown['type'])]
+        if possible_items:
+            eligible_items = possible_items
+    return random.choice(eligible_items)
+
+def indexed_pick(index, last_shown):
+    excluded_position = index.position_of(last_shown['type'], last_shown['id']) if last_shown else None
+    return index.item_at(pick_random_position(len(index), excluded_position))
+
+def time_draws(pick, index, draws):
+    last_shown = None
+    start = time.perf_counter()
+    for _ in range(draws):
+        item = pick(index, last_shown)
+        if last_shown is not None:
+            assert (item['type'], item['id']) != (last_shown['type'], last_shown['id'])
+        last_shown = {'id': item['id'], 'type': item['type']}
+    return (time.perf_counter() - start) / draws
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--draws', type=int, default=2000, help='draws per size for the indexed pick')
+    args = parser.parse_args()
+
+    print(f"{'items':>10} {'legacy us/draw':>16} {'indexed us/draw':>16} {'speedup':>10}")
+    for size in SIZES:
+        index = make_index(size)
+        # The legacy path is O(n) per draw, keep its draw count bounded on big categories
+        legacy_draws = max(3, min(args.draws, 20_000_000 // size))
+        legacy = time_draws(legacy_pick, index, legacy_draws)
+        indexed = time_draws(indexed_pick, index, args.draws)
+        print(f"{size:>10} {legacy * 1e6:>16.1f} {indexed * 1e6:>16.2f} {legacy / indexed:>9.0f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Compares two result files written by bench_endpoints.py.
+
+Prints throughput and p50/p99 latency of every scenario present in both runs,
+with the relative change of the second run against the first. Runs with different
+library sizes or concurrency are not comparable, a warning is printed for those.
+
+Usage:
+    python benchmarks/compare_results.py BASELINE.json CANDIDATE.json
+"""
+import argparse
+import json
+
+# Arguments that change what is measured, as opposed to how long it is measured for
+SHAPE_ARGUMENTS = ('files', 'categories', 'links', 'concurrency', 'link_batch', 'import_batch',
+                   'origin_delay_ms', 'origin_size')
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def change(old, new):
+    if not old or new is None:
+        return ''
+    return f'{(new - old) / old * 100:+.1f}%'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    args = parser.parse_args()
+
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    for key in SHAPE_ARGUMENTS:
+        old, new = baseline['arguments'].get(key), candidate['arguments'].get(key)
+        if old != new:
+            print(f'warning: {key} differs ({old} vs {new}), the runs are not directly comparable')
+    print(f"baseline  {baseline.get('git_commit') or '?':.12} {baseline['created_at']}")
+    print(f"candidate {candidate.get('git_commit') or '?':.12} {candidate['created_at']}")
+    print(f"startup   {baseline['startup_seconds']:.2f}s -> {candidate['startup_seconds']:.2f}s "
+          f"{change(baseline['startup_seconds'], candidate['startup_seconds'])}")
+    print()
+    print(f"{'scenario':<20}" + ''.join(f' {label:>28}' for label in ('req/s', 'p50 ms', 'p99 ms')))
+    for name, old in baseline['scenarios'].items():
+        new = candidate['scenarios'].get(name)
+        if new is None:
+            continue
+        columns = [(old['throughput_rps'], new['throughput_rps'])]
+        columns += [(old['latency_ms'][key], new['latency_ms'][key]) for key in ('p50', 'p99')]
+        line = f'{name:<20}'
+        for old_value, new_value in columns:
+            line += f" {old_value or 0:>9.2f} {new_value or 0:>9.2f} {change(old_value, new_value):>8}"
+        if new['errors'] or old['errors']:
+            line += f"  errors {old['errors']} -> {new['errors']}"
+        print(line)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Local stand-in for the external image hosts, used by the benchmarks.
+
+Serves small, distinct PNGs so proxying and URL imports can be measured without
+touching the network:
+
+    /img/<n>.png             image n (the bytes differ per n, so imports are not deduplicated)
+    /img/<n>.png?size=20000  image n padded to about 20000 bytes
+    /img/<n>.png?delay=250   answer after 250 ms instead of the server default
+    /status/<code>           an empty response with that status code
+    /text/<n>                a text/html page, rejected by the proxy and the importer
+
+Image responses carry an ETag and honour If-None-Match, so proxy cache
+revalidation gets its 304 like from a real CDN.
+
+Usage:
+    python benchmarks/fake_origin.py [--port 8099] [--delay-ms 0] [--size 0]
+"""
+import argparse
+import hashlib
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+def _png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+def make_png(seed, size=0):
+    """
+    A valid 1x1 PNG whose bytes depend on seed. A tEXt chunk carries the seed, plus
+    padding up to roughly size bytes when size is larger than the bare image.
+    """
+    header = b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 6, 0, 0, 0))
+    seed_bytes = str(seed).encode('ascii')
+    pixel = hashlib.sha256(seed_bytes).digest()[:3] + b'\xff'
+    body = _png_chunk(b'IDAT', zlib.compress(b'\x00' + pixel)) + _png_chunk(b'IEND', b'')
+    text = b'bench\x00' + seed_bytes
+    padding = size - len(header) - len(body) - len(text) - 12
+    if padding > 0:
+        text += b' ' + b'.' * (padding - 1)
+    return header + _png_chunk(b'tEXt', text) + body
+
+class FakeOriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like the hosts the connection pool talks to
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+        parts = parsed.path.strip('/').split('/')
+        self.server.count_request()
+        delay_ms = int(params.get('delay', [self.server.delay_ms])[0])
+        if delay_ms:
+            time.sleep(delay_ms / 1000)
+
+        if len(parts) == 2 and parts[0] == 'img':
+            seed = parts[1].rsplit('.', 1)[0]
+            size = int(params.get('size', [self.server.image_size])[0])
+            body = make_png(seed, size)
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self._respond(304, b'', etag=etag)
+            else:
+                self._respond(200, body, 'image/png', etag)
+        elif len(parts) == 2 and parts[0] == 'status' and parts[1].isdigit():
+            self._respond(int(parts[1]), b'')
+        elif len(parts) == 2 and parts[0] == 'text':
+            self._respond(200, b'<html><body>not an image</body></html>', 'text/html; charset=utf-8')
+        else:
+            self._respond(404, b'')
+
+    def _respond(self, status, body, content_type=None, etag=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'max-age=3600')
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # thousands of requests per run, keep the benchmark output readable
+
+class FakeOrigin(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, delay_ms=0, image_size=0):
+        super().__init__((host, port), FakeOriginHandler)
+        self.delay_ms = delay_ms
+        self.image_size = image_size
+        self.requests_served = 0
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        with self._lock:
+            self.requests_served += 1
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def image_url(self, seed):
+        return f'{self.base_url}/img/{seed}.png'
+
+    def start(self):
+        """Serves from a daemon thread and returns self, for use inside a benchmark process."""
+        threading.Thread(target=self.serve_forever, name='fake-origin', daemon=True).start()
+        return self
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--delay-ms', type=int, default=0, help='default response delay')
+    parser.add_argument('--size', type=int, default=0, help='default image size in bytes (0: about 100 bytes)')
+    args = parser.parse_args()
+
+    origin = FakeOrigin(args.host, args.port, args.delay_ms, args.size)
+    print(f'Fake origin listening on {origin.base_url} (example: {origin.image_url(1)})')
+    try:
+        origin.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
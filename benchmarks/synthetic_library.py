@@ -0,0 +1,95 @@
+"""
+Generates a synthetic emoticon tree for the benchmarks.
+
+The layout is the same for a given set of arguments, so runs against separately
+generated trees stay comparable:
+
+    bench-local/         10% of the files, no external links
+    bench-big/           40% of the files and half of the external links
+    bench-0001/ ...      the remaining files and links, spread round-robin
+
+Every file is a distinct tiny PNG, and the external links are written as legacy
+external_links.json files, so the first start of the app also measures their
+migration into the catalog.
+
+Usage:
+    python benchmarks/synthetic_library.py DIR [--files 10000] [--categories 20]
+        [--links 5000] [--origin http://127.0.0.1:8099]
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_origin import make_png # noqa: E402
+
+LOCAL_CATEGORY = 'bench-local'
+BIG_CATEGORY = 'bench-big'
+
+def plan_categories(files, categories, links):
+    """Returns {category: (file_count, link_count)} following the layout in the module docstring."""
+    filler_names = [f'bench-{i:04d}' for i in range(1, max(categories - 2, 1) + 1)]
+    plan = {LOCAL_CATEGORY: [files // 10, 0], BIG_CATEGORY: [files * 4 // 10, links // 2]}
+    plan.update((name, [0, 0]) for name in filler_names)
+    for i in range(files - files // 10 - files * 4 // 10):
+        plan[filler_names[i % len(filler_names)]][0] += 1
+    for i in range(links - links // 2):
+        plan[filler_names[i % len(filler_names)]][1] += 1
+    return {name: tuple(counts) for name, counts in plan.items()}
+
+def build_library(root, files, categories, links, origin_base_url, seed=0):
+    """Writes the tree under root and returns a summary of what was generated."""
+    rng = random.Random(seed)
+    added_at = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc).isoformat()
+    started = time.perf_counter()
+    link_number = 0
+    plan = plan_categories(files, categories, links)
+    for category, (file_count, link_count) in plan.items():
+        category_path = os.path.join(root, category)
+        os.makedirs(category_path, exist_ok=True)
+        for i in range(file_count):
+            with open(os.path.join(category_path, f'img_{i:07d}.png'), 'wb') as f:
+                f.write(make_png(f'{category}/{i}'))
+        if link_count:
+            category_links = []
+            for _ in range(link_count):
+                category_links.append({
+                    'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                    'url': f'{origin_base_url}/img/link-{link_number}.png',
+                    'added_at': added_at,
+                    'type': 'external',
+                })
+                link_number += 1
+            with open(os.path.join(category_path, 'external_links.json'), 'w', encoding='utf-8') as f:
+                json.dump(category_links, f)
+    return {
+        'root': root,
+        'files': files,
+        'links': links,
+        'categories': len(plan),
+        'local_category': LOCAL_CATEGORY,
+        'big_category': BIG_CATEGORY,
+        'build_seconds': round(time.perf_counter() - started, 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('root', help='directory to generate the tree in (used as EMOTICONS_FOLDER)')
+    parser.add_argument('--files', type=int, default=10_000)
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--links', type=int, default=5_000)
+    parser.add_argument('--origin', default='http://127.0.0.1:8099', help='base URL of the fake origin the links point to')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    summary = build_library(args.root, args.files, args.categories, args.links, args.origin.rstrip('/'), args.seed)
+    print(json.dumps(summary, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Image rendering helpers that run in worker processes.
+
+Kept out of app.py on purpose: the process pool starts its workers with the
+'spawn' method, and a worker only imports the module of the function it runs,
+so rendering a thumbnail or a WebP/AVIF variant does not drag in Flask, the
+catalog or the HTTP client. Pillow is optional; without it available() is False
+and callers fall back to serving originals.
+"""
+import os
+
+try:
+    from PIL import Image, ImageOps, ImageSequence, features
+except ImportError: # Pillow not installed, thumbnails are disabled
+    Image = None
+
+VARIANT_FORMATS = {'webp': 'WEBP', 'avif': 'AVIF'}
+
+def available():
+    return Image is not None
+
+def supported_variant_formats():
+    """The variant formats this Pillow build can encode (AVIF needs Pillow 11.3+ built with libavif)."""
+    if Image is None:
+        return ()
+    return tuple(fmt for fmt in VARIANT_FORMATS if features.check(fmt))
+
+def render_thumbnail(source_path, target_path, max_size, quality=80):
+    """
+    Writes a WebP thumbnail of source_path (first frame for animations), turned
+    upright per its EXIF orientation and fitting within max_size x max_size. The
+    file is written next to target_path and moved into place, so readers never
+    see a partial thumbnail.
+    Returns True on success, False if the source could not be decoded.
+    """
+    if Image is None:
+        return False
+    temp_path = f'{target_path}.{os.getpid()}.tmp'
+    try:
+        with Image.open(source_path) as image:
+            # First frame of GIFs; camera JPEGs are stored sideways with an EXIF orientation tag
+            frame = ImageOps.exif_transpose(next(ImageSequence.Iterator(image)))
+        if frame.mode not in ('RGB', 'RGBA'):
+            has_alpha = frame.mode in ('LA', 'PA') or (frame.mode == 'P' and 'transparency' in frame.info)
+            frame = frame.convert('RGBA' if has_alpha else 'RGB')
+        frame.thumbnail((max_size, max_size))
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        frame.save(temp_path, 'WEBP', quality=quality, method=4)
+        os.replace(temp_path, target_path)
+        return True
+    except (OSError, ValueError, Image.DecompressionBombError):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return False
+
+def render_variant(source_path, target_path, fmt, quality=80):
+    """
+    Re-encodes source_path as WebP or AVIF, keeping every frame of animations.
+    A variant that is not smaller than the original is not worth sending, target_path
+    is then written empty so the original is known to be up to date without encoding
+    it again. A source that cannot be decoded or encoded gets the same empty marker, so
+    it is not queued again on every request until the original changes. Returns the
+    variant size (0 when not kept), or None if rendering failed.
+    """
+    if Image is None:
+        return None
+    temp_path = f'{target_path}.{os.getpid()}.tmp'
+    try:
+        with Image.open(source_path) as image:
+            animated = getattr(image, 'is_animated', False)
+            if animated:
+                frame = image # the encoder converts every frame itself
+            else:
+                frame = ImageOps.exif_transpose(image) # browsers honour the EXIF orientation of the original
+                if frame.mode not in ('RGB', 'RGBA'):
+                    has_alpha = frame.mode in ('LA', 'PA') or (frame.mode == 'P' and 'transparency' in frame.info)
+                    frame = frame.convert('RGBA' if has_alpha else 'RGB')
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            frame.save(temp_path, VARIANT_FORMATS[fmt], quality=quality, save_all=animated)
+        size = os.path.getsize(temp_path)
+        if size >= os.path.getsize(source_path):
+            size = 0
+            open(temp_path, 'wb').close()
+        os.replace(temp_path, target_path)
+        return size
+    except (OSError, ValueError, KeyError, Image.DecompressionBombError):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        try:
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            open(target_path, 'wb').close()
+        except OSError:
+            pass # retried with the next request that could use the variant
+        return None
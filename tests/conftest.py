@@ -0,0 +1,48 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# app.py reads its configuration at import time, so point it at a scratch tree first
+DATA_ROOT = tempfile.mkdtemp(prefix='biaoqingbao-tests-')
+os.environ['EMOTICONS_FOLDER'] = os.path.join(DATA_ROOT, 'emoticons')
+os.environ['DATA_FOLDER'] = os.path.join(DATA_ROOT, 'data')
+os.environ['LINK_CHECK_INTERVAL'] = '0'
+os.environ['ADMIN_PASSWORD'] = 'test'
+os.makedirs(os.environ['EMOTICONS_FOLDER'], exist_ok=True)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module # noqa: E402
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(DATA_ROOT, ignore_errors=True)
+
+# A valid 1x1 PNG
+PNG_BYTES = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                          '1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082')
+
+@pytest.fixture
+def client():
+    app_module.app.config['TESTING'] = True
+    with app_module.app.test_client() as client:
+        with client.session_transaction() as session:
+            session['logged_in'] = True
+        yield client
+
+@pytest.fixture
+def make_category():
+    """Creates a category directory with count distinct files, without the app ever seeing it."""
+    created = []
+
+    def make(name, count):
+        category_path = os.path.join(app_module.app.config['EMOTICONS_FOLDER'], name)
+        os.makedirs(category_path)
+        for i in range(count):
+            with open(os.path.join(category_path, f'existing_{i}.png'), 'wb') as f:
+                f.write(PNG_BYTES + str(i).encode('ascii')) # distinct content, so nothing is deduplicated
+        created.append(name)
+        return category_path
+
+    return make
@@ -0,0 +1,72 @@
+"""Archive uploads: extraction limits and member names."""
+import io
+import os
+import tarfile
+import zipfile
+
+from conftest import PNG_BYTES, app_module
+
+def make_tar(members):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    buffer.seek(0)
+    return buffer
+
+def zip_of(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+def upload(client, category_name, archive, filename):
+    response = client.post('/admin/upload_archive', data={'category': category_name, 'archive': (archive, filename)},
+                           content_type='multipart/form-data')
+    return response.get_json()
+
+def test_skipped_tar_members_count_against_total(client, make_category, monkeypatch):
+    category_path = make_category('archive-bomb', 0)
+    monkeypatch.setitem(app_module.app.config, 'ARCHIVE_MAX_TOTAL_BYTES', 1024 * 1024)
+    # Skipped by name or extension, yet a tar stream still has to decompress them to get past
+    archive = make_tar([('first.png', PNG_BYTES), ('.hidden', b'\0' * 600 * 1024),
+                        ('notes.txt', b'\0' * 600 * 1024), ('after.png', PNG_BYTES)])
+
+    result = upload(client, 'archive-bomb', archive, 'bomb.tgz')
+    assert [member['status'] for member in result['results']] == ['success', 'skipped', 'error']
+    assert result['results'][-1]['name'] == 'notes.txt'
+    assert [name.split('_')[0] for name in os.listdir(category_path)] == ['first']
+
+class CountingStream(io.BytesIO):
+    bytes_read = 0
+
+    def read(self, *args):
+        data = super().read(*args)
+        self.bytes_read += len(data)
+        return data
+
+def test_oversized_tar_member_stops_before_it_is_read(make_category, monkeypatch):
+    make_category('archive-huge', 0)
+    monkeypatch.setitem(app_module.app.config, 'ARCHIVE_MAX_TOTAL_BYTES', 1024 * 1024)
+    archive = CountingStream(make_tar([('huge.png', PNG_BYTES + os.urandom(2 * 1024 * 1024))]).getvalue())
+
+    with app_module.app.app_context():
+        results = app_module.import_archive(archive, 'archive-huge')
+    assert results == [{'name': 'huge.png', 'status': 'error', 'message': '解压总大小超过上限，其余部分未处理'}]
+    assert archive.bytes_read < 256 * 1024 # the member's body was never decompressed
+
+def test_member_paths_cannot_leave_the_category(client, make_category):
+    category_path = make_category('archive-paths', 0)
+    for archive, filename in ((make_tar([('../../escaped.png', PNG_BYTES), ('/abs/rooted.png', PNG_BYTES + b'1')]), 'paths.tgz'),
+                              (zip_of([('../zip-escaped.png', PNG_BYTES + b'2')]), 'paths.zip')):
+        result = upload(client, 'archive-paths', archive, filename)
+        assert all(member['status'] == 'success' for member in result['results'])
+
+    assert sorted(name.split('_')[0] for name in os.listdir(category_path)) == ['escaped', 'rooted', 'zip-escaped']
+    emoticons_dir = app_module.app.config['EMOTICONS_FOLDER']
+    for directory in (emoticons_dir, os.path.dirname(emoticons_dir)):
+        assert not [name for name in os.listdir(directory) if 'escaped' in name]
@@ -0,0 +1,89 @@
+"""The async proxy of asgi.py: miss, revalidation and dead origins, served through the ASGI app."""
+import asyncio
+import hashlib
+import http.server
+import threading
+
+import pytest
+
+from conftest import app_module
+
+httpx = pytest.importorskip('httpx')
+pytest.importorskip('a2wsgi')
+
+IMAGE_BYTES = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 800 # several cache writes per response
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    """/image.png with an ETag (answering If-None-Match with 304), anything else 404."""
+
+    def do_GET(self):
+        etag = '"' + hashlib.sha256(IMAGE_BYTES).hexdigest()[:16] + '"'
+        if self.path != '/image.png':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(IMAGE_BYTES)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(IMAGE_BYTES)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def origin_url():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def asgi_app():
+    import asgi
+    yield asgi.AsyncProxyApplication(app_module.app)
+    app_module.app.config['ASYNC_PROXY'] = False # set by importing asgi
+
+def add_link(category_name, url):
+    link_id = app_module.generate_unique_id()
+    app_module.catalog.add_external_links(category_name, [
+        {'id': link_id, 'url': url, 'added_at': '2024-01-01T00:00:00+00:00'}])
+    app_module.invalidate_category_index(category_name)
+    return link_id
+
+async def fetch_twice(application, path, between=None):
+    transport = httpx.ASGITransport(app=application)
+    async with httpx.AsyncClient(transport=transport, base_url='http://testserver') as client:
+        first = await client.get(path)
+        if between:
+            between()
+        second = await client.get(path)
+    return first, second
+
+def test_proxy_miss_then_revalidated(make_category, origin_url, asgi_app, monkeypatch):
+    make_category('proxied', 0)
+    link_id = add_link('proxied', f'{origin_url}/image.png')
+
+    first, second = asyncio.run(fetch_twice(asgi_app, f'/media/link/{link_id}',
+                                            between=lambda: monkeypatch.setattr(app_module.proxy_cache, 'ttl', 0)))
+    assert first.status_code == 200
+    assert first.headers['X-Proxy-Cache'] == 'MISS'
+    assert first.content == IMAGE_BYTES
+    assert second.status_code == 200
+    assert second.headers['X-Proxy-Cache'] == 'REVALIDATED'
+    assert second.content == IMAGE_BYTES
+
+def test_proxy_dead_origin(make_category, origin_url, asgi_app):
+    make_category('proxied-dead', 0)
+    link_id = add_link('proxied-dead', f'{origin_url}/missing.png')
+
+    first, _ = asyncio.run(fetch_twice(asgi_app, f'/media/link/{link_id}'))
+    assert first.status_code == 404
+    assert 'X-Proxy-Cache' not in first.headers
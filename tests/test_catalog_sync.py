@@ -0,0 +1,57 @@
+"""
+The catalog must not lose files that are on disk but were never scanned when the
+app itself writes into (or deletes from) a category.
+"""
+import io
+import os
+
+from conftest import PNG_BYTES, app_module
+
+def listed_files(client, category_name):
+    index = app_module.get_category_index(category_name)
+    response = client.get(f'/admin/category/{category_name}?per_page=50')
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert all(filename in page for filename in index.local_files)
+    return sorted(index.local_files)
+
+def test_upload_into_unscanned_category_keeps_existing_files(client, make_category):
+    make_category('unscanned-upload', 5)
+
+    response = client.post('/admin/upload', data={'category': 'unscanned-upload',
+                                                  'file': (io.BytesIO(PNG_BYTES + b'new'), 'new.png')})
+    assert response.status_code == 200, response.get_json()
+
+    files = listed_files(client, 'unscanned-upload')
+    assert len(files) == 6
+    assert sum(name.startswith('existing_') for name in files) == 5
+
+def test_delete_from_unscanned_category_keeps_other_files(client, make_category):
+    make_category('unscanned-delete', 5)
+
+    response = client.post('/admin/delete_image/unscanned-delete/existing_0.png')
+    assert response.status_code == 302
+
+    assert listed_files(client, 'unscanned-delete') == [f'existing_{i}.png' for i in range(1, 5)]
+
+def test_rename_in_unscanned_category_keeps_other_files(client, make_category):
+    make_category('unscanned-rename', 5)
+
+    response = client.post('/admin/rename/unscanned-rename/existing_0.png', data={'new_filename': 'renamed'})
+    assert response.status_code in (200, 302)
+
+    files = listed_files(client, 'unscanned-rename')
+    assert len(files) == 5
+    assert 'existing_0.png' not in files
+
+def test_upload_into_synced_category_does_not_rescan(client, make_category):
+    category_path = make_category('synced-upload', 3)
+    listed_files(client, 'synced-upload')
+
+    response = client.post('/admin/upload', data={'category': 'synced-upload',
+                                                  'file': (io.BytesIO(PNG_BYTES + b'new'), 'new.png')})
+    assert response.status_code == 200, response.get_json()
+
+    # The write was recorded on top of an in-sync catalog, so the new mtime counts as synced
+    assert app_module.catalog.get_category_state('synced-upload')[1] == os.stat(category_path).st_mtime_ns
+    assert len(listed_files(client, 'synced-upload')) == 4
@@ -0,0 +1,42 @@
+"""The random endpoint's cached category index."""
+import json
+import os
+
+from conftest import PNG_BYTES, app_module
+
+def test_index_is_reused_until_the_category_changes(make_category):
+    category_path = make_category('indexed', 3)
+    index = app_module.get_category_index('indexed')
+    assert sorted(index.local_files) == [f'existing_{i}.png' for i in range(3)]
+    assert app_module.get_category_index('indexed') is index
+
+    # A file dropped in outside the app moves the directory mtime
+    with open(os.path.join(category_path, 'added.png'), 'wb') as f:
+        f.write(PNG_BYTES)
+    dir_mtime_ns = os.stat(category_path).st_mtime_ns + 10 ** 9
+    os.utime(category_path, ns=(dir_mtime_ns, dir_mtime_ns))
+    rebuilt = app_module.get_category_index('indexed')
+    assert rebuilt is not index
+    assert 'added.png' in rebuilt.local_files
+
+def test_index_holds_local_files_then_external_links(make_category):
+    category_path = make_category('indexed-links', 2)
+    with open(os.path.join(category_path, 'notes.txt'), 'w') as f:
+        f.write('not an image')
+    with open(os.path.join(category_path, 'external_links.json'), 'w') as f:
+        json.dump([{'id': 'link-1', 'url': 'http://example.invalid/a.png', 'type': 'external'}], f)
+
+    index = app_module.get_category_index('indexed-links')
+    assert len(index) == 3
+    assert [index.item_at(position)['type'] for position in range(3)] == ['local', 'local', 'external']
+    assert index.item_at(2) == {'id': 'link-1', 'type': 'external', 'url': 'http://example.invalid/a.png'}
+
+def test_missing_category(client):
+    assert app_module.get_category_index('no-such-category') is None
+    assert client.get('/no-such-category').status_code == 404
+
+def test_random_endpoint_serves_category_files(client, make_category):
+    make_category('served', 2)
+    response = client.get('/served')
+    assert response.status_code == 200
+    assert response.data.startswith(PNG_BYTES)
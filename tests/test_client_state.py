@@ -0,0 +1,107 @@
+"""The random endpoint's per-client state is kept server side and shared by all workers."""
+from conftest import app_module
+
+def test_sqlite_store_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'client_state.sqlite3')
+    first = app_module.SQLiteClientStateStore(path, 100)
+    second = app_module.SQLiteClientStateStore(path, 100) # another worker opening the same file
+
+    bag = app_module.ShuffleBag(2 ** 64 - 1, 7, 5)
+    first.set('token', 'cat', (('local', 'a.png'), bag))
+    assert second.get('token', 'cat') == (('local', 'a.png'), bag)
+
+    second.set('token', 'cat', (('external', 'link-id'), None))
+    assert first.get('token', 'cat') == (('external', 'link-id'), None)
+    assert first.get('token', 'other') is None
+
+def test_sqlite_store_prunes_least_recently_used(tmp_path):
+    store = app_module.SQLiteClientStateStore(str(tmp_path / 'client_state.sqlite3'), 3)
+    for i in range(5):
+        store.set(f'token-{i}', 'cat', (('local', 'a.png'), None))
+    store.prune()
+
+    assert len(store) == 3
+    assert store.get('token-0', 'cat') is None
+    assert store.get('token-4', 'cat') is not None
+
+def test_last_shown_holds_across_workers(client, make_category, monkeypatch):
+    make_category('alternating', 2)
+    path = app_module.app.config['CLIENT_STATE_PATH']
+    workers = [app_module.SQLiteClientStateStore(path, 100) for _ in range(2)]
+
+    shown = []
+    for i in range(8):
+        monkeypatch.setattr(app_module, 'client_state', workers[i % 2]) # alternate between two workers' stores
+        shown.append(client.get('/alternating?redirect=1').headers['Location'])
+    # The first visit only sets the client token, from then on no item repeats
+    assert all(previous != current for previous, current in zip(shown[1:], shown[2:]))
+
+def test_clients_without_cookies_leave_no_state(make_category):
+    make_category('cookieless', 2)
+    before = len(app_module.client_state)
+    cookieless = app_module.app.test_client(use_cookies=False)
+    for _ in range(5):
+        response = cookieless.get('/cookieless')
+        assert response.status_code == 200
+        assert 'session=' in response.headers.get('Set-Cookie', '')
+    assert len(app_module.client_state) == before
+
+def test_category_delete_and_rename_update_states(client, make_category):
+    make_category('state-old', 2)
+    make_category('state-gone', 2)
+    for _ in range(2):
+        client.get('/state-old')
+        client.get('/state-gone')
+    with client.session_transaction() as session:
+        token = session['client_token']
+    assert app_module.client_state.get(token, 'state-old') is not None
+
+    client.post('/admin/rename_category/state-old', data={'new_category_name': 'state-new'})
+    assert app_module.client_state.get(token, 'state-old') is None
+    assert app_module.client_state.get(token, 'state-new') is not None
+
+    client.post('/admin/delete_category/state-gone')
+    assert app_module.client_state.get(token, 'state-gone') is None
+
+def test_logout_forgets_the_client_token(client, make_category):
+    make_category('state-logout', 1)
+    client.get('/state-logout')
+    client.get('/logout')
+    with client.session_transaction() as session:
+        assert 'client_token' not in session
+
+def test_unchanged_state_is_not_rewritten(client, make_category, monkeypatch):
+    make_category('single-item', 1)
+    client.get('/single-item')
+    client.get('/single-item')
+    writes = []
+    original_set = app_module.client_state.set
+    monkeypatch.setattr(app_module.client_state, 'set', lambda *args: writes.append(args) or original_set(*args))
+    for _ in range(3):
+        assert client.get('/single-item').status_code == 200
+    assert writes == []
+
+def test_shuffle_bag_visits_every_item_once_per_cycle():
+    for size in (1, 2, 7, 64, 65):
+        bag, shown = None, []
+        for _ in range(3 * size):
+            position, bag = app_module.next_shuffle_position(bag, size, shown[-1] if shown else None)
+            shown.append(position)
+        for cycle in range(3):
+            assert sorted(shown[cycle * size:(cycle + 1) * size]) == list(range(size))
+        if size > 1:
+            assert all(previous != current for previous, current in zip(shown, shown[1:]))
+
+def test_shuffle_bag_walks_whole_category_across_workers(client, make_category, monkeypatch):
+    make_category('shuffled', 6)
+    path = app_module.app.config['CLIENT_STATE_PATH']
+    workers = [app_module.SQLiteClientStateStore(path, 100) for _ in range(2)]
+    client.get('/shuffled') # the first visit only sets the client token
+
+    shown = []
+    for i in range(6):
+        monkeypatch.setattr(app_module, 'client_state', workers[i % 2]) # alternate between two workers' stores
+        response = client.get('/shuffled?mode=shuffle&redirect=1')
+        assert response.status_code == 302
+        shown.append(response.headers['Location'])
+    assert len(set(shown)) == 6
@@ -0,0 +1,69 @@
+"""Content deduplication must hold across worker processes storing the same bytes at once."""
+import os
+import subprocess
+import sys
+import time
+
+from conftest import PNG_BYTES, app_module
+
+WORKER = '''
+import os, sys, time
+sys.path.insert(0, {root!r})
+import app
+category_path = os.path.join(app.app.config['EMOTICONS_FOLDER'], {category!r})
+filename = f'worker_{{os.getpid()}}.png'
+time.sleep(max(0, {start_at!r} - time.time()))
+dir_mtime_before = app._stat_mtime_ns(category_path)
+with open(os.path.join(category_path, filename), 'wb') as f:
+    f.write({content!r})
+kept, duplicate_of = app.store_deduplicated({category!r}, filename, {sha256!r}, dir_mtime_before)
+print('kept' if kept else 'duplicate')
+'''
+
+def test_concurrent_workers_keep_one_copy(make_category, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'DEDUP_MODE', 'reject')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for round_number in range(3):
+        category_name = f'dedup-race-{round_number}'
+        category_path = make_category(category_name, 0)
+        content = PNG_BYTES + f'race {round_number}'.encode('ascii')
+        script = WORKER.format(root=root, category=category_name, start_at=time.time() + 2, content=content,
+                               sha256=app_module.hashlib.sha256(content).hexdigest())
+        env = dict(os.environ, DEDUP_MODE='reject')
+        workers = [subprocess.Popen([sys.executable, '-c', script], env=env, stdout=subprocess.PIPE, text=True)
+                   for _ in range(4)]
+        outcomes = sorted(worker.communicate(timeout=60)[0].strip() for worker in workers)
+
+        assert outcomes == ['duplicate'] * 3 + ['kept']
+        assert len(os.listdir(category_path)) == 1
+
+class FakeDownload:
+    """Stands in for the streamed response of http_get."""
+    headers = {'content-type': 'image/png', 'content-length': str(len(PNG_BYTES))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield PNG_BYTES
+
+def test_import_keeps_the_downloaded_file_when_recording_it_fails(make_category, monkeypatch):
+    category_path = make_category('dedup-record-error', 0)
+    monkeypatch.setattr(app_module, 'http_get', lambda *args, **kwargs: FakeDownload())
+
+    def failing_store(*args):
+        raise app_module.sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(app_module, 'store_deduplicated', failing_store)
+    events = []
+
+    assert not app_module._download_url_item('task', 'item', 'https://example.com/a.png', 'dedup-record-error',
+                                              lambda name, payload: events.append(payload))
+    assert events[-1]['status'] == '错误'
+    assert os.listdir(category_path) == [events[-1]['new_filename']]
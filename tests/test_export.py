@@ -0,0 +1,30 @@
+"""Range handling of the category export."""
+import io
+import zipfile
+
+def test_multi_range_gets_whole_zip(client, make_category):
+    make_category('export-ranges', 3)
+    full = client.get('/admin/export/export-ranges')
+    assert full.status_code == 200
+
+    response = client.get('/admin/export/export-ranges', headers={'Range': 'bytes=0-9,20-29'})
+    assert response.status_code == 200
+    assert response.data == full.data
+    assert len(zipfile.ZipFile(io.BytesIO(response.data)).namelist()) >= 3
+
+def test_single_range(client, make_category):
+    make_category('export-single-range', 3)
+    full = client.get('/admin/export/export-single-range').data
+
+    response = client.get('/admin/export/export-single-range', headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206
+    assert response.data == full[10:20]
+    assert response.headers['Content-Range'] == f'bytes 10-19/{len(full)}'
+
+def test_unsatisfiable_single_range(client, make_category):
+    make_category('export-bad-range', 1)
+    length = len(client.get('/admin/export/export-bad-range').data)
+
+    response = client.get('/admin/export/export-bad-range', headers={'Range': f'bytes={length + 10}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{length}'
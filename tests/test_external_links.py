@@ -0,0 +1,32 @@
+"""Bulk external link adds skip URLs that only differ in their spelling."""
+from conftest import app_module
+
+def add_links(client, category_name, urls):
+    response = client.post(f'/admin/category/{category_name}/add_external_links', data={'urls': '\n'.join(urls)})
+    return response.get_json()
+
+def test_normalize_url():
+    assert app_module.normalize_url('HTTP://Example.COM:80') == 'http://example.com/'
+    assert app_module.normalize_url('https://example.com:443/a.png#top') == 'https://example.com/a.png'
+    assert app_module.normalize_url('https://example.com:8443/a.png?x=1') == 'https://example.com:8443/a.png?x=1'
+
+def test_duplicates_within_one_batch_are_skipped(client, make_category):
+    make_category('links-batch', 0)
+
+    data = add_links(client, 'links-batch', ['https://example.com/a.png',
+                                             'HTTPS://EXAMPLE.com:443/a.png#preview',
+                                             'ftp://example.com/b.png',
+                                             'https://example.com/b.png'])
+
+    assert [detail['status'] for detail in data['details']] == ['success', 'skipped', 'error', 'success']
+    assert sorted(url for _, url in app_module.get_category_index('links-batch').external_links) == [
+        'https://example.com/a.png', 'https://example.com/b.png']
+
+def test_links_already_in_the_category_are_skipped(client, make_category):
+    make_category('links-existing', 0)
+    add_links(client, 'links-existing', ['https://example.com/a.png'])
+
+    data = add_links(client, 'links-existing', ['https://Example.com/a.png', 'https://example.com/c.png'])
+
+    assert [detail['status'] for detail in data['details']] == ['skipped', 'success']
+    assert len(app_module.get_category_index('links-existing')) == 2
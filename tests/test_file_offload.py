@@ -0,0 +1,54 @@
+"""FILE_OFFLOAD: local files are handed to the front server with X-Accel-Redirect / X-Sendfile."""
+import hashlib
+import os
+
+from conftest import PNG_BYTES, app_module
+
+def test_nginx_offload_returns_only_headers(client, make_category, monkeypatch):
+    category_path = make_category('offload-nginx', 1)
+    monkeypatch.setitem(app_module.app.config, 'FILE_OFFLOAD', 'nginx')
+    monkeypatch.setitem(app_module.app.config, 'FILE_OFFLOAD_PREFIX', '/_emoticons/')
+
+    response = client.get('/offload-nginx', headers={'Range': 'bytes=0-3'})
+    assert response.status_code == 200 # Range is left to the front server
+    assert response.headers['X-Accel-Redirect'] == '/_emoticons/offload-nginx/existing_0.png'
+    assert 'X-Sendfile' not in response.headers
+    assert response.data == b''
+    assert response.mimetype == 'image/png'
+    assert os.path.isfile(os.path.join(category_path, 'existing_0.png'))
+
+    download = client.get('/admin/download/offload-nginx/existing_0.png')
+    assert download.headers['X-Accel-Redirect'] == '/_emoticons/offload-nginx/existing_0.png'
+    assert 'attachment' in download.headers['Content-Disposition']
+
+def test_sendfile_offload_passes_the_absolute_path(client, make_category, monkeypatch):
+    category_path = make_category('offload-sendfile', 1)
+    monkeypatch.setitem(app_module.app.config, 'FILE_OFFLOAD', 'sendfile')
+
+    response = client.get('/offload-sendfile')
+    assert response.headers['X-Sendfile'] == os.path.join(os.path.abspath(category_path), 'existing_0.png')
+    assert 'X-Accel-Redirect' not in response.headers
+    assert response.data == b''
+
+def test_conditional_media_request_is_answered_by_the_app(client, make_category, monkeypatch):
+    make_category('offload-media', 1)
+    monkeypatch.setitem(app_module.app.config, 'FILE_OFFLOAD', 'nginx')
+    content_hash = hashlib.sha256(PNG_BYTES + b'0').hexdigest()
+    location = client.get('/offload-media?redirect=1').headers['Location']
+
+    response = client.get(location)
+    # Other tests' categories hold the same bytes, /media/ may answer with any of them
+    assert response.headers['X-Accel-Redirect'].startswith('/_emoticons/')
+    assert response.headers['X-Accel-Redirect'].endswith('/existing_0.png')
+    assert response.headers['ETag'] == f'"{content_hash}"'
+
+    not_modified = client.get(location, headers={'If-None-Match': f'"{content_hash}"'})
+    assert not_modified.status_code == 304
+    assert 'X-Accel-Redirect' not in not_modified.headers
+
+def test_files_are_sent_directly_by_default(client, make_category):
+    make_category('offload-off', 1)
+    response = client.get('/offload-off')
+    assert 'X-Accel-Redirect' not in response.headers
+    assert 'X-Sendfile' not in response.headers
+    assert response.data == PNG_BYTES + b'0'
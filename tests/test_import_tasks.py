@@ -0,0 +1,45 @@
+"""URL import tasks left 'running' by a worker that went away must end instead of streaming heartbeats."""
+import datetime
+import os
+import time
+import uuid
+
+from conftest import app_module
+
+def create_running_task(owner_pid, heartbeat_age):
+    task_id = str(uuid.uuid4())
+    store = app_module.task_store
+    store.create(task_id, {'category': 'tasks', 'urls': ['http://example.invalid/a.png'], 'status': 'pending',
+                           'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat()})
+    store.update_status(task_id, 'running')
+    with store._connect() as conn:
+        conn.execute('UPDATE tasks SET owner_pid = ?, heartbeat_ts = ? WHERE id = ?',
+                     (owner_pid, time.time() - heartbeat_age, task_id))
+    return task_id
+
+def test_status_marks_task_without_heartbeat_failed(client):
+    task_id = create_running_task(os.getpid() + 1, app_module.app.config['TASK_HEARTBEAT_TIMEOUT'] + 5)
+
+    data = client.get(f'/admin/url_download_task/{task_id}').get_json()
+    assert data['task_status'] == 'failed'
+    assert data['result']['error']
+
+def test_stream_ends_with_error_for_orphaned_task(client):
+    task_id = create_running_task(os.getpid() + 1, app_module.app.config['TASK_HEARTBEAT_TIMEOUT'] + 5)
+
+    body = client.get(f'/admin/stream_url_download_progress?task_id={task_id}').get_data(as_text=True)
+    assert 'event: error' in body
+    # A reconnect after the error was delivered ends right away as well
+    assert 'event: error' not in client.get(f'/admin/stream_url_download_progress?task_id={task_id}',
+                                            headers={'Last-Event-ID': '999999999'}).get_data(as_text=True)
+
+def test_task_of_this_process_not_running_here_is_orphaned(client):
+    # Same pid as a restarted worker, but this process does not run the task
+    task_id = create_running_task(os.getpid(), 0)
+
+    assert client.get(f'/admin/url_download_task/{task_id}').get_json()['task_status'] == 'failed'
+
+def test_task_with_fresh_heartbeat_keeps_running(client):
+    task_id = create_running_task(os.getpid() + 1, 0)
+
+    assert client.get(f'/admin/url_download_task/{task_id}').get_json()['task_status'] == 'running'
@@ -0,0 +1,55 @@
+"""Health checks of external links: dead links leave the random pool until a check succeeds again."""
+import concurrent.futures
+
+from conftest import app_module
+
+def add_links(category_name, *link_ids):
+    app_module.catalog.add_external_links(category_name, [
+        {'id': link_id, 'url': f'https://example.com/{link_id}.png', 'added_at': f'2024-01-0{i + 1}T00:00:00+00:00'}
+        for i, link_id in enumerate(link_ids)])
+    app_module.invalidate_category_index(category_name)
+
+def run_checks(category_name, monkeypatch, results):
+    monkeypatch.setattr(app_module, 'check_link', lambda link_id, url: results[link_id])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        return app_module.run_link_checks(executor, 10, category_name)
+
+def test_dead_link_is_skipped_until_it_recovers(client, make_category, monkeypatch):
+    make_category('checked-links', 0)
+    add_links('checked-links', 'alive', 'broken')
+    monkeypatch.setitem(app_module.app.config, 'LINK_CHECK_FAILURES', 2)
+
+    assert run_checks('checked-links', monkeypatch, {'alive': (True, 'HTTP 200'), 'broken': (False, 'HTTP 404')}) == 2
+    assert app_module.catalog.count_dead_links('checked-links') == 0 # one failure is not enough
+
+    app_module.catalog.schedule_link_checks('checked-links')
+    run_checks('checked-links', monkeypatch, {'alive': (True, 'HTTP 200'), 'broken': (False, 'HTTP 404')})
+    assert [link['id'] for link in app_module.catalog.list_dead_links('checked-links')] == ['broken']
+    for _ in range(5):
+        assert client.get('/checked-links?redirect=1').headers['Location'] == '/media/link/alive'
+
+    app_module.catalog.schedule_link_checks('checked-links')
+    run_checks('checked-links', monkeypatch, {'alive': (True, 'HTTP 200'), 'broken': (True, 'HTTP 200')})
+    assert app_module.catalog.count_dead_links('checked-links') == 0
+    locations = {client.get('/checked-links?redirect=1').headers['Location'] for _ in range(10)}
+    assert locations == {'/media/link/alive', '/media/link/broken'}
+
+def test_inconclusive_check_keeps_the_failure_count(client, make_category, monkeypatch):
+    make_category('rate-limited-links', 0)
+    add_links('rate-limited-links', 'limited')
+    monkeypatch.setitem(app_module.app.config, 'LINK_CHECK_FAILURES', 2)
+
+    for result in [(False, 'HTTP 500'), (None, 'HTTP 429'), (False, 'HTTP 500')]:
+        app_module.catalog.schedule_link_checks('rate-limited-links')
+        run_checks('rate-limited-links', monkeypatch, {'limited': result})
+    assert [link['id'] for link in app_module.catalog.list_dead_links('rate-limited-links')] == ['limited']
+
+def test_failed_proxy_fetch_makes_a_live_link_due(make_category, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'LINK_CHECK_INTERVAL', 3600) # the conftest turns the checker off
+    make_category('proxied-links', 0)
+    add_links('proxied-links', 'flaky')
+    app_module.catalog.claim_due_links(10, app_module.LINK_CHECK_LEASE, 'proxied-links') # nothing due afterwards
+    assert app_module.catalog.claim_due_links(10, app_module.LINK_CHECK_LEASE, 'proxied-links') == []
+
+    app_module.request_link_check('flaky')
+    assert [link['id'] for link in app_module.catalog.claim_due_links(10, app_module.LINK_CHECK_LEASE, 'proxied-links')] == ['flaky']
@@ -0,0 +1,40 @@
+"""/metrics output: valid Prometheus text, with every per-process sample labelled by the process that answered."""
+import os
+
+import pytest
+
+from conftest import app_module
+
+SHARED_PREFIXES = ('bqb_proxy_cache_', 'bqb_client_state_entries')
+
+def metric_samples(client):
+    body = client.get('/metrics').get_data(as_text=True)
+    return [line for line in body.splitlines() if line and not line.startswith('#')]
+
+def test_samples_carry_pid_label(client):
+    client.get('/')
+    samples = metric_samples(client)
+
+    per_process = [line for line in samples if not line.startswith(SHARED_PREFIXES)]
+    assert per_process
+    assert all(f'pid="{os.getpid()}"' in line for line in per_process)
+    assert any(line.startswith('bqb_http_request_duration_seconds_bucket{') and 'le="+Inf"' in line for line in samples)
+
+def test_shared_store_metrics_have_no_pid(client):
+    app_module.proxy_cache.record('hits')
+    samples = [line for line in metric_samples(client) if line.startswith(SHARED_PREFIXES)]
+
+    assert {line.split('{')[0].split(' ')[0] for line in samples} == {
+        'bqb_proxy_cache_bytes', 'bqb_proxy_cache_entries', 'bqb_proxy_cache_events_total', 'bqb_client_state_entries'}
+    assert not any('pid=' in line for line in samples)
+    hits = next(line for line in samples if line.startswith('bqb_proxy_cache_events_total{event="hits"}'))
+    assert int(hits.split()[-1]) == app_module.proxy_cache.snapshot()['hits'] >= 1
+
+def test_process_start_time_is_exposed(client):
+    parser = pytest.importorskip('prometheus_client.parser')
+    body = client.get('/metrics').get_data(as_text=True)
+
+    families = {family.name: family for family in parser.text_string_to_metric_families(body)}
+    start_time = families['process_start_time_seconds'].samples[0]
+    assert start_time.labels == {'pid': str(os.getpid())}
+    assert start_time.value == pytest.approx(app_module.process_started_at)
@@ -0,0 +1,52 @@
+"""Prev/next pages of the admin category view continue from a keyset cursor, not an OFFSET."""
+import html
+import re
+
+from conftest import app_module
+
+def add_links(category_name, numbers):
+    app_module.catalog.add_external_links(category_name, [
+        {'id': f'link-{n:04d}', 'url': f'https://example.com/{n:04d}.png', 'added_at': f'2024-01-01T00:00:00.{n:06d}+00:00'}
+        for n in numbers])
+    app_module.invalidate_category_index(category_name)
+
+def listed_numbers(page):
+    return sorted({int(n) for n in re.findall(r'https://example\.com/(\d{4})\.png', page)}, reverse=True)
+
+def pager_link(page, label):
+    href = re.search(r'<a class="page-link" href="([^"]+)" aria-label="' + label + '"', page).group(1)
+    return html.unescape(href)
+
+def test_next_and_previous_pages_are_stable_while_items_are_added(client, make_category):
+    make_category('paged', 0)
+    add_links('paged', range(120))
+
+    first_page = client.get('/admin/category/paged?per_page=50').get_data(as_text=True)
+    assert listed_numbers(first_page) == list(range(119, 69, -1))
+
+    # Newer items push every OFFSET page back, the cursor keeps pointing at the same item
+    add_links('paged', range(120, 130))
+    second_page = client.get(pager_link(first_page, 'Next')).get_data(as_text=True)
+    assert listed_numbers(second_page) == list(range(69, 19, -1))
+
+    add_links('paged', range(130, 140))
+    previous_page = client.get(pager_link(second_page, 'Previous')).get_data(as_text=True)
+    assert listed_numbers(previous_page) == list(range(119, 69, -1))
+
+def test_catalog_keyset_pages():
+    add_links('keyset', range(10))
+    newest = app_module.catalog.list_items_page('keyset', 4)
+    assert [item['id'] for item in newest] == ['link-0009', 'link-0008', 'link-0007', 'link-0006']
+
+    key = app_module.decode_listing_cursor(app_module.encode_listing_cursor(newest[-1]))
+    assert [item['id'] for item in app_module.catalog.list_items_page('keyset', 4, after=key)] == [
+        'link-0005', 'link-0004', 'link-0003', 'link-0002']
+    assert [item['id'] for item in app_module.catalog.list_items_page('keyset', 2, before=key)] == ['link-0008', 'link-0007']
+
+def test_malformed_cursor_falls_back_to_the_page_number(client, make_category):
+    make_category('paged-fallback', 0)
+    add_links('paged-fallback', range(60))
+    assert app_module.decode_listing_cursor('not-a-cursor') is None
+
+    page = client.get('/admin/category/paged-fallback?per_page=50&page=2&after=not-a-cursor').get_data(as_text=True)
+    assert listed_numbers(page) == list(range(9, -1, -1))
@@ -0,0 +1,82 @@
+import os
+import time
+
+from conftest import app_module
+
+class FakeResponse:
+    """Stands in for a streamed requests.Response from the origin."""
+
+    def __init__(self, body, content_type='image/png'):
+        self.body = body
+        self.headers = {'Content-Type': content_type, 'ETag': '"v1"'}
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+def store(cache, link_id, body):
+    url = f'https://example.com/{link_id}.png'
+    relayed = b''.join(cache.stream_and_store(link_id, url, FakeResponse(body)))
+    assert relayed == body
+    return url
+
+def make_cache(cache_dir, max_bytes=250):
+    return app_module.ProxyCache(str(cache_dir), max_bytes, 100, 3600, 15)
+
+def test_workers_share_one_size_cap_and_lru_order(tmp_path):
+    worker_a = make_cache(tmp_path)
+    worker_b = make_cache(tmp_path)
+    url_1 = store(worker_a, 'link-1', b'1' * 100)
+    url_2 = store(worker_b, 'link-2', b'2' * 100)
+    # link-1 was stored by the other worker, but a hit here still makes it the most recently used
+    assert worker_b.lookup('link-1', url_1)['size'] == 100
+    with worker_b._connect() as conn:
+        conn.execute("UPDATE entries SET used_at = used_at - 3600 WHERE link_id = 'link-2'")
+
+    store(worker_a, 'link-3', b'3' * 100)
+
+    assert worker_a.lookup('link-2', url_2) is None
+    assert not os.path.exists(worker_a.data_path('link-2'))
+    assert worker_b.lookup('link-1', url_1) is not None
+    for cache in (worker_a, worker_b):
+        snapshot = cache.snapshot()
+        assert snapshot['entries'] == 2
+        assert snapshot['total_bytes'] == 200
+        assert snapshot['stores'] == 3
+        assert snapshot['evictions'] == 1
+
+def test_counters_of_all_workers_are_reported(tmp_path):
+    worker_a = make_cache(tmp_path)
+    worker_b = make_cache(tmp_path)
+    worker_a.record('hits')
+    worker_a.record('misses')
+    worker_b.record('hits')
+    worker_a._flush_stats()
+
+    snapshot = worker_b.snapshot()
+    assert snapshot['hits'] == 2
+    assert snapshot['misses'] == 1
+    assert snapshot['hit_ratio'] == round(2 / 3, 4)
+
+def test_oversized_body_is_relayed_but_not_cached(tmp_path):
+    cache = make_cache(tmp_path)
+    url = store(cache, 'link-big', b'x' * 150)
+    assert cache.lookup('link-big', url) is None
+    assert [name for name in os.listdir(tmp_path) if name.endswith(('.bin', '.tmp'))] == []
+
+def test_startup_keeps_temp_files_of_running_downloads(tmp_path):
+    make_cache(tmp_path)
+    abandoned = tmp_path / 'abandoned.tmp'
+    in_progress = tmp_path / 'in-progress.tmp'
+    abandoned.write_bytes(b'a')
+    in_progress.write_bytes(b'b')
+    old = time.time() - 60
+    os.utime(abandoned, (old, old))
+
+    make_cache(tmp_path) # another worker starting up
+
+    assert not abandoned.exists()
+    assert in_progress.exists()
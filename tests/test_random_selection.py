@@ -0,0 +1,29 @@
+"""Random draws that skip the item shown last."""
+import collections
+import random
+
+from conftest import app_module
+
+def test_never_returns_excluded_position():
+    for size in range(2, 8):
+        for excluded in range(size):
+            for _ in range(200):
+                position = app_module.pick_random_position(size, excluded)
+                assert 0 <= position < size and position != excluded
+
+def test_uniform_over_the_remaining_positions():
+    random.seed(1234)
+    draws = 40000
+    counts = collections.Counter(app_module.pick_random_position(5, 2) for _ in range(draws))
+    assert set(counts) == {0, 1, 3, 4}
+    for position in (0, 1, 3, 4):
+        assert abs(counts[position] - draws / 4) < draws / 4 * 0.05
+
+def test_single_item_and_no_exclusion():
+    assert app_module.pick_random_position(1, 0) == 0
+    assert {app_module.pick_random_position(3) for _ in range(300)} == {0, 1, 2}
+
+def test_endpoint_does_not_repeat_the_last_item(client, make_category):
+    make_category('two-items', 2)
+    shown = [client.get('/two-items').data for _ in range(20)]
+    assert all(previous != current for previous, current in zip(shown, shown[1:]))
@@ -0,0 +1,48 @@
+"""Redirect mode of the random endpoint and the cacheable /media/... URLs it points to."""
+import hashlib
+
+from conftest import PNG_BYTES, app_module
+
+def test_redirect_query_overrides_the_configured_mode(client, make_category, monkeypatch):
+    make_category('redirected', 1)
+
+    monkeypatch.setitem(app_module.app.config, 'RANDOM_REDIRECT', False)
+    response = client.get('/redirected?redirect=1')
+    assert response.status_code == 302
+    assert response.headers['Cache-Control'] == 'no-store'
+    assert client.get('/redirected').status_code == 200
+
+    monkeypatch.setitem(app_module.app.config, 'RANDOM_REDIRECT', True)
+    assert client.get('/redirected').status_code == 302
+    response = client.get('/redirected?redirect=0')
+    assert response.status_code == 200
+    assert response.data == PNG_BYTES + b'0'
+
+def test_local_file_redirects_to_content_addressed_media(client, make_category):
+    make_category('media', 1)
+    content_hash = hashlib.sha256(PNG_BYTES + b'0').hexdigest()
+
+    response = client.get('/media?redirect=1')
+    assert response.headers['Location'] == f'/media/{content_hash}.png'
+
+    media = client.get(response.headers['Location'])
+    assert media.status_code == 200
+    assert media.data == PNG_BYTES + b'0'
+    assert media.cache_control.immutable
+    assert media.cache_control.max_age == app_module.app.config['MEDIA_MAX_AGE']
+    assert client.get(response.headers['Location'], headers={'If-None-Match': f'"{content_hash}"'}).status_code == 304
+
+def test_external_link_redirects_to_its_id(client, make_category):
+    make_category('media-links', 0)
+    app_module.catalog.add_external_links('media-links', [
+        {'id': 'link-a', 'url': 'https://example.com/a.png', 'added_at': '2024-01-01T00:00:00+00:00'}])
+    app_module.invalidate_category_index('media-links')
+
+    response = client.get('/media-links?redirect=1')
+    assert response.status_code == 302
+    assert response.headers['Location'] == '/media/link/link-a'
+
+def test_unknown_media_is_not_found(client):
+    assert client.get('/media/' + '0' * 64 + '.png').status_code == 404
+    assert client.get('/media/not-a-hash.png').status_code == 404
+    assert client.get('/media/link/no-such-link').status_code == 404
@@ -0,0 +1,64 @@
+"""A missing thumbnail must not hold the request while it renders."""
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from conftest import app_module
+
+pytest.importorskip('PIL')
+
+@pytest.fixture
+def slow_renderer(monkeypatch):
+    """Renders thumbnails in a thread pool, each render blocked until the test releases it."""
+    release = threading.Event()
+    render_thumbnail = app_module.imaging.render_thumbnail
+    renders = []
+
+    def blocked_render(*args):
+        renders.append(args)
+        release.wait(10)
+        return render_thumbnail(*args)
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(app_module.imaging, 'render_thumbnail', blocked_render)
+    monkeypatch.setattr(app_module, 'get_thumbnail_pool', lambda: pool)
+    yield release, renders
+    release.set()
+    pool.shutdown()
+
+def test_missing_thumbnail_redirects_to_original_and_renders_in_background(client, make_category, slow_renderer):
+    release, renders = slow_renderer
+    category_path = make_category('thumbs', 1)
+    from PIL import Image
+    Image.new('RGB', (600, 400), 'red').save(f'{category_path}/existing_0.png')
+
+    started = time.monotonic()
+    response = client.get('/thumbnails/thumbs/existing_0.png')
+    assert time.monotonic() - started < app_module.app.config['THUMBNAIL_RENDER_TIMEOUT'] + 1
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/emoticons/thumbs/existing_0.png')
+    assert response.headers['Cache-Control'] == 'no-store'
+
+    # A second page load while the render is still under way does not queue it again
+    assert client.get('/thumbnails/thumbs/existing_0.png').status_code == 302
+    assert len(renders) == 1
+
+    release.set()
+    app_module.schedule_thumbnail('thumbs', 'existing_0.png').result(10)
+    response = client.get('/thumbnails/thumbs/existing_0.png')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/webp'
+
+def test_thumbnail_follows_exif_orientation(tmp_path):
+    from PIL import Image
+    source_path = tmp_path / 'rotated.jpg'
+    exif = Image.Exif()
+    exif[0x0112] = 6 # stored landscape, displayed rotated 90 degrees clockwise
+    Image.new('RGB', (400, 200), 'blue').save(source_path, exif=exif)
+
+    target_path = tmp_path / 'rotated.jpg.webp'
+    assert app_module.imaging.render_thumbnail(str(source_path), str(target_path), 100)
+    with Image.open(target_path) as thumbnail:
+        assert thumbnail.size == (50, 100)
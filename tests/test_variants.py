@@ -0,0 +1,49 @@
+"""WebP/AVIF variants: chosen from the Accept header, and not queued again after a failed render."""
+import os
+
+import pytest
+
+from conftest import app_module
+
+Image = pytest.importorskip('PIL.Image')
+
+def test_undecodable_source_gets_empty_marker(tmp_path):
+    source_path = tmp_path / 'broken.png'
+    source_path.write_bytes(b'not an image')
+    target_path = tmp_path / 'variants' / 'broken.png.webp'
+
+    assert app_module.imaging.render_variant(str(source_path), str(target_path), 'webp') is None
+    assert target_path.exists() and target_path.stat().st_size == 0
+
+def test_failed_variant_is_not_queued_again(client, make_category, monkeypatch):
+    if 'webp' not in app_module.variant_formats:
+        pytest.skip('this Pillow build cannot encode WebP')
+    category_path = make_category('broken-variants', 0)
+    with open(os.path.join(category_path, 'broken.png'), 'wb') as f:
+        f.write(b'not an image')
+    app_module.imaging.render_variant(os.path.join(category_path, 'broken.png'),
+                                      app_module.variant_path('broken-variants', 'broken.png', 'webp'), 'webp')
+
+    queued = []
+    monkeypatch.setattr(app_module, 'schedule_variant', lambda *args: queued.append(args))
+    response = client.get('/emoticons/broken-variants/broken.png', headers={'Accept': 'image/webp,*/*'})
+    assert response.status_code == 200
+    assert response.data == b'not an image'
+    assert queued == []
+
+def test_accepted_variant_is_sent(client, make_category):
+    if 'webp' not in app_module.variant_formats:
+        pytest.skip('this Pillow build cannot encode WebP')
+    category_path = make_category('variants-accept', 0)
+    source_path = os.path.join(category_path, 'plain.png')
+    Image.new('RGB', (200, 200), (200, 30, 30)).save(source_path, compress_level=0)
+    assert app_module.imaging.render_variant(source_path, app_module.variant_path('variants-accept', 'plain.png', 'webp'), 'webp') > 0
+
+    response = client.get('/emoticons/variants-accept/plain.png', headers={'Accept': 'image/webp,*/*'})
+    assert response.mimetype == 'image/webp'
+    assert 'Accept' in response.vary
+
+    # */* alone does not mean the client decodes WebP
+    response = client.get('/emoticons/variants-accept/plain.png', headers={'Accept': '*/*'})
+    assert response.mimetype == 'image/png'
+    assert 'Accept' in response.vary